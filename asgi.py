@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+ASGI 入口（异步服务模式）
+
+/v1/chat/completions 由原生 asyncio 处理：与同步端点共用 main 中的请求管线阶段，
+上游流使用共享的 httpx.AsyncClient，数据库和会话文件读写放到线程池中执行，
+单个进程即可同时保持大量上游流。
+其余路由（Azure 兼容端点、用户管理、静态页面）通过 WsgiToAsgi 交给 Flask 应用，行为不变。
+
+启动方式：
+    uvicorn asgi:application --host 0.0.0.0 --port 8080
+"""
+import asyncio
+import json
+import time
+import uuid
+import logging
+from contextlib import aclosing
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import g
+
+from main import (
+    app, request_logger, api_debug_logger, authenticate_api_key,
+    update_session, finish_session_turn, format_openai_error_response, format_openai_non_streaming_response,
+    ChatPipelineError, prepare_chat, log_upstream_call, log_upstream_response, record_usage,
+    handle_upstream_error, check_event_stream, record_cancel
+)
+from auth_cache import client_address
+from http_transport import upstream_transport
+from usage_writer import usage_writer
+from sse_parser import SSEParser, extract_event_fields
+from sse_encoder import OpenAIStreamEncoder
+from stream_coalescer import create_coalescer
+from logging_system import enable_queue_logging
+
+logger = logging.getLogger(__name__)
+
+# 非原生处理的路由全部交给 Flask
+flask_application = WsgiToAsgi(app)
+
+_log_listener = None
+
+# 上游流结束标记
+_STREAM_END = object()
+
+
+async def _read_body(receive):
+    """读取完整请求体，客户端提前断开时返回 None"""
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+async def _send_json(send, status_code, payload):
+    """发送 JSON 响应"""
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1'))
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _aiter_sse_payloads(response):
+    """从上游原始字节流中逐个产出 SSE data 载荷"""
+    parser = SSEParser()
+    async for chunk in response.aiter_bytes():
+        for payload in parser.feed(chunk):
+            yield payload
+    for payload in parser.flush():
+        yield payload
+
+
+async def acall_upstream(ctx):
+    """call_upstream 的异步版本：阶段逻辑与同步管线共用，只有网络和数据库读写改为非阻塞"""
+    log_upstream_call(ctx)
+
+    retried = False
+    while True:
+        start_time = time.time()
+        response = await ctx.client.achat(ctx.query, **ctx.chat_kwargs())
+        api_timing = time.time() - start_time
+
+        if not retried:
+            await asyncio.to_thread(record_usage, ctx)
+        log_upstream_response(ctx, response, api_timing, retried)
+
+        if response.status_code == 200:
+            break
+
+        error_details = (await response.aread()).decode('utf-8', errors='replace') or "无错误详情"
+        await response.aclose()
+        # 可能轮换默认会话（会话存储的写入），放到线程池
+        await asyncio.to_thread(handle_upstream_error, ctx, response.status_code, error_details, retried)
+        retried = True
+
+    try:
+        check_event_stream(response)
+    except ChatPipelineError:
+        await response.aclose()
+        raise
+    return response
+
+
+async def aiter_chat_content(ctx, response):
+    """iter_chat_content 的异步版本，会话文件读写放到线程池中执行"""
+    received_conversation_id = False
+    error = None
+
+    try:
+        async for payload in _aiter_sse_payloads(response):
+            conv_id, content = extract_event_fields(payload)
+
+            if conv_id and not received_conversation_id:
+                print(f"[STREAM] 收到conversationId: {conv_id}")
+                await asyncio.to_thread(update_session, ctx.session_id, conv_id, ctx.turn_index + 1, ctx.token_info['id'])
+                received_conversation_id = True
+
+            if content:
+                yield content
+    except Exception as e:
+        error = e
+    finally:
+        # 对话结束后更新 turn_index（如果还没更新）
+        if not received_conversation_id:
+            await asyncio.to_thread(finish_session_turn, ctx.session_id)
+
+    if error is not None:
+        raise error
+
+
+async def _aiter_with_deadline(contents, coalescer):
+    """
+    在 content 迭代器的基础上支持合并窗口到期：
+    窗口到期而上游暂无新内容时产出 None，由调用方 flush 合并缓冲区
+    """
+    if not coalescer.window:
+        async for content in contents:
+            yield content
+        return
+
+    queue = asyncio.Queue(maxsize=64)
+
+    async def pump():
+        try:
+            async for content in contents:
+                await queue.put(content)
+            await queue.put(_STREAM_END)
+        except Exception as e:
+            await queue.put(e)
+
+    pump_task = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), coalescer.time_remaining())
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if item is _STREAM_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
+
+
+async def _wait_for_disconnect(receive):
+    """请求体读取完毕后，receive() 只会在客户端断开时返回 http.disconnect"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def _run_until_disconnect(receive, coro):
+    """
+    执行输出协程，客户端断开时立即取消它
+
+    uvicorn 在连接断开后会静默丢弃 send()，只能通过 receive() 感知断开。
+
+    Returns:
+        True 表示正常完成，False 表示客户端已断开
+    """
+    task = asyncio.create_task(coro)
+    watcher = asyncio.create_task(_wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+
+    if task.done():
+        task.result()
+        return True
+
+    # 客户端断开：取消输出，上游响应在其 finally 中关闭
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return False
+
+
+async def _stream_response(send, ctx, response, progress):
+    """管线输出阶段（流式）：合并 content 增量并编码为 OpenAI chunk 帧"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache')
+        ]
+    })
+
+    encoder = OpenAIStreamEncoder(f"chatcmpl-{uuid.uuid4()}", ctx.model)
+    coalescer = create_coalescer(ctx.data, ctx.user_info)
+
+    async def send_content(text):
+        await send({
+            'type': 'http.response.body',
+            'body': encoder.encode_content(text),
+            'more_body': True
+        })
+
+    try:
+        chat_contents = aiter_chat_content(ctx, response)
+        contents = _aiter_with_deadline(chat_contents, coalescer)
+        async with aclosing(chat_contents), aclosing(contents):
+            async for content in contents:
+                # None 表示合并窗口到期
+                merged = coalescer.flush() if content is None else coalescer.push(content)
+                if merged:
+                    await send_content(merged)
+                    progress['chunks_sent'] += 1
+    except Exception as e:
+        print(f"[ERROR] 流式响应生成器错误: {e}")
+    finally:
+        await response.aclose()
+
+    # 输出合并缓冲区中剩余的内容并发送结束标记
+    tail = coalescer.flush()
+    if tail:
+        await send_content(tail)
+    await send({
+        'type': 'http.response.body',
+        'body': encoder.encode_stop(),
+        'more_body': False
+    })
+
+
+async def _collect_response(send, ctx, response):
+    """管线输出阶段（非流式）：收集所有内容并返回完整响应"""
+    try:
+        content = ''.join([content async for content in aiter_chat_content(ctx, response)])
+    finally:
+        await response.aclose()
+
+    await _send_json(send, 200, format_openai_non_streaming_response(
+        f"chatcmpl-{uuid.uuid4()}",
+        ctx.model,
+        content
+    ))
+
+
+async def _handle_chat_completions(scope, receive, send, headers, request_id, client_ip):
+    """/v1/chat/completions 的异步实现，与同步端点共用同一条管线"""
+    # API Key 验证（缓存未命中时的数据库查询放到线程池）
+    user_info, tokens, api_key, error = await asyncio.to_thread(
+        authenticate_api_key, headers.get('authorization'), client_ip
+    )
+    if error:
+        message, status_code = error
+        return await _send_json(send, status_code, format_openai_error_response(
+            "invalid_request_error",
+            message,
+            request_id=request_id
+        ))
+
+    # 解析请求
+    body = await _read_body(receive)
+    if body is None:
+        return
+    try:
+        data = json.loads(body) if body else None
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        data = None
+    if not data or not isinstance(data, dict):
+        return await _send_json(send, 400, format_openai_error_response(
+            "invalid_request_error",
+            "请求体必须是有效的 JSON"
+        ))
+
+    # 读取会话存储（SQLite / Redis）的阻塞调用放到线程池，不占用事件循环
+    try:
+        ctx = await asyncio.to_thread(
+            prepare_chat, data, data.get("model", "wenxiaobai-deep-thought"), user_info, tokens, request_id
+        )
+    except ChatPipelineError as e:
+        return await _send_json(send, e.status_code, e.to_response())
+
+    # 无论正常结束、出错还是客户端断开，都释放调度器分配的 Token
+    try:
+        try:
+            response = await acall_upstream(ctx)
+        except ChatPipelineError as e:
+            return await _send_json(send, e.status_code, e.to_response())
+
+        progress = {'chunks_sent': 0}
+        if ctx.stream:
+            output = _stream_response(send, ctx, response, progress)
+        else:
+            output = _collect_response(send, ctx, response)
+
+        if not await _run_until_disconnect(receive, output):
+            await asyncio.to_thread(record_cancel, ctx, progress['chunks_sent'])
+    finally:
+        ctx.release()
+
+
+async def chat_completions(scope, receive, send):
+    """原生 asyncio 的 /v1/chat/completions 入口"""
+    headers = {
+        key.decode('latin-1').lower(): value.decode('latin-1')
+        for key, value in scope.get('headers', [])
+    }
+
+    # Get client IP (X-Forwarded-For is only trusted from TRUSTED_PROXIES)
+    client_ip = client_address((scope.get('client') or (None,))[0], headers.get('x-forwarded-for'))
+
+    request_id = str(uuid.uuid4())
+    start_time = time.time()
+
+    # 推入 Flask 应用上下文，使共享的会话/日志辅助函数可以读取 g.request_id
+    with app.app_context():
+        g.request_id = request_id
+        g.request_start_time = start_time
+        g.client_ip = client_ip
+
+        request_logger.logger.info(
+            f"[{request_id}] Incoming POST request to /v1/chat/completions (asgi) - "
+            f"IP: {client_ip}, User-Agent: {headers.get('user-agent', 'Unknown')[:50]}..."
+        )
+
+        try:
+            await _handle_chat_completions(scope, receive, send, headers, request_id, client_ip)
+        except Exception as e:
+            api_debug_logger.log_api_error(
+                error_details=f"Internal server error: {str(e)}",
+                request_id=request_id,
+                exception=e
+            )
+            await _send_json(send, 500, format_openai_error_response(
+                "internal_server_error",
+                f"内部服务器错误: {str(e)}",
+                request_id
+            ))
+        finally:
+            request_logger.log_request_timing(start_time, time.time(), request_id)
+
+
+async def _lifespan(receive, send):
+    """处理 ASGI lifespan 事件"""
+    global _log_listener
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # 日志改为队列输出，避免控制台写入阻塞事件循环
+            _log_listener = enable_queue_logging(request_logger.logger, api_debug_logger.logger)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await upstream_transport.aclose()
+            # 写完队列中剩余的使用记录
+            await asyncio.to_thread(usage_writer.close)
+            if _log_listener is not None:
+                _log_listener.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI 应用入口"""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    if (scope['type'] == 'http' and scope['method'] == 'POST'
+            and scope['path'] == '/v1/chat/completions'):
+        return await chat_completions(scope, receive, send)
+
+    return await flask_application(scope, receive, send)
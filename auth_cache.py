@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+API Key 认证缓存
+
+按 API Key 缓存用户信息和按优先顺序排列的活跃 Token 候选列表，有效期内的认证无需查询数据库。
+数据失效分两层：
+- 本进程：修改 API Key / Token / 用户状态的数据库方法递增 cache_versions 中的版本号时通过回调立即清空缓存
+- 其他 worker：每 AUTH_CACHE_VERSION_CHECK_MS 毫秒读取一次版本号，发现变化后整体清空
+余额变化不会递增版本号，Token 的优先顺序最多滞后 AUTH_CACHE_TTL 秒（预估余额跌破 BALANCE_LOW_THRESHOLD 时除外）。
+
+无效 Key 的防护：
+- 有效 Key 摘要集合：版本号变化时重建，不在集合中的 Key 直接判定无效，不访问数据库；
+  其他 worker 新建的 Key 在版本号刷新前不在集合中，此时最多每 AUTH_KEY_FILTER_RECHECK_MS 毫秒重新检查一次版本号
+- 按客户端 IP 的 401 令牌桶：认证失败消耗令牌，令牌耗尽的 IP 的无效 Key 直接返回 429（有效 Key 不受影响）；
+  客户端 IP 取连接的对端地址，只有对端属于 TRUSTED_PROXIES 时才采用 X-Forwarded-For（见 client_address()）
+"""
+import hashlib
+import ipaddress
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from database import db, AUTH_CACHE_VERSION
+
+logger = logging.getLogger(__name__)
+
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 30))                          # 秒，0 表示关闭缓存
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 10000))
+AUTH_CACHE_VERSION_CHECK_MS = int(os.environ.get("AUTH_CACHE_VERSION_CHECK_MS", 1000))  # 0 表示每次认证都检查
+AUTH_KEY_FILTER = os.environ.get("AUTH_KEY_FILTER", "true").lower() == "true"
+AUTH_KEY_FILTER_RECHECK_MS = int(os.environ.get("AUTH_KEY_FILTER_RECHECK_MS", 100))
+AUTH_FAIL_BURST = int(os.environ.get("AUTH_FAIL_BURST", 20))           # 每个 IP 允许连续失败的次数，0 表示不限制
+AUTH_FAIL_RATE = float(os.environ.get("AUTH_FAIL_RATE", 1))            # 每秒恢复的失败次数
+AUTH_FAIL_MAX_CLIENTS = int(os.environ.get("AUTH_FAIL_MAX_CLIENTS", 10000))
+TRUSTED_PROXIES = os.environ.get("TRUSTED_PROXIES", "127.0.0.1,::1")   # 逗号分隔的 IP / CIDR，为空表示不信任 X-Forwarded-For
+
+
+def _parse_networks(spec: str) -> List:
+    networks = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            logger.warning(f"Ignoring invalid TRUSTED_PROXIES entry '{item}'")
+    return networks
+
+
+_TRUSTED_NETWORKS = _parse_networks(TRUSTED_PROXIES)
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in _TRUSTED_NETWORKS)
+
+
+def client_address(peer: Optional[str], forwarded_for: Optional[str] = None) -> str:
+    """
+    解析客户端 IP（用于日志和认证失败限流）
+
+    对端不是可信代理时 X-Forwarded-For 由客户端任意填写，直接使用对端地址；
+    否则从右向左跳过可信代理追加的地址，取第一个不属于可信代理的地址。
+    """
+    if not peer:
+        return 'unknown'
+    if not forwarded_for or not _is_trusted_proxy(peer):
+        return peer
+    hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+def _key_digest(api_key: str) -> bytes:
+    # 只保存摘要，内存中不留存完整的 Key
+    return hashlib.blake2b(api_key.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class AuthCache:
+    """TTL + LRU 的 API Key 认证缓存"""
+
+    def __init__(self, database, ttl: float = AUTH_CACHE_TTL, max_size: int = AUTH_CACHE_SIZE,
+                 version_check_ms: int = AUTH_CACHE_VERSION_CHECK_MS, key_filter: bool = AUTH_KEY_FILTER,
+                 filter_recheck_ms: int = AUTH_KEY_FILTER_RECHECK_MS):
+        self.db = database
+        self.ttl = ttl
+        self.max_size = max_size
+        self.version_check_interval = version_check_ms / 1000
+        self.key_filter = key_filter
+        self.filter_recheck_interval = filter_recheck_ms / 1000
+        self.hits = 0
+        self.misses = 0
+        self.filtered = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()   # api_key -> (expires_at, user_info, tokens)
+        self._version = None
+        self._checked_at = 0.0
+        self._force_check_until = 0.0
+        self._valid_keys = None       # 有效 Key 的摘要集合，None 表示尚未建立
+        self._filter_version = None
+
+        database.add_cache_listener(AUTH_CACHE_VERSION, self.invalidate)
+
+    def lookup(self, api_key: str) -> Optional[Tuple[Dict, List[Dict]]]:
+        """
+        返回 (user_info, tokens)，API Key 无效时返回 None
+
+        tokens 为用户的活跃 Token 列表（优先顺序），可能为空。返回的对象是缓存的共享副本，调用方不要修改。
+        """
+        now = time.monotonic()
+        if self.key_filter and not self._may_be_valid(api_key, now):
+            self.filtered += 1
+            return None
+
+        if self.ttl <= 0:
+            return self._load(api_key)
+
+        version = self._current_version(now)
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(api_key)
+                self.hits += 1
+                return entry[1], entry[2]
+
+        self.misses += 1
+        result = self._load(api_key)
+        if result is not None:
+            with self._lock:
+                # 加载期间版本号发生了变化（数据已被修改），不缓存可能过期的结果
+                if self._version == version:
+                    self._entries[api_key] = (now + self.ttl,) + result
+                    self._entries.move_to_end(api_key)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+        return result
+
+    def invalidate(self):
+        """清空缓存，并在随后一段时间内每次认证都检查版本号（等待修改事务提交）"""
+        with self._lock:
+            self._entries.clear()
+            self._force_check_until = time.monotonic() + max(self.version_check_interval, 1)
+
+    def stats(self) -> Dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'filtered': self.filtered,
+            'valid_keys': len(self._valid_keys) if self._valid_keys is not None else None,
+            'version': self._version
+        }
+
+    def _may_be_valid(self, api_key: str, now: float) -> bool:
+        """Key 是否可能有效；返回 False 时一定无效"""
+        self._current_version(now)
+        if self._valid_keys is None or self._filter_version != self._version:
+            self._rebuild_filter()
+
+        digest = _key_digest(api_key)
+        if digest in self._valid_keys:
+            return True
+
+        # 可能是其他 worker 刚创建/启用的 Key：限频提前检查版本号
+        if now - self._checked_at >= self.filter_recheck_interval:
+            self._current_version(now, force=True)
+            if self._filter_version != self._version:
+                self._rebuild_filter()
+                return digest in self._valid_keys
+        return False
+
+    def _rebuild_filter(self):
+        version = self._version
+        valid_keys = {_key_digest(api_key) for api_key in self.db.get_active_api_keys()}
+        with self._lock:
+            self._valid_keys = valid_keys
+            self._filter_version = version
+
+    def _current_version(self, now: float, force: bool = False) -> Optional[int]:
+        if (not force and now - self._checked_at < self.version_check_interval
+                and now >= self._force_check_until):
+            return self._version
+
+        version = self.db.get_cache_version(AUTH_CACHE_VERSION)
+        with self._lock:
+            self._checked_at = now
+            if version != self._version:
+                if self._version is not None:
+                    logger.info(f"Auth cache invalidated (version {self._version} -> {version})")
+                self._entries.clear()
+                self._version = version
+                self._force_check_until = 0.0
+        return version
+
+    def _load(self, api_key: str) -> Optional[Tuple[Dict, List[Dict]]]:
+        user_info = self.db.get_user_by_api_key(api_key)
+        if not user_info:
+            return None
+        return user_info, self.db.get_active_tokens_for_user(user_info['user_id'])
+
+
+class AuthThrottle:
+    """按客户端 IP 限制认证失败（401）速率的令牌桶，记录数有上限（LRU）"""
+
+    def __init__(self, burst: int = AUTH_FAIL_BURST, rate: float = AUTH_FAIL_RATE,
+                 max_clients: int = AUTH_FAIL_MAX_CLIENTS):
+        self.burst = burst
+        self.rate = rate
+        self.max_clients = max_clients
+        self.throttled = 0
+
+        self._lock = threading.Lock()
+        self._buckets: OrderedDict = OrderedDict()   # client_ip -> [tokens, updated_at]
+
+    def blocked(self, client_ip: Optional[str]) -> bool:
+        """该 IP 的失败次数是否已用完"""
+        if self.burst <= 0 or not client_ip:
+            return False
+        with self._lock:
+            bucket = self._buckets.get(client_ip)
+            if bucket is None:
+                return False
+            if self._refill(bucket, time.monotonic()) >= 1:
+                return False
+            self.throttled += 1
+            return True
+
+    def record_failure(self, client_ip: Optional[str]):
+        """记录一次认证失败"""
+        if self.burst <= 0 or not client_ip:
+            return
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client_ip)
+            if bucket is None:
+                bucket = self._buckets[client_ip] = [float(self.burst), now]
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client_ip)
+                self._refill(bucket, now)
+            bucket[0] = max(bucket[0] - 1, 0.0)
+
+    def _refill(self, bucket, now: float) -> float:
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        return bucket[0]
+
+
+# 全局认证缓存实例
+auth_cache = AuthCache(db)
+auth_throttle = AuthThrottle()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Token 余额查询缓存（stale-while-revalidate）
+
+按 access token 缓存最近一次成功的余额查询结果：
+- 结果在 BALANCE_CACHE_TTL 秒内视为新鲜，直接返回
+- 超过 TTL 但在可接受的陈旧时间内（默认 BALANCE_CACHE_MAX_STALE 秒，调用方可用 max_staleness 收紧）
+  立即返回旧值，同时在后台发起一次刷新
+- 更旧或没有缓存时同步查询；同一个 Token 同时只有一个上游请求（single-flight），其余调用方等待并共享结果
+查询失败的结果不缓存。缓存只在本进程内有效。
+成功的结果带有 fetched_at（实际向上游查询的时间，epoch 秒），缓存命中时返回的是原查询时间，
+调用方据此判断结果是否比数据库中已保存的更新。
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+BALANCE_CACHE_TTL = float(os.environ.get("BALANCE_CACHE_TTL", 60))              # 秒，0 表示不缓存
+BALANCE_CACHE_MAX_STALE = float(os.environ.get("BALANCE_CACHE_MAX_STALE", 600))  # 默认可接受的最大陈旧时间（秒）
+BALANCE_CACHE_SIZE = int(os.environ.get("BALANCE_CACHE_SIZE", 10000))
+
+
+def _token_key(token: str) -> bytes:
+    # 只保存摘要，内存中的键不包含完整的 Token
+    return hashlib.blake2b((token or '').encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class _Flight:
+    """一次进行中的上游查询"""
+
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class BalanceCache:
+    """TTL + LRU 的余额缓存，fetch(token, device_id, timeout) 执行实际的上游查询"""
+
+    def __init__(self, fetch: Callable, ttl: float = BALANCE_CACHE_TTL, max_stale: float = BALANCE_CACHE_MAX_STALE,
+                 max_size: int = BALANCE_CACHE_SIZE, refresh_timeout: float = 10):
+        self.fetch = fetch
+        self.refresh_timeout = refresh_timeout
+        self.ttl = ttl
+        self.max_stale = max(max_stale, ttl)
+        self.max_size = max_size
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fetches = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()   # key -> (fetched_at, result)
+        self._flights: Dict[bytes, _Flight] = {}
+        self._generation = 0                          # invalidate() 时递增，进行中的查询结果不再写入缓存
+
+    def get(self, token: str, device_id: str = None, timeout: float = 10,
+            max_staleness: Optional[float] = None) -> Optional[Dict]:
+        """
+        返回余额查询结果（BalanceChecker.check_balance 的格式）
+
+        Args:
+            max_staleness: 本次调用可接受的最大陈旧秒数，默认 max_stale；0 表示必须重新查询（仍与并发查询共享）
+        """
+        key = _token_key(token)
+        cached = self._lookup(key, token, device_id, max_staleness)
+        if cached is not None:
+            return cached
+        with self._lock:
+            self.misses += 1
+        return self._single_flight(key, token, device_id, timeout)
+
+    def peek(self, token: str, device_id: str = None, max_staleness: Optional[float] = None) -> Optional[Dict]:
+        """只读缓存：有可接受的结果时返回（陈旧时同样触发后台刷新），否则返回 None，不发起同步查询"""
+        return self._lookup(_token_key(token), token, device_id, max_staleness)
+
+    def invalidate(self, token: str):
+        """余额已知发生变化（如完成任务）时丢弃缓存的结果"""
+        with self._lock:
+            self._entries.pop(_token_key(token), None)
+            self._generation += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'fetches': self.fetches,
+                'in_flight': len(self._flights)
+            }
+
+    def _lookup(self, key: bytes, token: str, device_id: Optional[str],
+                max_staleness: Optional[float]) -> Optional[Dict]:
+        limit = self.max_stale if max_staleness is None else max_staleness
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            age = now - entry[0]
+            if age > limit:
+                return None
+            self._entries.move_to_end(key)
+            if age <= self.ttl:
+                self.hits += 1
+                return entry[1]
+            self.stale_hits += 1
+            refreshing = key in self._flights
+
+        if not refreshing:
+            threading.Thread(target=self._single_flight, args=(key, token, device_id, self.refresh_timeout),
+                             name="balance-revalidate", daemon=True).start()
+        return entry[1]
+
+    def _single_flight(self, key: bytes, token: str, device_id: Optional[str], timeout: float) -> Optional[Dict]:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                generation = self._generation
+                self.fetches += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if flight.done.wait(timeout):
+                return flight.result
+            return {'success': False, 'error': '请求超时'}
+
+        try:
+            flight.result = self.fetch(token, device_id, timeout)
+            if flight.result and flight.result.get('success'):
+                flight.result['fetched_at'] = time.time()
+            if self.ttl > 0 and flight.result and flight.result.get('success'):
+                with self._lock:
+                    if self._generation == generation:
+                        self._entries[key] = (time.monotonic(), flight.result)
+                        self._entries.move_to_end(key)
+                        while len(self._entries) > self.max_size:
+                            self._entries.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
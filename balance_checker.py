@@ -6,33 +6,87 @@ import requests
 import json
 import hashlib
 import base64
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from urllib.parse import urlparse
 import pytz
 from typing import Optional, Dict
 import logging
+from http_transport import upstream_transport
+from balance_cache import BalanceCache
 
 logger = logging.getLogger(__name__)
 
+# 批量查询余额：并发请求数、每个上游主机每秒最多发起的请求数（0 表示不限制）、整批的截止时间（秒）
+BALANCE_BATCH_CONCURRENCY = int(os.environ.get("BALANCE_BATCH_CONCURRENCY", 16))
+BALANCE_BATCH_RATE = float(os.environ.get("BALANCE_BATCH_RATE", 20))
+BALANCE_BATCH_DEADLINE = float(os.environ.get("BALANCE_BATCH_DEADLINE", 30))
+
+# 单次余额查询的超时（秒）
+BALANCE_CHECK_TIMEOUT = 10
+
+
+class HostRateLimiter:
+    """按主机均匀间隔发起请求的限速器（进程内所有批量查询共享）"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_slot = {}   # host -> 下一个可用的发起时刻（monotonic）
+
+    def acquire(self, host: str, deadline: float) -> bool:
+        """等待轮到该主机的下一个请求名额；在截止时间之前等不到时返回 False（不占用名额）"""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            if slot >= deadline:
+                return False
+            self._next_slot[host] = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+        return True
+
 class BalanceChecker:
-    def __init__(self):
+    def __init__(self, concurrency: int = BALANCE_BATCH_CONCURRENCY, rate: float = BALANCE_BATCH_RATE,
+                 deadline: float = BALANCE_BATCH_DEADLINE):
         self.base_url = "https://api-bj.wenxiaobai.com"
         self.balance_endpoint = "/rest/api/asset/summary"
+        self.batch_concurrency = concurrency
+        self.batch_deadline = deadline
+        self.rate_limiter = HostRateLimiter(rate)
+        self.cache = BalanceCache(self._fetch_balance, refresh_timeout=BALANCE_CHECK_TIMEOUT)
     
     def _get_rfc1123_date(self):
         """获取RFC1123格式的日期"""
         return datetime.now(pytz.timezone('GMT')).strftime('%a, %d %b %Y %H:%M:%S GMT')
     
-    def check_balance(self, token: str, device_id: str = None) -> Optional[Dict]:
+    def check_balance(self, token: str, device_id: str = None, timeout: float = BALANCE_CHECK_TIMEOUT,
+                      max_staleness: float = None) -> Optional[Dict]:
         """
-        查询文小白账户余额
+        查询文小白账户余额（经过余额缓存，见 balance_cache）
         
         Args:
             token: 用户的access token
             device_id: 设备ID（可选）
+            timeout: 请求超时（秒）
+            max_staleness: 可接受的缓存结果最大陈旧秒数，None 使用缓存的默认值，0 表示必须重新查询
             
         Returns:
             Dict: 包含余额信息的字典，失败时返回None
         """
+        return self.cache.get(token, device_id, timeout=timeout, max_staleness=max_staleness)
+    
+    def invalidate(self, token: str):
+        """丢弃Token的缓存余额（余额已知发生变化时调用）"""
+        self.cache.invalidate(token)
+    
+    def _fetch_balance(self, token: str, device_id: str = None, timeout: float = BALANCE_CHECK_TIMEOUT) -> Optional[Dict]:
+        """向上游查询余额（不经过缓存）"""
         try:
             # 构建请求头
             headers = {
@@ -57,10 +111,10 @@ class BalanceChecker:
                 headers['x-yuanshi-deviceid'] = device_id
             
             # 发送请求
-            response = requests.get(
+            response = upstream_transport.get(
                 f"{self.base_url}{self.balance_endpoint}",
                 headers=headers,
-                timeout=10,
+                timeout=timeout,
                 verify=False  # 禁用SSL验证
             )
             
@@ -144,46 +198,92 @@ class BalanceChecker:
                 'error': f'未知错误: {str(e)}'
             }
     
-    def batch_check_balances(self, tokens_info: list) -> Dict:
+    def batch_check_balances(self, tokens_info: list, concurrency: int = None, deadline: float = None,
+                             max_staleness: float = None) -> Dict:
         """
-        批量查询余额
+        并发批量查询余额
+        
+        最多 concurrency 个请求同时进行，并按上游主机限速；整批超过 deadline 秒后立即返回已完成的结果，
+        尚未完成的 Token 标记为 timed_out（仍在进行的请求在后台结束，结果被丢弃）。
         
         Args:
             tokens_info: 包含token信息的列表，每个元素包含 {'id', 'token', 'device_id'}
+            concurrency: 并发请求数，默认 BALANCE_BATCH_CONCURRENCY
+            deadline: 整批的截止时间（秒），默认 BALANCE_BATCH_DEADLINE
+            max_staleness: 可接受的缓存结果最大陈旧秒数（命中缓存的 Token 不占用并发和限速名额）
             
         Returns:
-            Dict: 批量查询结果
+            Dict: 批量查询结果，results 与 tokens_info 顺序一致
         """
+        concurrency = max(concurrency or self.batch_concurrency, 1)
+        deadline_at = time.monotonic() + (deadline or self.batch_deadline)
+        host = urlparse(self.base_url).netloc
+        
+        def check(token_info):
+            cached = self.cache.peek(token_info.get('token'), token_info.get('device_id'), max_staleness)
+            if cached is not None:
+                return cached
+            if not self.rate_limiter.acquire(host, deadline_at):
+                return None
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                return None
+            logger.info(f"Checking balance for token ID: {token_info.get('id')}")
+            return self.check_balance(token_info.get('token'), token_info.get('device_id'),
+                                      timeout=min(BALANCE_CHECK_TIMEOUT, remaining), max_staleness=max_staleness)
+        
+        executor = ThreadPoolExecutor(max_workers=min(concurrency, max(len(tokens_info), 1)),
+                                      thread_name_prefix="balance-batch")
+        futures = {executor.submit(check, token_info): i for i, token_info in enumerate(tokens_info)}
+        balance_results = [None] * len(tokens_info)
+        finished = [False] * len(tokens_info)
+        
+        pending = set(futures)
+        while pending:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                try:
+                    balance_results[i] = future.result()
+                    finished[i] = balance_results[i] is not None
+                except Exception as e:
+                    balance_results[i] = {'success': False, 'error': f'未知错误: {str(e)}'}
+                    finished[i] = True
+        executor.shutdown(wait=False, cancel_futures=True)
+        
         results = {
             'success_count': 0,
             'failed_count': 0,
+            'timed_out_count': 0,
             'results': []
         }
         
-        for token_info in tokens_info:
-            token_id = token_info.get('id')
-            token = token_info.get('token')
-            device_id = token_info.get('device_id')
-            
-            logger.info(f"Checking balance for token ID: {token_id}")
-            
-            balance_result = self.check_balance(token, device_id)
-            
+        for i, token_info in enumerate(tokens_info):
+            balance_result = balance_results[i]
             result_item = {
-                'token_id': token_id,
+                'token_id': token_info.get('id'),
                 'balance_result': balance_result
             }
             
-            if balance_result and balance_result.get('success'):
+            if not finished[i]:
+                results['timed_out_count'] += 1
+                result_item['timed_out'] = True
+                result_item['error'] = '查询超时'
+            elif balance_result.get('success'):
                 results['success_count'] += 1
                 result_item['balance'] = balance_result.get('suanli_balance', 0)
+                result_item['fetched_at'] = balance_result.get('fetched_at')
             else:
                 results['failed_count'] += 1
-                result_item['error'] = balance_result.get('error', '未知错误') if balance_result else '查询失败'
+                result_item['error'] = balance_result.get('error', '未知错误')
             
             results['results'].append(result_item)
         
-        logger.info(f"Batch balance check completed: {results['success_count']} success, {results['failed_count']} failed")
+        logger.info(f"Batch balance check completed: {results['success_count']} success, "
+                    f"{results['failed_count']} failed, {results['timed_out_count']} timed out")
         return results
 
 # 全局余额查询实例
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Token 余额的后台刷新
+
+请求路径（每 50 次调用）只调用 balance_refresher.request(token_id) 把 Token 放入刷新队列，立即返回；
+后台线程查询余额并写回数据库，余额低于阈值且启用了自动任务时接着执行任务，聊天响应不再等待余额查询和任务系统。
+
+- 同一个 Token 已在队列中或正在刷新时，新的请求直接合并（coalesced 计数）
+- 队列满时丢弃请求（dropped 计数），下一次触发会重新入队
+"""
+import logging
+import os
+import queue
+import threading
+from typing import Dict, Optional
+
+from database import db, BALANCE_LOW_THRESHOLD
+from balance_checker import balance_checker
+from balance_cache import BALANCE_CACHE_TTL
+from task_system import task_system
+
+logger = logging.getLogger(__name__)
+
+BALANCE_REFRESH_WORKERS = int(os.environ.get("BALANCE_REFRESH_WORKERS", 2))
+BALANCE_REFRESH_QUEUE_SIZE = int(os.environ.get("BALANCE_REFRESH_QUEUE_SIZE", 1000))
+
+# 余额低于该值且启用了自动任务时执行任务（预估余额跌破同一阈值时巡检会提前查询真实余额）
+AUTO_TASK_BALANCE_THRESHOLD = BALANCE_LOW_THRESHOLD
+
+
+class BalanceRefresher:
+    """按 Token 去重的后台余额刷新队列"""
+
+    def __init__(self, database, checker, workers: int = BALANCE_REFRESH_WORKERS,
+                 queue_size: int = BALANCE_REFRESH_QUEUE_SIZE):
+        self.db = database
+        self.checker = checker
+        self.workers = max(workers, 1)
+        self.queue_size = queue_size
+        self.requested = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.refreshed = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        self._pending = set()     # 在队列中或正在刷新的 Token ID
+        self._queue = None
+        self._pid = None
+
+    def request(self, token_id: int) -> bool:
+        """
+        请求在后台刷新 Token 余额
+
+        Returns:
+            是否新入队；已有相同 Token 的刷新在排队或进行中（合并）、或队列已满时返回 False
+        """
+        self._ensure_started()
+        with self._lock:
+            self.requested += 1
+            if token_id in self._pending:
+                self.coalesced += 1
+                return False
+            self._pending.add(token_id)
+
+        try:
+            self._queue.put_nowait(token_id)
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(token_id)
+                self.dropped += 1
+            logger.warning(f"Balance refresh queue full, dropped refresh for token {token_id}")
+            return False
+        return True
+
+    def refresh(self, token_id: int) -> Optional[float]:
+        """
+        查询并保存 Token 余额，余额不足且启用了自动任务时执行任务（在调用线程中同步执行）
+
+        Returns:
+            新的余额；Token 不存在、已禁用或查询失败时返回 None
+        """
+        token_info = self.db.get_token_by_id(token_id)
+        if not token_info or not token_info['is_active']:
+            return None
+
+        # 只接受新鲜的缓存结果：刚刚被其他调用方查询过的 Token 不再重复请求上游
+        balance_result = self.checker.check_balance(token_info['full_token'], token_info['device_id'],
+                                                    max_staleness=BALANCE_CACHE_TTL)
+        if not balance_result or not balance_result.get('success'):
+            with self._lock:
+                self.failed += 1
+            logger.warning(f"Balance refresh failed for token {token_id}: "
+                           f"{balance_result.get('error') if balance_result else 'no result'}")
+            return None
+
+        balance = balance_result.get('suanli_balance', 0)
+        self.db.update_token_balance(token_id, balance, balance_result.get('fetched_at'))
+        with self._lock:
+            self.refreshed += 1
+
+        if token_info['auto_task_enabled'] and balance < AUTO_TASK_BALANCE_THRESHOLD:
+            logger.info(f"Triggering auto tasks for token {token_id} due to low balance: {balance}")
+            task_result = task_system.auto_complete_tasks_for_token(token_info)
+            # 任务奖励改变了余额，缓存的查询结果不再准确
+            self.checker.invalidate(token_info['full_token'])
+            if task_result.get('success'):
+                logger.info(f"Auto tasks completed for token {token_id}: {task_result.get('task_count')} tasks, "
+                            f"{task_result.get('total_rewards')} rewards")
+        return balance
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'requested': self.requested,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'refreshed': self.refreshed,
+                'failed': self.failed,
+                'pending': len(self._pending)
+            }
+
+    def _ensure_started(self):
+        # fork 出的子进程没有父进程的后台线程，需要重新创建队列和线程
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._pending = set()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"balance-refresher-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            token_id = self._queue.get()
+            try:
+                self.refresh(token_id)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"Balance refresh for token {token_id} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(token_id)
+
+
+# 全局余额刷新实例
+balance_refresher = BalanceRefresher(db, balance_checker)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+所有启用 Token 余额的后台巡检
+
+每个 Token 在 balance_schedule 表中有下一次检查时间，后台线程定期领取到期的 Token，
+通过 balance_refresher.refresh() 查询余额、写回数据库（余额不足时执行自动任务），再安排下一次检查：
+- 检查间隔与最近的调用量成反比：最近 24 小时每产生 BALANCE_SWEEP_CALLS_PER_CHECK 次调用检查一次，
+  限制在 [BALANCE_SWEEP_MIN_INTERVAL, BALANCE_SWEEP_MAX_INTERVAL] 秒之间；没有调用的 Token 按最大间隔检查
+- 每次的间隔乘以 1 ± BALANCE_SWEEP_JITTER 的随机系数，新 Token 的首次检查也随机分散，避免检查集中在同一时刻
+- 写入使用记录时预估余额跌破 BALANCE_LOW_THRESHOLD 的 Token 会被提前到立即检查（余额不足时接着执行自动任务）
+- BALANCE_SWEEP_CONCURRENCY 是所有 worker 合计的并发检查数，由数据库中的领取租约保证
+- 调度保存在数据库中，重启后按原计划继续；进程退出时未完成的检查在租约（BALANCE_SWEEP_LEASE 秒）到期后重新领取
+
+启用巡检后请求路径不再每 50 次调用触发余额刷新，路由使用的余额由巡检保持新鲜。
+"""
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict
+
+from database import db
+from balance_refresher import balance_refresher
+
+logger = logging.getLogger(__name__)
+
+BALANCE_SWEEP_ENABLED = os.environ.get("BALANCE_SWEEP_ENABLED", "true").lower() == "true"
+BALANCE_SWEEP_CONCURRENCY = int(os.environ.get("BALANCE_SWEEP_CONCURRENCY", 4))
+BALANCE_SWEEP_MIN_INTERVAL = float(os.environ.get("BALANCE_SWEEP_MIN_INTERVAL", 60))
+BALANCE_SWEEP_MAX_INTERVAL = float(os.environ.get("BALANCE_SWEEP_MAX_INTERVAL", 21600))
+BALANCE_SWEEP_CALLS_PER_CHECK = float(os.environ.get("BALANCE_SWEEP_CALLS_PER_CHECK", 25))
+BALANCE_SWEEP_JITTER = float(os.environ.get("BALANCE_SWEEP_JITTER", 0.2))
+BALANCE_SWEEP_LEASE = float(os.environ.get("BALANCE_SWEEP_LEASE", 120))
+
+# 领取到期检查的轮询间隔（秒）与同步调度表（新增 / 删除 Token）的间隔（秒）
+POLL_INTERVAL = 5
+SYNC_INTERVAL = 60
+
+
+class BalanceSweeper:
+    """按调用量安排检查频率的余额巡检"""
+
+    def __init__(self, database, refresher, enabled: bool = BALANCE_SWEEP_ENABLED,
+                 concurrency: int = BALANCE_SWEEP_CONCURRENCY, min_interval: float = BALANCE_SWEEP_MIN_INTERVAL,
+                 max_interval: float = BALANCE_SWEEP_MAX_INTERVAL,
+                 calls_per_check: float = BALANCE_SWEEP_CALLS_PER_CHECK, jitter: float = BALANCE_SWEEP_JITTER,
+                 lease: float = BALANCE_SWEEP_LEASE):
+        self.db = database
+        self.refresher = refresher
+        self.enabled = enabled
+        self.concurrency = max(concurrency, 1)
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.calls_per_check = calls_per_check
+        self.jitter = min(max(jitter, 0.0), 0.9)
+        self.lease = lease
+        self.checked = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._executor = None
+        self._pid = None
+
+    def start(self):
+        """启动后台巡检线程（每个进程一个，并发总数由数据库租约在所有进程间共享）"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._inflight = 0
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="balance-sweep")
+            threading.Thread(target=self._run, name="balance-sweeper", daemon=True).start()
+
+    def run_once(self, now: float = None) -> int:
+        """领取到期的检查并提交给本进程的检查线程，返回领取数"""
+        now = time.time() if now is None else now
+        with self._lock:
+            free = self.concurrency - self._inflight
+        if free <= 0:
+            return 0
+
+        token_ids = self.db.claim_balance_checks(now, self.concurrency, self.lease, free)
+        with self._lock:
+            self._inflight += len(token_ids)
+        for token_id in token_ids:
+            self._executor.submit(self._check, token_id)
+        return len(token_ids)
+
+    def sync(self) -> int:
+        """把新的 Token 加入调度（首次检查分散在一个最小间隔内），返回新增数"""
+        added, removed = self.db.sync_balance_schedule(time.time(), self.min_interval)
+        if added or removed:
+            logger.info(f"Balance schedule synced: {added} added, {removed} removed")
+        return added
+
+    def next_interval(self, token_id: int, now: float = None) -> float:
+        """根据最近 24 小时的调用量计算下一次检查的间隔（不含抖动）"""
+        current = datetime.fromtimestamp(time.time() if now is None else now)
+        today = current.date()
+        yesterday = today - timedelta(days=1)
+        calls = self.db.get_recent_api_calls(token_id, [today.isoformat(), yesterday.isoformat()])
+
+        # 今天的全部调用加上昨天的调用按 24 小时窗口中仍覆盖的比例折算
+        elapsed = (current - datetime.combine(today, datetime.min.time())).total_seconds()
+        recent = calls.get(today.isoformat(), 0) + calls.get(yesterday.isoformat(), 0) * (1 - elapsed / 86400)
+        if recent <= 0:
+            return self.max_interval
+        interval = self.calls_per_check / recent * 86400
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            result = {
+                'enabled': self.enabled,
+                'concurrency': self.concurrency,
+                'checked': self.checked,
+                'failed': self.failed,
+                'inflight': self._inflight
+            }
+        if self.enabled:
+            result['schedule'] = self.db.get_balance_schedule_summary(time.time())
+        return result
+
+    def _check(self, token_id: int):
+        try:
+            balance = self.refresher.refresh(token_id)
+            with self._lock:
+                if balance is None:
+                    self.failed += 1
+                else:
+                    self.checked += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.error(f"Balance sweep for token {token_id} failed: {e}")
+
+        # 查询失败同样按正常间隔重排，失效的 Token 不会被反复请求
+        try:
+            now = time.time()
+            interval = self.next_interval(token_id, now)
+            delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self.db.reschedule_balance_check(token_id, now + delay, interval, now)
+        except Exception as e:
+            logger.error(f"Failed to reschedule balance check for token {token_id}: {e}")
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def _run(self):
+        last_sync = 0.0
+        while True:
+            try:
+                if time.monotonic() - last_sync >= SYNC_INTERVAL:
+                    self.sync()
+                    last_sync = time.monotonic()
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Balance sweep failed: {e}")
+            # 各 worker 的轮询相互错开
+            time.sleep(POLL_INTERVAL * random.uniform(0.5, 1.5))
+
+
+# 全局余额巡检实例
+balance_sweeper = BalanceSweeper(db, balance_refresher)
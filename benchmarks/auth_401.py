@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+无效 API Key 的拒绝吞吐基准
+
+模拟扫描器用随机 Key 反复请求：对比直接查询数据库（原来的 get_user_by_api_key）、
+认证缓存 + 有效 Key 摘要集合，以及同一 IP 触发 401 令牌桶之后的拒绝速度，并统计执行的 SQL 语句数。
+
+用法：
+    python benchmarks/auth_401.py --keys 1000 --requests 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import DatabaseManager  # noqa: E402
+from auth_cache import AuthCache, AuthThrottle  # noqa: E402
+
+
+def make_invalid_keys(count):
+    return [f"wxb-{uuid.uuid4().hex}{uuid.uuid4().hex[:11]}" for _ in range(count)]
+
+
+def bench(reject, keys):
+    started = time.perf_counter()
+    for api_key in keys:
+        reject(api_key)
+    return len(keys) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Invalid API key rejection benchmark")
+    parser.add_argument("--keys", type=int, default=1000, help="数据库中有效 Key 的数量")
+    parser.add_argument("--requests", type=int, default=100000, help="无效 Key 请求数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = DatabaseManager(os.path.join(data_dir, "bench.db"))
+        user_id = manager.create_user("bench", "password")
+        valid_key = None
+        for i in range(args.keys):
+            valid_key = manager.create_api_key(user_id, f"key-{i}")
+        manager.create_token(user_id, "bench", f"token-{uuid.uuid4()}")
+
+        invalid_keys = make_invalid_keys(args.requests)
+        statements = [0]
+        manager._connect().set_trace_callback(lambda sql: statements.__setitem__(0, statements[0] + 1))
+
+        def run(label, reject):
+            statements[0] = 0
+            rate = bench(reject, invalid_keys)
+            return label, rate, statements[0] / len(invalid_keys)
+
+        cache = AuthCache(manager)
+        assert cache.lookup(valid_key) is not None
+
+        throttle = AuthThrottle(burst=20, rate=1)
+
+        def throttled(api_key):
+            if throttle.blocked("203.0.113.7"):
+                return None
+            if cache.lookup(api_key) is None:
+                throttle.record_failure("203.0.113.7")
+
+        results = [
+            run("database lookup", manager.get_user_by_api_key),
+            run("auth cache + key filter", cache.lookup),
+            run("per-IP 401 throttle", throttled),
+        ]
+
+    print(f"valid keys: {args.keys}, invalid requests: {args.requests}")
+    print(f"{'path':<28}{'401 / s':>14}{'SQL / request':>16}")
+    for label, rate, per_request in results:
+        print(f"{label:<28}{rate:>14,.0f}{per_request:>16.4f}")
+    print(f"speedup (key filter): {results[1][1] / results[0][1]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+鉴权 + 用量记录路径的数据库吞吐基准
+
+模拟一次聊天请求的数据库访问：get_user_by_api_key、get_active_token_for_user、log_usage、increment_api_calls，
+对比每次调用新建连接（回滚日志模式，即原来的实现）、DatabaseManager 的每线程持久连接（WAL + 调优 PRAGMA），
+以及在持久连接之上由 UsageWriter 后台批量写入使用记录和调用次数（计时包含最后一批的写入）。
+
+用法：
+    python benchmarks/db_auth_path.py --requests 2000 --threads 4
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import DatabaseManager  # noqa: E402
+from usage_writer import UsageWriter  # noqa: E402
+
+
+class PerCallDatabaseManager(DatabaseManager):
+    """原来的连接方式：每个方法调用都新建连接，数据库保持默认的回滚日志模式"""
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path)
+
+
+def setup(manager):
+    user_id = manager.create_user(f"bench-{uuid.uuid4().hex[:8]}", "password")
+    api_key = manager.create_api_key(user_id, "bench")
+    manager.create_token(user_id, "bench", f"token-{uuid.uuid4()}", device_id="bench-device")
+    return api_key
+
+
+def handle_request(manager, writer, api_key):
+    user_info = manager.get_user_by_api_key(api_key)
+    token_info = manager.get_active_token_for_user(user_info['user_id'])
+    writer.log_usage(
+        user_info['user_id'], user_info['api_key_id'], token_info['id'],
+        "wenxiaobai-deep-thought", request_id=str(uuid.uuid4())
+    )
+    writer.increment_api_calls(token_info['id'])
+
+
+def run(manager, writer, api_key, requests, threads):
+    per_thread = requests // threads
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(per_thread):
+                handle_request(manager, writer, api_key)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if writer is not manager:
+        writer.close()
+    elapsed = time.perf_counter() - started
+    if errors:
+        print(f"  {len(errors)} worker(s) failed: {errors[0]}")
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Auth + usage logging database benchmark")
+    parser.add_argument("--requests", type=int, default=2000, help="模拟的请求数")
+    parser.add_argument("--threads", type=int, default=4, help="并发线程数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        results = []
+        for label, cls, write_behind in (("per-call connect", PerCallDatabaseManager, False),
+                                         ("per-thread pool (WAL)", DatabaseManager, False),
+                                         ("pool + write-behind", DatabaseManager, True)):
+            manager = cls(os.path.join(data_dir, f"{label.split()[0]}.db"))
+            writer = UsageWriter(manager) if write_behind else manager
+            api_key = setup(manager)
+            handle_request(manager, writer, api_key)  # 预热
+            journal_mode = manager._connect().execute('PRAGMA journal_mode').fetchone()[0]
+            results.append((label, journal_mode, run(manager, writer, api_key, args.requests, args.threads)))
+
+    print(f"requests: {args.requests}, threads: {args.threads}")
+    print(f"{'implementation':<26}{'journal':>10}{'req / s':>12}")
+    for label, journal_mode, rate in results:
+        print(f"{label:<26}{journal_mode:>10}{rate:>12,.0f}")
+    for label, _, rate in results[1:]:
+        print(f"speedup ({label}): {rate / results[0][2]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+会话表内存与吞吐基准
+
+对比原来的 {session_id: {"conversation_id": str, "turn_index": int}} 字典
+与 session_table.SessionTable（并行数组 + CLOCK/TTL）在 N 个会话下的内存占用和读写速度。
+
+用法：
+    python benchmarks/session_table_memory.py --sessions 1000000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from session_table import SessionTable  # noqa: E402
+
+
+def make_keys(count):
+    # 与真实数据相近：session_id 与 conversation_id 都是 UUID 长度的字符串
+    session_ids = [f"session-{i:028d}" for i in range(count)]
+    conversation_ids = [f"conv-{i:031d}" for i in range(count)]
+    return session_ids, conversation_ids
+
+
+def build_dict(session_ids, conversation_ids):
+    sessions = {}
+    for session_id, conversation_id in zip(session_ids, conversation_ids):
+        sessions[session_id] = {"conversation_id": conversation_id, "turn_index": 3}
+    return sessions
+
+
+def build_table(session_ids, conversation_ids):
+    table = SessionTable(len(session_ids), ttl=3600, sliding=True)
+    for session_id, conversation_id in zip(session_ids, conversation_ids):
+        table.put(session_id, conversation_id, 3, 1)
+    return table
+
+
+def measure(builder, session_ids, conversation_ids):
+    """只统计容器本身的开销（键和 conversation_id 字符串两种实现共享，不计入）"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    container = builder(session_ids, conversation_ids)
+    build_seconds = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return container, current, build_seconds
+
+
+def bench_reads(lookup, session_ids, rounds=3):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for session_id in session_ids:
+            lookup(session_id)
+    return len(session_ids) * rounds / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session table memory benchmark")
+    parser.add_argument("--sessions", type=int, default=1000000, help="会话数量")
+    args = parser.parse_args()
+
+    count = args.sessions
+    session_ids, conversation_ids = make_keys(count)
+    per_million = 1000000 / count / (1024 * 1024)
+
+    sessions, dict_bytes, dict_build = measure(build_dict, session_ids, conversation_ids)
+    dict_reads = bench_reads(sessions.get, session_ids)
+    del sessions
+
+    table, table_bytes, table_build = measure(build_table, session_ids, conversation_ids)
+    table_reads = bench_reads(table.get, session_ids)
+
+    # 容量上限生效：只保留一半会话
+    bounded = SessionTable(count // 2, ttl=3600, sliding=True)
+    for session_id, conversation_id in zip(session_ids, conversation_ids):
+        bounded.put(session_id, conversation_id, 3, 1)
+
+    print(f"sessions: {count}")
+    print(f"{'implementation':<24}{'MiB / 1M sessions':>20}{'build (s)':>12}{'reads / s':>14}")
+    print(f"{'dict of dicts':<24}{dict_bytes * per_million:>20.1f}{dict_build:>12.2f}{dict_reads:>14,.0f}")
+    print(f"{'SessionTable (arrays)':<24}{table_bytes * per_million:>20.1f}{table_build:>12.2f}{table_reads:>14,.0f}")
+    print(f"bounded table (max_size={count // 2}): {len(bounded)} entries, {bounded.evictions} evicted")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+使用统计查询延迟基准
+
+在 usage_logs 中生成 N 条分布在最近 --days 天内的记录（同时回填 usage_hourly / usage_daily 预聚合），
+对比直接聚合原始记录（原来的 get_user_usage_stats）与基于预聚合的 get_user_usage_stats 的查询延迟。
+前者随记录数线性增长，后者只与窗口内的小时 / 天数有关。
+
+用法：
+    python benchmarks/usage_stats.py --rows 1000000 --window 30
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import DatabaseManager  # noqa: E402
+from db_migrations import _usage_rollups  # noqa: E402
+
+
+def raw_usage_stats(manager, user_id, days):
+    """原来的实现：在窗口内聚合 usage_logs"""
+    row = manager._connect().execute('''
+        SELECT COUNT(*), SUM(tokens_used), SUM(cost), COUNT(DISTINCT DATE(created_at))
+        FROM usage_logs
+        WHERE user_id = ? AND created_at >= datetime('now', ?)
+    ''', (user_id, f'-{days} days')).fetchone()
+    return {
+        'total_requests': row[0] or 0,
+        'total_tokens': row[1] or 0,
+        'total_cost': float(row[2]) if row[2] else 0,
+        'active_days': row[3] or 0
+    }
+
+
+def populate(manager, rows, days, users):
+    now = datetime.now(timezone.utc)
+    conn = manager._connect()
+    batch = []
+    for i in range(rows):
+        created_at = now - timedelta(seconds=random.randint(0, days * 86400))
+        batch.append((
+            random.randint(1, users), random.randint(1, 3), random.randint(1, 5),
+            random.choice(("wenxiaobai-deep-thought", "wenxiaobai-base")),
+            random.randint(0, 2000), random.random() / 100, f"req-{i}",
+            created_at.strftime('%Y-%m-%d %H:%M:%S')
+        ))
+        if len(batch) >= 100000:
+            conn.executemany('''
+                INSERT INTO usage_logs (user_id, api_key_id, token_id, model, tokens_used, cost, request_id, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+            batch = []
+    conn.executemany('''
+        INSERT INTO usage_logs (user_id, api_key_id, token_id, model, tokens_used, cost, request_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', batch)
+    _usage_rollups(conn)
+    conn.commit()
+
+
+def bench(query, user_id, days, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = query(user_id, days)
+    return (time.perf_counter() - started) / rounds * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Usage stats query latency benchmark")
+    parser.add_argument("--rows", type=int, default=1000000, help="usage_logs 记录数")
+    parser.add_argument("--users", type=int, default=10, help="用户数")
+    parser.add_argument("--days", type=int, default=90, help="记录分布的天数")
+    parser.add_argument("--window", type=int, default=30, help="统计窗口（天）")
+    parser.add_argument("--rounds", type=int, default=20, help="每种实现的查询次数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = DatabaseManager(os.path.join(data_dir, "bench.db"))
+        started = time.perf_counter()
+        populate(manager, args.rows, args.days, args.users)
+        print(f"rows: {args.rows}, users: {args.users}, window: {args.window} days "
+              f"(populated in {time.perf_counter() - started:.1f}s)")
+
+        raw_ms, raw = bench(lambda u, d: raw_usage_stats(manager, u, d), 1, args.window, args.rounds)
+        rollup_ms, rollup = bench(manager.get_user_usage_stats, 1, args.window, args.rounds)
+
+    print(f"{'implementation':<22}{'ms / query':>12}{'requests':>12}{'active days':>14}")
+    print(f"{'usage_logs scan':<22}{raw_ms:>12.2f}{raw['total_requests']:>12}{raw['active_days']:>14}")
+    print(f"{'rollups':<22}{rollup_ms:>12.2f}{rollup['total_requests']:>12}{rollup['active_days']:>14}")
+    print(f"speedup: {raw_ms / rollup_ms:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
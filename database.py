@@ -6,18 +6,110 @@ import sqlite3
 import hashlib
 import secrets
 import json
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Optional, Tuple
 import os
 
+from db_migrations import migrate
+
+# SQLite 连接参数（每个线程一个持久连接）
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 10))           # 等待写锁的秒数
+SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", 16384))                  # 每个连接的页缓存大小
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 64 * 1024 * 1024))     # 内存映射读取的字节数，0 表示关闭
+SQLITE_CACHED_STATEMENTS = int(os.environ.get("SQLITE_CACHED_STATEMENTS", 256))  # 每个连接缓存的预编译语句数
+
+# API Key 认证缓存的版本号名称（cache_versions 表）
+AUTH_CACHE_VERSION = 'auth'
+
+# 预估余额：尚未学习到消耗的模型每次请求的默认消耗、学习消耗时新样本的权重（指数滑动平均）
+BALANCE_ESTIMATE_DEFAULT_COST = float(os.environ.get("BALANCE_ESTIMATE_DEFAULT_COST", 0))
+BALANCE_ESTIMATE_ALPHA = float(os.environ.get("BALANCE_ESTIMATE_ALPHA", 0.3))
+# 余额不足的阈值：低于该值执行自动任务；预估余额跌破该值时提前安排一次真实查询
+BALANCE_LOW_THRESHOLD = float(os.environ.get("BALANCE_LOW_THRESHOLD", 10))
+
+def _utc_timestamp(epoch: float) -> str:
+    """epoch 秒转换为与 CURRENT_TIMESTAMP 相同格式的 UTC 时间字符串"""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
 class DatabaseManager:
     def __init__(self, db_path: str = "wenxiaobai_users.db"):
         self.db_path = db_path
+        self._local = threading.local()
+        self._cache_listeners = {}
         self.init_database()
     
+    def _connect(self) -> sqlite3.Connection:
+        """
+        获取当前线程的持久连接，首次使用时创建
+
+        连接在线程内复用，预编译语句缓存随之生效；用作上下文管理器时只提交/回滚事务，不会关闭连接。
+        fork 出的子进程不能沿用父进程的连接，检测到 pid 变化时重新打开。
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None and local.pid == os.getpid():
+            return conn
+        
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            cached_statements=SQLITE_CACHED_STATEMENTS
+        )
+        # WAL：读写互不阻塞；NORMAL 同步级别在 WAL 下只在检查点时 fsync
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_KB}')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        
+        local.conn = conn
+        local.pid = os.getpid()
+        return conn
+    
+    def close(self):
+        """关闭当前线程的持久连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            if self._local.pid == os.getpid():
+                conn.close()
+            self._local.conn = None
+    
+    def add_cache_listener(self, name: str, callback):
+        """注册本进程的缓存失效回调，版本号递增的事务提交后调用"""
+        self._cache_listeners.setdefault(name, []).append(callback)
+    
+    def _bump_cache_version(self, cursor, name: str):
+        """
+        在当前事务中递增缓存版本号，各 worker 的内存缓存发现版本变化后整体失效
+        
+        会覆盖 cursor.rowcount，调用方需先保存自己语句的影响行数；
+        事务提交后再调用 _notify_cache_listeners() 让本进程的缓存立即失效。
+        """
+        cursor.execute('''
+            UPDATE cache_versions SET version = version + 1 WHERE name = ?
+        ''', (name,))
+    
+    def _notify_cache_listeners(self, name: str):
+        """调用本进程注册的缓存失效回调（在递增版本号的事务提交之后）"""
+        for callback in self._cache_listeners.get(name, ()):
+            callback()
+    
+    def get_cache_version(self, name: str) -> int:
+        """读取缓存版本号"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT version FROM cache_versions WHERE name = ?
+            ''', (name,))
+            
+            row = cursor.fetchone()
+            return row[0] if row else 0
+    
     def init_database(self):
         """初始化数据库表"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             # 用户表
@@ -121,6 +213,9 @@ class DatabaseManager:
             
             conn.commit()
             
+        # 后续版本的列和索引通过迁移添加
+        migrate(self._connect())
+        
         # 创建默认管理员账户
         self.create_default_admin()
     
@@ -146,7 +241,7 @@ class DatabaseManager:
         """创建用户"""
         password_hash = self.hash_password(password)
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO users (username, password_hash, email, is_admin)
@@ -158,7 +253,7 @@ class DatabaseManager:
         """用户认证"""
         password_hash = self.hash_password(password)
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, username, email, is_admin, is_active
@@ -179,7 +274,7 @@ class DatabaseManager:
     
     def get_user_by_id(self, user_id: int) -> Optional[Dict]:
         """根据ID获取用户"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, username, email, is_admin, is_active, created_at
@@ -200,7 +295,7 @@ class DatabaseManager:
     
     def get_all_users(self) -> List[Dict]:
         """获取所有用户（管理员功能）"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, username, email, is_admin, is_active, created_at
@@ -221,21 +316,23 @@ class DatabaseManager:
         """创建API Key"""
         api_key = self.generate_api_key()
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO api_keys (user_id, api_key, name)
                 VALUES (?, ?, ?)
             ''', (user_id, api_key, name))
+            self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        self._notify_cache_listeners(AUTH_CACHE_VERSION)
         
         return api_key
     
     def get_user_api_keys(self, user_id: int) -> List[Dict]:
         """获取用户的API Keys"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT id, api_key, name, is_active, created_at
+                SELECT id, api_key, name, is_active, created_at, stream_coalesce_ms, stream_coalesce_bytes
                 FROM api_keys WHERE user_id = ? ORDER BY created_at DESC
             ''', (user_id,))
             
@@ -244,15 +341,18 @@ class DatabaseManager:
                 'api_key': row[1],
                 'name': row[2],
                 'is_active': row[3],
-                'created_at': row[4]
+                'created_at': row[4],
+                'stream_coalesce_ms': row[5],
+                'stream_coalesce_bytes': row[6]
             } for row in cursor.fetchall()]
     
     def get_user_by_api_key(self, api_key: str) -> Optional[Dict]:
         """根据API Key获取用户信息"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT u.id, u.username, u.is_admin, ak.id as api_key_id
+                SELECT u.id, u.username, u.is_admin, ak.id as api_key_id,
+                       ak.stream_coalesce_ms, ak.stream_coalesce_bytes
                 FROM users u
                 JOIN api_keys ak ON u.id = ak.user_id
                 WHERE ak.api_key = ? AND ak.is_active = 1 AND u.is_active = 1
@@ -264,44 +364,89 @@ class DatabaseManager:
                     'user_id': row[0],
                     'username': row[1],
                     'is_admin': row[2],
-                    'api_key_id': row[3]
+                    'api_key_id': row[3],
+                    'stream_coalesce_ms': row[4],
+                    'stream_coalesce_bytes': row[5]
                 }
         return None
     
+    def get_active_api_keys(self) -> List[str]:
+        """获取所有可用的API Key（Key 和所属用户均为启用状态）"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT ak.api_key
+                FROM api_keys ak
+                JOIN users u ON u.id = ak.user_id
+                WHERE ak.is_active = 1 AND u.is_active = 1
+            ''')
+            
+            return [row[0] for row in cursor.fetchall()]
+    
     def toggle_api_key(self, api_key_id: int, user_id: int) -> bool:
         """切换API Key状态"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE api_keys 
                 SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP
                 WHERE id = ? AND user_id = ?
             ''', (api_key_id, user_id))
-            return cursor.rowcount > 0
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
+    
+    def update_api_key_stream_settings(self, api_key_id: int, user_id: int,
+                                       coalesce_ms: Optional[int], coalesce_bytes: Optional[int]) -> bool:
+        """设置API Key的流式输出合并参数（None 表示使用全局默认）"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE api_keys 
+                SET stream_coalesce_ms = ?, stream_coalesce_bytes = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND user_id = ?
+            ''', (coalesce_ms, coalesce_bytes, api_key_id, user_id))
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
     
     def delete_api_key(self, api_key_id: int, user_id: int) -> bool:
         """删除API Key"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 DELETE FROM api_keys WHERE id = ? AND user_id = ?
             ''', (api_key_id, user_id))
-            return cursor.rowcount > 0
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
     
     # Token管理
     def create_token(self, user_id: int, name: str, token: str, device_id: str = None, wenxiaobai_username: str = None) -> int:
         """创建Token"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO tokens (user_id, name, token, device_id, auto_task_enabled, wenxiaobai_username)
                 VALUES (?, ?, ?, ?, 0, ?)
             ''', (user_id, name, token, device_id, wenxiaobai_username))
-            return cursor.lastrowid
+            token_id = cursor.lastrowid
+            self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return token_id
     
     def get_user_tokens(self, user_id: int) -> List[Dict]:
         """获取用户的Tokens"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, name, token, device_id, balance, last_balance_check, is_active, 
@@ -326,14 +471,14 @@ class DatabaseManager:
             } for row in cursor.fetchall()]
     
     def get_active_token_for_user(self, user_id: int) -> Optional[Dict]:
-        """获取用户的活跃Token（用于API调用）"""
-        with sqlite3.connect(self.db_path) as conn:
+        """获取用户的活跃Token（用于API调用），balance 为预估余额"""
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT id, token, device_id, balance
+                SELECT id, token, device_id, COALESCE(estimated_balance, balance), estimated_balance
                 FROM tokens 
                 WHERE user_id = ? AND is_active = 1 
-                ORDER BY balance DESC, created_at DESC
+                ORDER BY COALESCE(estimated_balance, balance) DESC, created_at DESC
                 LIMIT 1
             ''', (user_id,))
             
@@ -343,47 +488,264 @@ class DatabaseManager:
                     'id': row[0],
                     'token': row[1],
                     'device_id': row[2],
-                    'balance': float(row[3]) if row[3] else 0
+                    'balance': float(row[3]) if row[3] else 0,
+                    'estimated_balance': row[4]
                 }
         return None
     
-    def update_token_balance(self, token_id: int, balance: float) -> bool:
-        """更新Token余额"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_active_tokens_for_user(self, user_id: int) -> List[Dict]:
+        """
+        获取用户的全部活跃Token，按 get_active_token_for_user 的优先顺序排列
+        
+        balance 为预估余额（从未查询过真实余额时为 balance 列）；estimated_balance 为 None 表示尚无预估
+        """
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, token, device_id, COALESCE(estimated_balance, balance), estimated_balance
+                FROM tokens 
+                WHERE user_id = ? AND is_active = 1 
+                ORDER BY COALESCE(estimated_balance, balance) DESC, created_at DESC
+            ''', (user_id,))
+            
+            return [{
+                'id': row[0],
+                'token': row[1],
+                'device_id': row[2],
+                'balance': float(row[3]) if row[3] else 0,
+                'estimated_balance': row[4]
+            } for row in cursor.fetchall()]
+    
+    def get_token_by_id(self, token_id: int) -> Optional[Dict]:
+        """按ID获取Token（后台余额刷新、自动任务使用）"""
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
+                SELECT id, user_id, name, token, device_id, balance, is_active, auto_task_enabled
+                FROM tokens WHERE id = ?
+            ''', (token_id,))
+            
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return {
+                'id': row[0],
+                'user_id': row[1],
+                'name': row[2],
+                'full_token': row[3],
+                'device_id': row[4],
+                'balance': float(row[5]) if row[5] else 0,
+                'is_active': row[6],
+                'auto_task_enabled': row[7]
+            }
+    
+    def update_token_balance(self, token_id: int, balance: float, checked_at: float = None) -> bool:
+        """
+        更新Token余额（真实查询结果），同时校准预估余额
+        
+        checked_at 为实际向上游查询的时间（epoch 秒，余额查询结果中的 fetched_at），默认为当前时间；
+        不比已保存的 last_balance_check 更新的结果（如缓存命中）不写入，返回 False
+        """
+        return self.update_token_balances([(token_id, balance, checked_at)]) > 0
+    
+    def update_token_balances(self, balances: List[Tuple[int, float, Optional[float]]]) -> int:
+        """在一个事务中批量更新Token余额，balances: [(token_id, balance, checked_at), ...]，返回实际写入的数量"""
+        if not balances:
+            return 0
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            # 先推进 last_balance_check（事务中的第一条写语句，之后持有写锁），只有比已保存的查询更新的结果
+            # 才会校准预估余额和学习消耗；RETURNING 得到的是更新前的余额，estimated_balance 非空表示此前查询过
+            fresh = []
+            for token_id, balance, checked_at in balances:
+                checked = _utc_timestamp(checked_at or now)
+                row = cursor.execute('''
+                    UPDATE tokens SET last_balance_check = ?
+                    WHERE id = ? AND (last_balance_check IS NULL OR last_balance_check < ?)
+                    RETURNING balance, estimated_balance IS NOT NULL
+                ''', (checked, token_id, checked)).fetchone()
+                if row:
+                    fresh.append((token_id, balance, float(row[0] or 0) if row[1] else None))
+            
+            self._learn_model_costs(cursor, fresh)
+            cursor.executemany('''
                 UPDATE tokens 
-                SET balance = ?, last_balance_check = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                SET balance = ?, estimated_balance = ?, updated_at = CURRENT_TIMESTAMP
                 WHERE id = ?
-            ''', (balance, token_id))
-            return cursor.rowcount > 0
+            ''', [(balance, balance, token_id) for token_id, balance, _ in fresh])
+            return len(fresh)
+    
+    def _learn_model_costs(self, cursor, balances: List[Tuple[int, float, Optional[float]]]):
+        """
+        用两次真实查询之间的余额减少量更新各模型的单次请求消耗，并清零 Token 自上次查询以来的请求数
+        
+        balances: [(token_id, 新余额, 上一次查询的余额或 None)]，只包含比已保存的查询更新的结果
+        
+        已有消耗估计的模型先按估计值计入，剩余部分按请求数分摊给尚无估计（或估计为 0）的模型；
+        所有模型都有估计时按估计值的比例缩放。每个模型的消耗向本次样本做指数滑动平均。
+        余额增加（任务奖励、充值）的区间不参与学习。
+        """
+        costs = {row[0]: (row[1], row[2]) for row in cursor.execute('SELECT model, cost, samples FROM model_costs')}
+        samples = {}
+        for token_id, balance, previous in balances:
+            usage = cursor.execute('''
+                DELETE FROM token_usage_since_check WHERE token_id = ? RETURNING model, requests
+            ''', (token_id,)).fetchall()
+            if not usage or previous is None:
+                continue
+            spent = previous - float(balance)
+            if spent < 0:
+                continue
+            
+            known = {model: costs[model][0] for model, _ in usage if model in costs and costs[model][0] > 0}
+            predicted = sum(requests * known[model] for model, requests in usage if model in known)
+            unknown_requests = sum(requests for model, requests in usage if model not in known)
+            if unknown_requests:
+                # 已知模型按估计值计入；余额减少量不足以覆盖估计时按比例缩小已知模型的消耗
+                ratio = min(spent / predicted, 1.0) if predicted > 0 else 1.0
+                residual = max(spent - predicted, 0.0)
+                for model, requests in usage:
+                    if model in known:
+                        samples.setdefault(model, []).append(known[model] * ratio)
+                    else:
+                        samples.setdefault(model, []).append(residual / unknown_requests)
+            else:
+                ratio = spent / predicted
+                for model, _ in usage:
+                    samples.setdefault(model, []).append(known[model] * ratio)
+        
+        for model, observed in samples.items():
+            cost, count = costs.get(model, (None, 0))
+            for sample in observed:
+                cost = sample if count == 0 else cost + BALANCE_ESTIMATE_ALPHA * (sample - cost)
+                count += 1
+            cursor.execute('''
+                INSERT INTO model_costs (model, cost, samples) VALUES (?, ?, ?)
+                ON CONFLICT(model) DO UPDATE
+                SET cost = excluded.cost, samples = excluded.samples, updated_at = CURRENT_TIMESTAMP
+            ''', (model, cost, count))
+    
+    def get_model_costs(self) -> List[Dict]:
+        """获取学习到的各模型单次请求消耗"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT model, cost, samples, updated_at FROM model_costs ORDER BY model
+            ''')
+            return [{
+                'model': row[0],
+                'cost': round(row[1], 4),
+                'samples': row[2],
+                'updated_at': row[3]
+            } for row in cursor.fetchall()]
+    
+    def sync_balance_schedule(self, now: float, spread: float) -> Tuple[int, int]:
+        """
+        让余额巡检调度表与 tokens 同步：新的启用 Token 在 [now, now + spread) 内随机安排首次检查，
+        已删除 Token 的调度记录被移除。返回 (新增数, 删除数)
+        """
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO balance_schedule (token_id, next_check_at)
+                SELECT id, ? + (ABS(RANDOM()) % 1000000) / 1000000.0 * ? FROM tokens
+                WHERE is_active = 1 AND id NOT IN (SELECT token_id FROM balance_schedule)
+            ''', (now, spread))
+            added = cursor.rowcount
+            cursor.execute('''
+                DELETE FROM balance_schedule WHERE token_id NOT IN (SELECT id FROM tokens)
+            ''')
+            return added, cursor.rowcount
+    
+    def claim_balance_checks(self, now: float, budget: int, lease: float, limit: int) -> List[int]:
+        """
+        领取到期的余额检查（启用的 Token，按到期时间排序），返回 Token ID 列表
+        
+        领取即写入 claimed_until = now + lease；所有 worker 正在进行（租约未过期）的检查总数不超过 budget。
+        统计与领取在同一条 UPDATE 语句（同一个写事务）中完成，多个进程并发领取也不会超出预算或重复领取。
+        进程中途退出时租约到期后由其他 worker 重新领取。
+        """
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE balance_schedule SET claimed_until = ?
+                WHERE token_id IN (
+                    SELECT s.token_id FROM balance_schedule s JOIN tokens t ON t.id = s.token_id
+                    WHERE t.is_active = 1 AND s.next_check_at <= ?
+                      AND (s.claimed_until IS NULL OR s.claimed_until < ?)
+                    ORDER BY s.next_check_at
+                    LIMIT MIN(?, MAX(0, ? - (SELECT COUNT(*) FROM balance_schedule WHERE claimed_until >= ?)))
+                )
+                RETURNING token_id
+            ''', (now + lease, now, now, limit, budget, now))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def reschedule_balance_check(self, token_id: int, next_check_at: float, interval: float, checked_at: float):
+        """完成一次余额检查：释放租约并安排下一次检查"""
+        with self._connect() as conn:
+            conn.execute('''
+                UPDATE balance_schedule
+                SET next_check_at = ?, interval = ?, claimed_until = NULL, last_checked_at = ?
+                WHERE token_id = ?
+            ''', (next_check_at, interval, checked_at, token_id))
+    
+    def get_balance_schedule_summary(self, now: float) -> Dict:
+        """余额巡检调度表概况（管理员统计）"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*),
+                       SUM(CASE WHEN next_check_at <= ? THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN claimed_until >= ? THEN 1 ELSE 0 END),
+                       AVG(interval), MIN(interval)
+                FROM balance_schedule
+            ''', (now, now))
+            row = cursor.fetchone()
+            return {
+                'scheduled': row[0] or 0,
+                'due': row[1] or 0,
+                'in_progress': row[2] or 0,
+                'avg_interval': round(row[3], 1) if row[3] else None,
+                'min_interval': round(row[4], 1) if row[4] else None
+            }
     
     def toggle_token(self, token_id: int, user_id: int) -> bool:
         """切换Token状态"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE tokens 
                 SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP
                 WHERE id = ? AND user_id = ?
             ''', (token_id, user_id))
-            return cursor.rowcount > 0
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
     
     def delete_token(self, token_id: int, user_id: int) -> bool:
         """删除Token"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 DELETE FROM tokens WHERE id = ? AND user_id = ?
             ''', (token_id, user_id))
-            return cursor.rowcount > 0
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
     
     def batch_toggle_tokens(self, token_ids: List[int], user_id: int) -> int:
         """批量切换Token状态"""
         if not token_ids:
             return 0
             
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             placeholders = ','.join(['?' for _ in token_ids])
             cursor.execute(f'''
@@ -391,45 +753,163 @@ class DatabaseManager:
                 SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP
                 WHERE id IN ({placeholders}) AND user_id = ?
             ''', token_ids + [user_id])
-            return cursor.rowcount
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed
     
     def batch_delete_tokens(self, token_ids: List[int], user_id: int) -> int:
         """批量删除Token"""
         if not token_ids:
             return 0
             
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             placeholders = ','.join(['?' for _ in token_ids])
             cursor.execute(f'''
                 DELETE FROM tokens WHERE id IN ({placeholders}) AND user_id = ?
             ''', token_ids + [user_id])
-            return cursor.rowcount
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed
     
     # 使用记录
     def log_usage(self, user_id: int, api_key_id: int, token_id: int, 
                   model: str, tokens_used: int = 0, cost: float = 0, request_id: str = None):
         """记录使用情况"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
+            bumped = self._insert_usage(conn.cursor(), [(user_id, api_key_id, token_id, model, tokens_used, cost, request_id)])
+        if bumped:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+    
+    def _insert_usage(self, cursor, usage_rows: List[Tuple]) -> bool:
+        """
+        写入使用记录，并在同一事务中累加 usage_hourly / usage_daily 预聚合
+        
+        同一批记录使用同一个 created_at（UTC），与聚合所在的小时 / 天一致；
+        批内先按 (用户, API Key, Token, 模型) 合并，每组每张表只执行一次 UPSERT。
+        返回是否递增了认证缓存版本号（调用方在事务提交后通知本进程的缓存）。
+        """
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        cursor.executemany('''
+            INSERT INTO usage_logs (user_id, api_key_id, token_id, model, tokens_used, cost, request_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [row + (now,) for row in usage_rows])
+        
+        groups = {}
+        for user_id, api_key_id, token_id, model, tokens_used, cost, _ in usage_rows:
+            totals = groups.setdefault((user_id, api_key_id or 0, token_id or 0, model or ''), [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += tokens_used or 0
+            totals[2] += float(cost or 0)
+        
+        for table, bucket, value in (('usage_hourly', 'hour', now[:13] + ':00:00'), ('usage_daily', 'day', now[:10])):
+            cursor.executemany(f'''
+                INSERT INTO {table} (user_id, {bucket}, api_key_id, token_id, model, requests, tokens_used, cost)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, {bucket}, api_key_id, token_id, model) DO UPDATE
+                SET requests = requests + excluded.requests,
+                    tokens_used = tokens_used + excluded.tokens_used,
+                    cost = cost + excluded.cost
+            ''', [(key[0], value) + key[1:] + tuple(totals) for key, totals in groups.items()])
+        
+        requests = {}
+        for (_, _, token_id, model), totals in groups.items():
+            if token_id:
+                requests[(token_id, model)] = requests.get((token_id, model), 0) + totals[0]
+        return self._charge_estimates(cursor, requests)
+    
+    def _charge_estimates(self, cursor, requests: Dict[Tuple[int, str], int]) -> bool:
+        """
+        按学习到的模型消耗扣减预估余额，并累加 Token 自上次查询以来的请求数（供下次查询时学习消耗）
+        
+        预估余额跌破 BALANCE_LOW_THRESHOLD 时把该 Token 的余额巡检提前到现在，
+        并递增认证缓存版本号，路由立即看到新的预估余额；返回是否递增了版本号。
+        """
+        if not requests:
+            return False
+        cursor.executemany('''
+            INSERT INTO token_usage_since_check (token_id, model, requests) VALUES (?, ?, ?)
+            ON CONFLICT(token_id, model) DO UPDATE SET requests = requests + excluded.requests
+        ''', [key + (count,) for key, count in requests.items()])
+        
+        models = sorted({model for _, model in requests})
+        costs = dict(cursor.execute(f'''
+            SELECT model, cost FROM model_costs WHERE model IN ({','.join('?' * len(models))})
+        ''', models).fetchall())
+        
+        crossed = []
+        for (token_id, model), count in requests.items():
+            charge = count * costs.get(model, BALANCE_ESTIMATE_DEFAULT_COST)
+            if charge <= 0:
+                continue
+            row = cursor.execute('''
+                UPDATE tokens SET estimated_balance = estimated_balance - ?
+                WHERE id = ? AND estimated_balance IS NOT NULL
+                RETURNING estimated_balance
+            ''', (charge, token_id)).fetchone()
+            if row and row[0] < BALANCE_LOW_THRESHOLD <= row[0] + charge:
+                crossed.append(token_id)
+        
+        if crossed:
+            cursor.execute(f'''
+                UPDATE balance_schedule SET next_check_at = MIN(next_check_at, ?)
+                WHERE token_id IN ({','.join('?' * len(crossed))})
+            ''', [time.time()] + crossed)
+            self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        return bool(crossed)
+    
+    def update_usage_status(self, request_id: str, status: str):
+        """更新使用记录的状态（如客户端断开时标记为 cancelled）"""
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO usage_logs (user_id, api_key_id, token_id, model, tokens_used, cost, request_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, api_key_id, token_id, model, tokens_used, cost, request_id))
+                UPDATE usage_logs SET status = ? WHERE request_id = ?
+            ''', (status, request_id))
     
     def get_user_usage_stats(self, user_id: int, days: int = 30) -> Dict:
-        """获取用户使用统计"""
-        with sqlite3.connect(self.db_path) as conn:
+        """
+        获取用户使用统计（最近 days 天）
+        
+        窗口 [start, now) 拆成三段，查询代价与 usage_logs 的总行数无关：
+        start 所在的不完整小时读原始记录，到当天结束的整小时读 usage_hourly，之后的整天读 usage_daily。
+        """
+        start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(days=days)
+        hour_start = start.replace(minute=0, second=0)
+        if hour_start < start:
+            hour_start += timedelta(hours=1)
+        day_start = hour_start.replace(hour=0)
+        if day_start < hour_start:
+            day_start += timedelta(days=1)
+        
+        start = start.strftime('%Y-%m-%d %H:%M:%S')
+        hour_start = hour_start.strftime('%Y-%m-%d %H:%M:%S')
+        day_start = day_start.strftime('%Y-%m-%d')
+        
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT 
-                    COUNT(*) as total_requests,
+                    SUM(requests) as total_requests,
                     SUM(tokens_used) as total_tokens,
                     SUM(cost) as total_cost,
-                    COUNT(DISTINCT DATE(created_at)) as active_days
-                FROM usage_logs 
-                WHERE user_id = ? AND created_at >= datetime('now', '-{} days')
-            '''.format(days), (user_id,))
+                    COUNT(DISTINCT day) as active_days
+                FROM (
+                    SELECT day, requests, tokens_used, cost FROM usage_daily
+                    WHERE user_id = ? AND day >= ?
+                    UNION ALL
+                    SELECT substr(hour, 1, 10), requests, tokens_used, cost FROM usage_hourly
+                    WHERE user_id = ? AND hour >= ? AND hour < ?
+                    UNION ALL
+                    SELECT DATE(created_at), 1, tokens_used, cost FROM usage_logs
+                    WHERE user_id = ? AND created_at >= ? AND created_at < ?
+                )
+            ''', (user_id, day_start, user_id, hour_start, day_start, user_id, start, hour_start))
             
             row = cursor.fetchone()
             return {
@@ -441,7 +921,7 @@ class DatabaseManager:
     
     def toggle_auto_task(self, token_id: int, user_id: int) -> bool:
         """切换Token自动任务状态"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE tokens 
@@ -451,41 +931,137 @@ class DatabaseManager:
             return cursor.rowcount > 0
     
     def increment_api_calls(self, token_id: int) -> int:
-        """增加Token的API调用次数"""
+        """增加Token当天的API调用次数，返回当天的调用次数"""
         today = datetime.now().date().isoformat()
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
+            return self._add_api_calls(conn.cursor(), token_id, today, 1)
+    
+    def _add_api_calls(self, cursor, token_id: int, day: str, delta: int) -> int:
+        """
+        在 token_daily_stats 上原子累加调用次数，并同步 tokens.api_calls_today 缓存
+        
+        UPSERT 与缓存更新处于同一个写事务中，多个 worker 并发调用也不会丢失计数。
+        当天第一次调用时记录 Token 当时的余额作为 initial_balance。Token 不存在时返回 0。
+        """
+        cursor.execute('''
+            INSERT INTO token_daily_stats (token_id, date, initial_balance, api_calls_count)
+            SELECT id, ?, balance, ? FROM tokens WHERE id = ?
+            ON CONFLICT(token_id, date) DO UPDATE
+            SET api_calls_count = api_calls_count + excluded.api_calls_count, updated_at = CURRENT_TIMESTAMP
+            RETURNING api_calls_count
+        ''', (day, delta, token_id))
+        
+        row = cursor.fetchone()
+        if not row:
+            return 0
+        
+        # 缓存只会前进到更新的日期，跨零点时旧日期的增量不会覆盖新一天的计数
+        cursor.execute('''
+            UPDATE tokens 
+            SET api_calls_today = ?, last_call_date = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND (last_call_date IS NULL OR last_call_date <= ?)
+        ''', (row[0], day, token_id, day))
+        return row[0]
+    
+    def get_api_calls_today(self, token_id: int, today: str) -> int:
+        """读取Token当天已提交的API调用次数"""
+        with self._connect() as conn:
             cursor = conn.cursor()
-            
-            # 检查是否是新的一天
             cursor.execute('''
-                SELECT api_calls_today, last_call_date FROM tokens WHERE id = ?
-            ''', (token_id,))
+                SELECT api_calls_count FROM token_daily_stats WHERE token_id = ? AND date = ?
+            ''', (token_id, today))
             
             row = cursor.fetchone()
-            if row:
-                current_calls, last_date = row
-                
-                # 如果是新的一天，重置计数
-                if last_date != today:
-                    current_calls = 0
-                
-                new_calls = current_calls + 1
-                
-                cursor.execute('''
-                    UPDATE tokens 
-                    SET api_calls_today = ?, last_call_date = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (new_calls, today, token_id))
-                
-                conn.commit()
-                return new_calls
+            return row[0] if row else 0
+    
+    def get_recent_api_calls(self, token_id: int, days: List[str]) -> Dict[str, int]:
+        """读取Token在指定日期的API调用次数 {日期: 次数}，没有记录的日期不出现在结果中"""
+        if not days:
+            return {}
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT date, api_calls_count FROM token_daily_stats
+                WHERE token_id = ? AND date IN ({','.join('?' * len(days))})
+            ''', (token_id, *days))
+            return {row[0]: row[1] or 0 for row in cursor.fetchall()}
+    
+    def get_token_daily_stats(self, token_id: int, day: str = None) -> Dict:
+        """获取Token某一天（默认今天）的调用次数、任务数和奖励"""
+        day = day or datetime.now().date().isoformat()
+        
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT initial_balance, api_calls_count, tasks_completed, rewards_earned, is_disabled_today
+                FROM token_daily_stats WHERE token_id = ? AND date = ?
+            ''', (token_id, day))
             
-            return 0
+            row = cursor.fetchone() or (0, 0, 0, 0, 0)
+            return {
+                'token_id': token_id,
+                'date': day,
+                'initial_balance': float(row[0]) if row[0] else 0,
+                'api_calls_count': row[1] or 0,
+                'tasks_completed': row[2] or 0,
+                'rewards_earned': float(row[3]) if row[3] else 0,
+                'is_disabled_today': row[4]
+            }
+    
+    def record_task_completion(self, token_id: int, task_type: str, task_id: str, rewards_earned: float):
+        """记录一次任务完成，并在同一事务中累加当天的任务数和奖励"""
+        today = datetime.now().date().isoformat()
+        
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO task_logs (token_id, task_type, task_id, rewards_earned)
+                VALUES (?, ?, ?, ?)
+            ''', (token_id, task_type, task_id, rewards_earned))
+            
+            cursor.execute('''
+                INSERT INTO token_daily_stats (token_id, date, initial_balance, tasks_completed, rewards_earned)
+                SELECT id, ?, balance, 1, ? FROM tokens WHERE id = ?
+                ON CONFLICT(token_id, date) DO UPDATE
+                SET tasks_completed = tasks_completed + 1,
+                    rewards_earned = rewards_earned + excluded.rewards_earned,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (today, rewards_earned, token_id))
+    
+    def write_usage_batch(self, usage_rows: List[Tuple], call_deltas: List[Tuple],
+                          status_updates: List[Tuple]) -> Dict[Tuple[int, str], int]:
+        """
+        在一个事务中批量写入使用记录、调用次数增量和状态更新
+        
+        Args:
+            usage_rows: [(user_id, api_key_id, token_id, model, tokens_used, cost, request_id), ...]
+            call_deltas: [(token_id, date, delta), ...]，按日期升序
+            status_updates: [(status, request_id), ...]，在本批插入之后执行
+        
+        Returns:
+            {(token_id, date): 累加后当天的调用次数}（含其他 worker 已提交的次数）
+        """
+        totals = {}
+        bumped = False
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            if usage_rows:
+                bumped = self._insert_usage(cursor, usage_rows)
+            
+            for token_id, day, delta in call_deltas:
+                totals[(token_id, day)] = self._add_api_calls(cursor, token_id, day, delta)
+            
+            cursor.executemany('''
+                UPDATE usage_logs SET status = ? WHERE request_id = ?
+            ''', status_updates)
+        if bumped:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return totals
     
     def get_tokens_for_auto_tasks(self) -> List[Dict]:
         """获取启用了自动任务的Token"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, user_id, name, token, device_id, balance, auto_task_enabled, 
@@ -507,12 +1083,12 @@ class DatabaseManager:
             } for row in cursor.fetchall()]
     
     def get_connection(self):
-        """获取数据库连接"""
-        return sqlite3.connect(self.db_path)
+        """获取数据库连接（当前线程的持久连接，不要关闭）"""
+        return self._connect()
     
     def check_wenxiaobai_username_exists(self, wenxiaobai_username: str) -> bool:
         """检查文小白用户名是否已存在"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT COUNT(*) FROM tokens WHERE wenxiaobai_username = ?
@@ -521,7 +1097,7 @@ class DatabaseManager:
     
     def get_all_tokens(self) -> List[Dict]:
         """获取所有Token（管理员功能）"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT t.id, t.user_id, u.username, t.name, t.token, t.device_id, 
@@ -552,18 +1128,23 @@ class DatabaseManager:
     
     def admin_toggle_token(self, token_id: int) -> bool:
         """管理员切换Token状态"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE tokens 
                 SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP
                 WHERE id = ?
             ''', (token_id,))
-            return cursor.rowcount > 0
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
     
     def admin_toggle_auto_task(self, token_id: int) -> bool:
         """管理员切换Token自动任务状态"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE tokens 
@@ -574,19 +1155,24 @@ class DatabaseManager:
     
     def admin_delete_token(self, token_id: int) -> bool:
         """管理员删除Token"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 DELETE FROM tokens WHERE id = ?
             ''', (token_id,))
-            return cursor.rowcount > 0
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
     
     def admin_batch_toggle_tokens(self, token_ids: List[int]) -> int:
         """管理员批量切换Token状态"""
         if not token_ids:
             return 0
             
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             placeholders = ','.join(['?' for _ in token_ids])
             cursor.execute(f'''
@@ -594,14 +1180,19 @@ class DatabaseManager:
                 SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP
                 WHERE id IN ({placeholders})
             ''', token_ids)
-            return cursor.rowcount
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed
     
     def admin_batch_toggle_auto_task(self, token_ids: List[int]) -> int:
         """管理员批量切换自动任务状态"""
         if not token_ids:
             return 0
             
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             placeholders = ','.join(['?' for _ in token_ids])
             cursor.execute(f'''
@@ -616,33 +1207,48 @@ class DatabaseManager:
         if not token_ids:
             return 0
             
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             placeholders = ','.join(['?' for _ in token_ids])
             cursor.execute(f'''
                 DELETE FROM tokens WHERE id IN ({placeholders})
             ''', token_ids)
-            return cursor.rowcount
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed
     
     def admin_delete_user(self, user_id: int) -> bool:
         """管理员删除用户（级联删除相关数据）"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 DELETE FROM users WHERE id = ? AND is_admin = 0
             ''', (user_id,))
-            return cursor.rowcount > 0
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
     
     def admin_toggle_user_status(self, user_id: int) -> bool:
         """管理员切换用户状态"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE users 
                 SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP
                 WHERE id = ? AND is_admin = 0
             ''', (user_id,))
-            return cursor.rowcount > 0
+            changed = cursor.rowcount
+            if changed > 0:
+                self._bump_cache_version(cursor, AUTH_CACHE_VERSION)
+        if changed > 0:
+            self._notify_cache_listeners(AUTH_CACHE_VERSION)
+        return changed > 0
 
 # 全局数据库实例
 db = DatabaseManager()
\ No newline at end of file
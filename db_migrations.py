@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+数据库结构迁移
+
+schema_version 表记录已应用的迁移版本，启动时按版本号顺序执行尚未应用的前向迁移。
+每个迁移与版本记录在同一个 BEGIN IMMEDIATE 事务中提交，多个 worker 同时启动时只有一个会执行，
+其余进程拿到写锁后发现版本已更新便直接跳过。
+
+新增迁移：在 MIGRATIONS 末尾追加 (版本号, 说明, 函数)，版本号递增；已发布的迁移不要再修改。
+"""
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, definition: str):
+    """列不存在时添加列（旧版本启动时可能已经补过该列，但没有版本记录）"""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _stream_coalesce_columns(conn: sqlite3.Connection):
+    _add_column(conn, 'api_keys', 'stream_coalesce_ms', 'INTEGER')
+    _add_column(conn, 'api_keys', 'stream_coalesce_bytes', 'INTEGER')
+
+
+def _usage_status_column(conn: sqlite3.Connection):
+    _add_column(conn, 'usage_logs', 'status', "VARCHAR(20) DEFAULT 'completed'")
+
+
+def _access_path_indexes(conn: sqlite3.Connection):
+    # get_user_usage_stats：按用户 + 时间范围聚合，索引包含聚合列，无需回表
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_usage_logs_user_created
+        ON usage_logs (user_id, created_at, tokens_used, cost)
+    ''')
+    # update_usage_status：按 request_id 更新请求状态
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_usage_logs_request_id ON usage_logs (request_id)')
+    # TaskSystem.get_daily_task_stats：按 Token + 当天时间范围按任务类型汇总
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_task_logs_token_created
+        ON task_logs (token_id, created_at, task_type, rewards_earned)
+    ''')
+    # get_active_token_for_user：索引顺序即排序顺序，LIMIT 1 只读取一条索引项
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tokens_user_active_balance
+        ON tokens (user_id, is_active, balance DESC, created_at DESC)
+    ''')
+
+
+def _token_daily_stats_backfill(conn: sqlite3.Connection):
+    # 此前 token_daily_stats 没有写入：调用次数来自 tokens 上的当天缓存，任务数和奖励从 task_logs 汇总
+    conn.execute('''
+        INSERT OR IGNORE INTO token_daily_stats (token_id, date, initial_balance, api_calls_count)
+        SELECT id, last_call_date, balance, api_calls_today FROM tokens
+        WHERE last_call_date IS NOT NULL AND api_calls_today > 0
+    ''')
+    conn.execute('''
+        INSERT INTO token_daily_stats (token_id, date, tasks_completed, rewards_earned)
+        SELECT token_id, DATE(created_at, 'localtime'), COUNT(*), SUM(rewards_earned)
+        FROM task_logs WHERE true
+        GROUP BY token_id, DATE(created_at, 'localtime')
+        ON CONFLICT(token_id, date) DO UPDATE
+        SET tasks_completed = excluded.tasks_completed, rewards_earned = excluded.rewards_earned
+    ''')
+
+
+def _cache_versions(conn: sqlite3.Connection):
+    # 内存缓存的跨进程失效：修改相关数据时在同一事务中递增版本号
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name VARCHAR(50) PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('auth', 0)")
+
+
+def _usage_rollups(conn: sqlite3.Connection):
+    # 使用量按小时 / 按天预聚合（UTC，与 usage_logs.created_at 一致），统计查询不再扫描原始记录；
+    # 写入使用记录时在同一事务中累加，这里从已有的 usage_logs 回填
+    for table, bucket, length in (('usage_hourly', 'hour', 13), ('usage_daily', 'day', 10)):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                user_id INTEGER NOT NULL,
+                {bucket} TEXT NOT NULL,
+                api_key_id INTEGER NOT NULL DEFAULT 0,
+                token_id INTEGER NOT NULL DEFAULT 0,
+                model TEXT NOT NULL DEFAULT '',
+                requests INTEGER NOT NULL DEFAULT 0,
+                tokens_used INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, {bucket}, api_key_id, token_id, model)
+            ) WITHOUT ROWID
+        ''')
+        suffix = " || ':00:00'" if bucket == 'hour' else ''
+        conn.execute(f'''
+            INSERT INTO {table} (user_id, {bucket}, api_key_id, token_id, model, requests, tokens_used, cost)
+            SELECT user_id, substr(created_at, 1, {length}){suffix}, COALESCE(api_key_id, 0), COALESCE(token_id, 0),
+                   COALESCE(model, ''), COUNT(*), COALESCE(SUM(tokens_used), 0), COALESCE(SUM(cost), 0)
+            FROM usage_logs WHERE created_at IS NOT NULL
+            GROUP BY 1, 2, 3, 4, 5
+        ''')
+
+
+def _balance_schedule(conn: sqlite3.Connection):
+    # 后台余额巡检的调度表：下次检查时间（epoch 秒）、当前检查间隔，以及正在检查的 worker 的租约到期时间
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS balance_schedule (
+            token_id INTEGER PRIMARY KEY,
+            next_check_at REAL NOT NULL,
+            interval REAL,
+            claimed_until REAL,
+            last_checked_at REAL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_balance_schedule_next ON balance_schedule (next_check_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_balance_schedule_claimed ON balance_schedule (claimed_until)')
+
+
+def _balance_estimates(conn: sqlite3.Connection):
+    # 两次余额查询之间的预估余额：NULL 表示尚未查询过真实余额；已查询过的 Token 从最近一次查询结果开始预估
+    _add_column(conn, 'tokens', 'estimated_balance', 'REAL')
+    conn.execute('UPDATE tokens SET estimated_balance = balance WHERE last_balance_check IS NOT NULL')
+    # 路由按预估余额排序，替换按 balance 排序的索引
+    conn.execute('DROP INDEX IF EXISTS idx_tokens_user_active_balance')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tokens_user_active_estimate
+        ON tokens (user_id, is_active, COALESCE(estimated_balance, balance) DESC, created_at DESC)
+    ''')
+    # 从余额变化中学习的每个模型单次请求的消耗
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS model_costs (
+            model VARCHAR(100) PRIMARY KEY,
+            cost REAL NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 每个 Token 自上次查询余额以来各模型的请求数
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS token_usage_since_check (
+            token_id INTEGER NOT NULL,
+            model VARCHAR(100) NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (token_id, model)
+        ) WITHOUT ROWID
+    ''')
+
+
+# (版本号, 说明, 迁移函数)
+MIGRATIONS = [
+    (1, "api_keys: stream_coalesce_ms / stream_coalesce_bytes", _stream_coalesce_columns),
+    (2, "usage_logs: status", _usage_status_column),
+    (3, "usage_logs / task_logs / tokens access path indexes", _access_path_indexes),
+    (4, "token_daily_stats backfill", _token_daily_stats_backfill),
+    (5, "cache_versions", _cache_versions),
+    (6, "usage_hourly / usage_daily rollups", _usage_rollups),
+    (7, "balance_schedule", _balance_schedule),
+    (8, "tokens: estimated_balance, model_costs, token_usage_since_check", _balance_estimates),
+]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    """返回已应用的最高迁移版本，未迁移过时为 0"""
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """执行所有尚未应用的迁移，返回迁移后的版本号"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    version = current_version(conn)
+    for target, description, apply in MIGRATIONS:
+        if target <= version:
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 拿到写锁后重新检查：其他进程可能刚刚完成了同一个迁移
+            version = current_version(conn)
+            if target <= version:
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (target, description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Schema migration {target} failed: {description}")
+            raise
+
+        version = target
+        logger.info(f"Applied schema migration {target}: {description}")
+
+    return version
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+上游HTTP传输模块
+
+为对话、余额查询和任务系统提供进程级共享的 requests.Session，
+按主机维护 keep-alive 连接池，避免每次调用都重新进行 TCP+TLS 握手。
+"""
+import os
+import threading
+import time
+import logging
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamTransport:
+    """
+    共享的上游HTTP传输层
+
+    - pool_connections: 缓存的主机连接池数量
+    - pool_maxsize: 每个主机连接池保留的最大连接数
+    - idle_timeout: 连接池空闲超过该秒数后整体回收（0 表示不回收）
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 32,
+                 idle_timeout: float = 90.0):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+        self._last_used = 0.0
+        self._async_client = None
+
+    def _build_session(self) -> requests.Session:
+        """创建带连接池的 Session"""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=False
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _get_session(self) -> requests.Session:
+        """获取 Session，空闲超时后回收旧连接"""
+        with self._lock:
+            now = time.monotonic()
+            if self._session is None:
+                self._session = self._build_session()
+            elif self.idle_timeout and now - self._last_used > self.idle_timeout:
+                # 上游通常会先于我们关闭长时间空闲的连接，直接清空连接池避免复用失效连接
+                logger.info(f"Upstream pool idle for {now - self._last_used:.0f}s, evicting connections")
+                for adapter in self._session.adapters.values():
+                    adapter.poolmanager.clear()
+            self._last_used = now
+            return self._session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """发送请求，参数与 requests.request 一致"""
+        return self._get_session().request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def get_async_client(self):
+        """
+        获取共享的 httpx.AsyncClient（ASGI 服务模式使用）
+
+        连接池参数与同步 Session 一致，idle_timeout 对应 keep-alive 过期时间。
+        """
+        if self._async_client is None:
+            import httpx
+            self._async_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=None,
+                    max_keepalive_connections=self.pool_maxsize,
+                    keepalive_expiry=self.idle_timeout or None
+                ),
+                verify=False  # 禁用 SSL 证书验证
+            )
+        return self._async_client
+
+    def close(self):
+        """关闭所有连接"""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    async def aclose(self):
+        """关闭异步客户端的所有连接"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+
+# 全局上游传输实例
+upstream_transport = UpstreamTransport(
+    pool_connections=int(os.environ.get("UPSTREAM_POOL_CONNECTIONS", 10)),
+    pool_maxsize=int(os.environ.get("UPSTREAM_POOL_MAXSIZE", 32)),
+    idle_timeout=float(os.environ.get("UPSTREAM_POOL_IDLE_TIMEOUT", 90))
+)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+usage_logs / task_logs 的保留与归档
+
+超过 LOG_RETENTION_DAYS 天的记录按 created_at 的日期（UTC）追加到压缩归档文件
+LOG_ARCHIVE_DIR/<表名>/<YYYY-MM-DD>.ndjson.gz（每行一条 JSON 记录），然后从数据库中删除：
+- 按 id 顺序每次处理 LOG_ARCHIVE_BATCH 行，每批的删除是一个很短的写事务，批之间让出写锁
+- 先写入并 fsync 归档文件再删除；两步之间进程退出时下一轮会重复归档这些行，读取时按 id 去重
+- 多个 worker 都会启动归档线程，通过归档目录下的文件锁保证同一时刻只有一个在执行
+
+统计查询使用的 usage_hourly / usage_daily 预聚合不会被清理，历史明细通过 query() 从归档文件中读取。
+"""
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，仅保证单进程内的互斥
+    fcntl = None
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+LOG_RETENTION_DAYS = int(os.environ.get("LOG_RETENTION_DAYS", 90))           # 0 表示不归档
+LOG_ARCHIVE_DIR = os.environ.get("LOG_ARCHIVE_DIR", "")                       # 默认为数据库所在目录下的 archive/
+LOG_ARCHIVE_INTERVAL = int(os.environ.get("LOG_ARCHIVE_INTERVAL", 3600))      # 两次归档之间的秒数
+LOG_ARCHIVE_BATCH = int(os.environ.get("LOG_ARCHIVE_BATCH", 1000))
+
+# 可归档的表（按 created_at 划分日期）
+ARCHIVE_TABLES = ('usage_logs', 'task_logs')
+
+# 每批删除之后的停顿（秒），给请求路径上的写入让出写锁
+BATCH_PAUSE = 0.05
+
+
+class LogArchiver:
+    """把过期的日志记录移动到按日期分区的 gzip NDJSON 归档文件"""
+
+    def __init__(self, database, archive_dir: str = LOG_ARCHIVE_DIR, retention_days: int = LOG_RETENTION_DAYS,
+                 interval: int = LOG_ARCHIVE_INTERVAL, batch_size: int = LOG_ARCHIVE_BATCH):
+        self.db = database
+        self.archive_dir = archive_dir or os.path.join(os.path.dirname(os.path.abspath(database.db_path)), "archive")
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.archived = {table: 0 for table in ARCHIVE_TABLES}
+
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """启动后台归档线程（每个进程一个，retention_days 为 0 时不启动）"""
+        if self.retention_days <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="log-archiver", daemon=True).start()
+
+    def run_once(self) -> Dict[str, int]:
+        """
+        归档所有过期记录，返回 {表名: 归档行数}
+
+        其他进程正在归档时直接返回空结果。
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+
+        with self._lock:
+            lock_fd = os.open(os.path.join(self.archive_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        return {}
+                result = {table: self._archive_table(table, cutoff) for table in ARCHIVE_TABLES}
+            finally:
+                os.close(lock_fd)
+
+        if any(result.values()):
+            logger.info(f"Archived log rows older than {cutoff}: {result}")
+        return result
+
+    def query(self, table: str, start: str, end: str, limit: Optional[int] = None, **filters) -> List[Dict]:
+        """
+        读取归档中日期在 [start, end]（YYYY-MM-DD）内、且字段等于 filters 的记录，按日期和 id 排序
+        """
+        rows = []
+        for row in self.iter_archive(table, start, end, **filters):
+            rows.append(row)
+            if limit and len(rows) >= limit:
+                break
+        return rows
+
+    def iter_archive(self, table: str, start: str, end: str, **filters) -> Iterator[Dict]:
+        if table not in ARCHIVE_TABLES:
+            raise ValueError(f"不支持归档的表: {table}")
+
+        for day in self.partitions(table):
+            if not start <= day <= end:
+                continue
+            rows = {}
+            with gzip.open(self._partition_path(table, day), 'rt', encoding='utf-8') as f:
+                try:
+                    for line in f:
+                        row = json.loads(line)
+                        rows[row['id']] = row
+                except (EOFError, ValueError) as e:
+                    # 写入时进程退出导致的不完整末尾，之前的记录仍然有效
+                    logger.warning(f"Truncated archive partition {table}/{day}: {e}")
+            for row_id in sorted(rows):
+                row = rows[row_id]
+                if all(row.get(key) == value for key, value in filters.items()):
+                    yield row
+
+    def partitions(self, table: str) -> List[str]:
+        """返回表的所有归档日期（升序）"""
+        table_dir = os.path.join(self.archive_dir, table)
+        if not os.path.isdir(table_dir):
+            return []
+        return sorted(name[:-len('.ndjson.gz')] for name in os.listdir(table_dir) if name.endswith('.ndjson.gz'))
+
+    def stats(self) -> Dict:
+        return {
+            'retention_days': self.retention_days,
+            'archive_dir': self.archive_dir,
+            'archived': dict(self.archived),
+            'partitions': {table: len(self.partitions(table)) for table in ARCHIVE_TABLES}
+        }
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Log archiving failed: {e}")
+            time.sleep(self.interval)
+
+    def _archive_table(self, table: str, cutoff: str) -> int:
+        conn = self.db.get_connection()
+        total = 0
+        last_id = 0
+        while True:
+            # 按主键顺序读取，不依赖 created_at 上的索引；遇到第一条未过期的记录即停止
+            cursor = conn.execute(f'SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?', (last_id, self.batch_size))
+            columns = [column[0] for column in cursor.description]
+            rows = []
+            for values in cursor.fetchall():
+                row = dict(zip(columns, values))
+                if row['created_at'] is None or row['created_at'] >= cutoff:
+                    break
+                rows.append(row)
+            if not rows:
+                return total
+
+            self._append(table, rows)
+            with conn:
+                conn.execute(f'DELETE FROM {table} WHERE id BETWEEN ? AND ?', (rows[0]['id'], rows[-1]['id']))
+
+            last_id = rows[-1]['id']
+            total += len(rows)
+            self.archived[table] += len(rows)
+            if len(rows) < self.batch_size:
+                return total
+            time.sleep(BATCH_PAUSE)
+
+    def _append(self, table: str, rows: List[Dict]):
+        """按日期追加到归档文件（每次追加一个 gzip 成员）并落盘"""
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row['created_at'][:10], []).append(row)
+
+        os.makedirs(os.path.join(self.archive_dir, table), exist_ok=True)
+        for day, day_rows in by_day.items():
+            data = ''.join(json.dumps(row, ensure_ascii=False, separators=(',', ':'), default=str) + '\n'
+                           for row in day_rows)
+            with open(self._partition_path(table, day), 'ab') as f:
+                f.write(gzip.compress(data.encode('utf-8')))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _partition_path(self, table: str, day: str) -> str:
+        return os.path.join(self.archive_dir, table, f"{day}.ndjson.gz")
+
+
+# 全局归档实例
+log_archiver = LogArchiver(db)
@@ -9,6 +9,8 @@ from datetime import datetime
 from dataclasses import dataclass, asdict
 from typing import Dict, Any, Optional, List
 import logging
+import logging.handlers
+import queue
 
 
 @dataclass
@@ -516,4 +518,33 @@ class APIDebugLogger:
                 filtered[key] = "***MASKED***"
             else:
                 filtered[key] = value
-        return filtered
\ No newline at end of file
+        return filtered
+
+
+def enable_queue_logging(*loggers: logging.Logger) -> logging.handlers.QueueListener:
+    """
+    Route the given loggers through an in-memory queue so that emitting a
+    record never blocks the caller on console or file I/O.
+    
+    Used by the asyncio serving mode, where a slow stderr write would
+    otherwise stall the event loop and every stream it is serving.
+    
+    Args:
+        *loggers: Loggers whose existing handlers should be moved behind the queue
+        
+    Returns:
+        logging.handlers.QueueListener: The started listener; call stop() on shutdown
+    """
+    log_queue = queue.SimpleQueue()
+    handlers = []
+    
+    for target in loggers:
+        for handler in list(target.handlers):
+            target.removeHandler(handler)
+            if handler not in handlers:
+                handlers.append(handler)
+        target.addHandler(logging.handlers.QueueHandler(log_queue))
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -1,18 +1,28 @@
 import os
-import json
 import time
 import uuid
 import requests
 import random
 import logging
 from datetime import datetime
-from flask import Flask, request, jsonify, Response, g, session
+from dataclasses import dataclass
+from typing import Optional
+from flask import Flask, request, jsonify, Response, g, session, stream_with_context
 from dotenv import load_dotenv
 from wenxiaobai_client import create_wenxiaobai_client, MODEL_MAP, MODEL_ABILITIES
+from sse_parser import iter_sse_payloads, extract_event_fields
+from sse_encoder import OpenAIStreamEncoder
+from session_store import create_session_store
+from stream_coalescer import create_coalescer
 from pathlib import Path
 from logging_system import RequestLogger, APIDebugLogger
 from user_management import user_bp
-from database import db
+from usage_writer import usage_writer
+from balance_refresher import balance_refresher
+from balance_sweeper import balance_sweeper
+from log_archiver import log_archiver
+from auth_cache import auth_cache, auth_throttle, client_address
+from token_scheduler import token_scheduler, TokenLease
 from functools import wraps
 
 # 加载 .env 文件中的环境变量
@@ -29,51 +39,61 @@ app.register_blueprint(user_bp)
 request_logger = RequestLogger()
 api_debug_logger = APIDebugLogger()
 
+def authenticate_api_key(auth_header, client_ip=None):
+    """
+    校验 Authorization 头并解析用户与 token
+
+    Returns:
+        (user_info, tokens, api_key, error)，tokens 为活跃 Token 候选列表（按余额优先排列），
+        error 为 (message, status_code) 或 None
+    """
+    if not auth_header:
+        return None, None, None, _auth_failure(client_ip, "Missing Authorization header")
+    
+    # 解析Bearer token
+    if not auth_header.startswith('Bearer '):
+        return None, None, None, _auth_failure(client_ip, "Invalid Authorization header format")
+    
+    api_key = auth_header[7:]  # 移除 "Bearer " 前缀
+    
+    # 验证API Key（认证缓存命中或 Key 不在有效集合中时都不查询数据库）；有效 Key 不受失败限流影响
+    cached = auth_cache.lookup(api_key)
+    if not cached:
+        return None, None, api_key, _auth_failure(client_ip, "Invalid API key")
+    user_info, tokens = cached
+    
+    # 用户的活跃token候选（具体使用哪个由调度器在管线中选择）
+    if not tokens:
+        return dict(user_info), None, api_key, ("No active token found for user", 400)
+    
+    return dict(user_info), tokens, api_key, None
+
+def _auth_failure(client_ip, message):
+    """认证失败：失败过多的 IP 返回 429，否则记录一次失败并返回 401"""
+    if auth_throttle.blocked(client_ip):
+        return "Too many failed authentication attempts, please retry later", 429
+    auth_throttle.record_failure(client_ip)
+    return message, 401
+
 # API Key验证装饰器
 def require_api_key(f):
     """API Key验证装饰器"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # 获取Authorization头
-        auth_header = request.headers.get('Authorization')
-        if not auth_header:
-            return jsonify(format_openai_error_response(
-                "invalid_request_error",
-                "Missing Authorization header",
-                request_id=getattr(g, 'request_id', 'unknown')
-            )), 401
-        
-        # 解析Bearer token
-        if not auth_header.startswith('Bearer '):
-            return jsonify(format_openai_error_response(
-                "invalid_request_error",
-                "Invalid Authorization header format",
-                request_id=getattr(g, 'request_id', 'unknown')
-            )), 401
-        
-        api_key = auth_header[7:]  # 移除 "Bearer " 前缀
-        
-        # 验证API Key
-        user_info = db.get_user_by_api_key(api_key)
-        if not user_info:
-            return jsonify(format_openai_error_response(
-                "invalid_request_error",
-                "Invalid API key",
-                request_id=getattr(g, 'request_id', 'unknown')
-            )), 401
-        
-        # 获取用户的活跃token
-        token_info = db.get_active_token_for_user(user_info['user_id'])
-        if not token_info:
+        user_info, tokens, api_key, error = authenticate_api_key(
+            request.headers.get('Authorization'), getattr(g, 'client_ip', None)
+        )
+        if error:
+            message, status_code = error
             return jsonify(format_openai_error_response(
                 "invalid_request_error",
-                "No active token found for user",
+                message,
                 request_id=getattr(g, 'request_id', 'unknown')
-            )), 400
+            )), status_code
         
-        # 将用户信息和token信息存储到g对象中
+        # 将用户信息和token候选存储到g对象中
         g.user_info = user_info
-        g.token_info = token_info
+        g.tokens = tokens
         g.api_key = api_key
         
         return f(*args, **kwargs)
@@ -81,10 +101,8 @@ def require_api_key(f):
 @app.before_request
 def log_request_start():
     """Log incoming request and generate correlation ID."""
-    # Get client IP (handle proxy headers)
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    if client_ip and ',' in client_ip:
-        client_ip = client_ip.split(',')[0].strip()
+    # Get client IP (X-Forwarded-For is only trusted from TRUSTED_PROXIES)
+    client_ip = client_address(request.remote_addr, request.headers.get('X-Forwarded-For'))
     
     # Generate request ID and store in Flask's g object for request duration
     request_id = request_logger.log_incoming_request(
@@ -192,61 +210,46 @@ database_dir = os.path.dirname(DATABASE_PATH)
 if database_dir:
     Path(database_dir).mkdir(parents=True, exist_ok=True)
 
-session_storage_file = os.path.join(SESSION_DATA_DIR, "sessions.json")
-
-def load_sessions():
-    """从文件加载会话数据"""
-    try:
-        if os.path.exists(session_storage_file):
-            with open(session_storage_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"[WARNING] 加载会话数据失败: {e}")
-    return {}
-
-def save_sessions(sessions_data):
-    """保存会话数据到文件"""
-    try:
-        with open(session_storage_file, 'w', encoding='utf-8') as f:
-            json.dump(sessions_data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"[WARNING] 保存会话数据失败: {e}")
+# 日志保留：后台把过期的使用记录 / 任务记录移到归档文件
+log_archiver.start()
+balance_sweeper.start()
 
-# 会话管理：加载已保存的会话数据
-# 格式: {session_id: {"conversation_id": str, "turn_index": int}}
-sessions = load_sessions()
+# 会话管理：所有 worker 共享的会话存储
+# 每个会话: {"conversation_id": str, "turn_index": int, "token_id": int}，另外共享当前默认会话ID（达到对话上限时自动更新）
+session_store = create_session_store(SESSION_DATA_DIR)
 
-# 默认会话ID：当客户端不传递session_id时使用
-DEFAULT_SESSION_ID = "default-session"
+# 未知模型回退使用的默认模型ID（ds3.2）
+DEFAULT_MODEL_ID = "deepseekV3_2"
 
-# 当前默认会话ID（当达到对话上限时会自动更新）
-current_default_session_id = DEFAULT_SESSION_ID
-
-def update_session(session_id, conversation_id, turn_index):
-    """更新会话数据并保存到文件"""
+def update_session(session_id, conversation_id, turn_index, token_id=None):
+    """更新会话数据并追加到会话日志，token_id 为创建/续写该对话的 Token"""
     request_id = getattr(g, 'request_id', 'unknown')
     
     # Log session update operation
     request_logger.logger.info(
         f"[{request_id}] Session update - ID: {session_id}, "
-        f"ConvID: {conversation_id}, Turn: {turn_index}"
+        f"ConvID: {conversation_id}, Turn: {turn_index}, Token: {token_id}"
     )
     
-    old_session = sessions.get(session_id, {})
-    old_conv_id = old_session.get("conversation_id")
-    old_turn = old_session.get("turn_index", 0)
+    old_session = {}
     
-    sessions[session_id] = {
-        "conversation_id": conversation_id,
-        "turn_index": turn_index
-    }
+    def apply(current):
+        old_session.update(current or {})
+        # 其他 worker 已推进同一对话时在其基础上递增，避免轮次回退
+        if current and current["conversation_id"] == conversation_id:
+            return {
+                "conversation_id": conversation_id,
+                "turn_index": max(turn_index, current["turn_index"] + 1),
+                "token_id": token_id or current.get("token_id")
+            }
+        return {"conversation_id": conversation_id, "turn_index": turn_index, "token_id": token_id}
     
     try:
-        save_sessions(sessions)
+        new_session = session_store.update(session_id, apply)
         request_logger.logger.debug(
             f"[{request_id}] Session saved successfully - "
-            f"Changed from ConvID: {old_conv_id}, Turn: {old_turn} "
-            f"to ConvID: {conversation_id}, Turn: {turn_index}"
+            f"Changed from ConvID: {old_session.get('conversation_id')}, Turn: {old_session.get('turn_index', 0)} "
+            f"to ConvID: {conversation_id}, Turn: {new_session['turn_index']}"
         )
     except Exception as e:
         request_logger.logger.error(
@@ -254,28 +257,107 @@ def update_session(session_id, conversation_id, turn_index):
         )
         raise
     
-    print(f"[SESSION] 更新会话: session_id={session_id}, conversation_id={conversation_id}, turn_index={turn_index}")
+    print(f"[SESSION] 更新会话: session_id={session_id}, conversation_id={conversation_id}, turn_index={new_session['turn_index']}")
+
+def finish_session_turn(session_id):
+    """对话结束后递增 turn_index（仅在流中未收到 conversationId 时调用）"""
+    def apply(current):
+        if current is None:
+            return None
+        current["turn_index"] += 1
+        return current
+    
+    new_session = session_store.update(session_id, apply)
+    if new_session:
+        print(f"[SESSION] 对话结束更新turn_index: {new_session['turn_index'] - 1} -> {new_session['turn_index']}")
+
+def rotate_default_session(session_id, request_id, reason):
+    """如果是默认会话，切换到新的默认会话ID并返回新ID，否则原样返回"""
+    current_default_session_id = session_store.get_default_session_id()
+    if session_id != current_default_session_id:
+        return session_id
+    
+    new_default_session_id = session_store.replace_default_session_id(
+        current_default_session_id,
+        f"default-session-{int(time.time())}"
+    )
+    request_logger.logger.info(
+        f"[{request_id}] {reason} - "
+        f"{current_default_session_id} -> {new_default_session_id}"
+    )
+    print(f"[AUTO_NEW] 默认会话切换: {current_default_session_id} -> {new_default_session_id}")
+    return new_default_session_id
 
-# --- OpenAI 格式化辅助函数 ---
-def format_openai_stream_chunk(chat_id, model, content, finish_reason=None):
-    """格式化 OpenAI 兼容的流式响应块"""
-    chunk = {
-        "id": chat_id,
-        "object": "chat.completion.chunk",
-        "created": int(time.time()),
-        "model": model,
-        "choices": [{
-            "index": 0,
-            "delta": {"content": content} if content else {},
-            "finish_reason": finish_reason
-        }]
-    }
-    return f"data: {json.dumps(chunk)}\n\n"
+def resolve_session(provided_session_id, request_id):
+    """
+    解析本次请求使用的会话
+    
+    Returns:
+        (session_id, conversation_id, turn_index, token_id)，conversation_id 为 None 表示新建对话，
+        token_id 为创建该对话的 Token（旧会话或新建对话时为 None）
+    """
+    # 如果客户端不传递session_id，使用当前默认session_id，这样所有请求都在同一会话中
+    if provided_session_id:
+        session_id = provided_session_id
+        request_logger.logger.info(f"[{request_id}] Using provided session ID: {session_id}")
+    else:
+        session_id = session_store.get_default_session_id()
+        request_logger.logger.info(f"[{request_id}] Using default session ID: {session_id}")
+    
+    session_info, _ = session_store.get(session_id)
+    session_info = session_info or {"conversation_id": None, "turn_index": 0}
+    conversation_id = session_info["conversation_id"]
+    turn_index = session_info["turn_index"]
+    token_id = session_info.get("token_id")
+    
+    request_logger.logger.debug(
+        f"[{request_id}] Session state - ID: {session_id}, "
+        f"ConvID: {conversation_id}, Turn: {turn_index}, Token: {token_id}"
+    )
+    
+    # 检测会话是否可能达到上限（turn_index >= 10时自动创建新会话）
+    if conversation_id is not None and turn_index >= 10:
+        request_logger.logger.warning(
+            f"[{request_id}] Session limit reached - Turn index {turn_index} >= 10, "
+            f"creating new session"
+        )
+        print(f"[AUTO_NEW] 会话可能达到上限（turn_index={turn_index}），自动创建新会话")
+        conversation_id = None
+        turn_index = 0
+        session_id = rotate_default_session(session_id, request_id, "Default session rotation")
+    
+    if conversation_id is None:
+        token_id = None
+    
+    return session_id, conversation_id, turn_index, token_id
+
+def resolve_model(model, request_id):
+    """模型兼容性处理：如果模型不在MODEL_MAP中，使用默认模型deepseekV3_2"""
+    if model in MODEL_MAP:
+        request_logger.logger.info(
+            f"[{request_id}] Model validation passed - '{model}' "
+            f"(mapped to {MODEL_MAP.get(model, 'unknown')})"
+        )
+        return model
+    
+    fallback = next((k for k, v in MODEL_MAP.items() if v == DEFAULT_MODEL_ID), "wenxiaobai-deep-thought")
+    request_logger.logger.warning(
+        f"[{request_id}] Model fallback - '{model}' not found, "
+        f"using '{fallback}' (mapped to {MODEL_MAP.get(fallback, 'unknown')})"
+    )
+    print(f"[MODEL] 模型 '{model}' 不存在，自动回退到默认模型 '{DEFAULT_MODEL_ID}'")
+    return fallback
 
-def format_openai_stream_stop_chunk(chat_id, model):
-    """格式化 OpenAI 兼容的流式响应结束块"""
-    return format_openai_stream_chunk(chat_id, model, None, "stop") + "data: [DONE]\n\n"
+def trigger_balance_check(token_info, api_calls_today):
+    """每50次调用请求一次后台余额刷新（余额不足且启用自动任务时由后台执行任务），不阻塞当前请求"""
+    # 启用后台余额巡检时由巡检按调用量安排刷新
+    if balance_sweeper.enabled or api_calls_today % 50 != 0:
+        return
+    
+    if not balance_refresher.request(token_info['id']):
+        request_logger.logger.debug(f"Balance refresh for token {token_info['id']} coalesced")
 
+# --- OpenAI 格式化辅助函数 ---
 def format_openai_non_streaming_response(chat_id, model, content):
     """格式化 OpenAI 兼容的非流式响应"""
     response = {
@@ -359,115 +441,88 @@ def extract_query_from_messages(messages):
     request_logger.logger.warning(f"[{request_id}] Could not extract query from message format")
     return None
 
-@app.route('/v1/chat/completions', methods=['POST'])
-@require_api_key
-def chat_completions_endpoint():
-    """
-    兼容标准 OpenAI 的聊天 API 端点
-    完全符合 OpenAI Chat Completions API 规范
+# --- 聊天请求管线 ---
+# OpenAI 和 Azure 端点（以及异步服务模式）共用同一条管线：
+# 解析模型 -> 选择会话 -> 签名并调用上游 -> 解析事件流 -> 转换 -> 输出
+class ChatPipelineError(Exception):
+    """管线中需要直接以 OpenAI 错误格式返回给客户端的错误"""
+    
+    def __init__(self, status_code, error_type, message, code=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_type = error_type
+        self.message = message
+        self.code = code
+    
+    def to_response(self):
+        return format_openai_error_response(self.error_type, self.message, self.code)
+
+@dataclass
+class ChatContext:
+    """一次聊天请求在管线各阶段之间传递的状态"""
+    request_id: str
+    data: dict
+    model: str
+    query: str
+    stream: bool
+    session_id: str
+    conversation_id: Optional[str]
+    turn_index: int
+    user_info: dict
+    token_info: dict
+    client: object
+    token_lease: Optional[TokenLease] = None
+    
+    def chat_kwargs(self):
+        """调用上游 chat/achat 的会话参数"""
+        return {
+            "model": self.model,
+            "conversation_id": self.conversation_id,
+            "turn_index": self.turn_index,
+            "is_new_conversation": self.conversation_id is None
+        }
+    
+    def release(self):
+        """请求结束：释放占用的 Token（可重复调用）"""
+        if self.token_lease is not None:
+            self.token_lease.release()
+
+def prepare_chat(data, model, user_info, tokens, request_id):
     """
-    global current_default_session_id  # 声明使用全局变量
+    管线第一阶段：解析模型、选择会话、校验消息、调度 Token 并创建用户专用客户端
     
-    # 解析请求
-    data = request.get_json()
-    if not data:
-        return jsonify(format_openai_error_response(
-            "invalid_request_error",
-            "请求体必须是有效的 JSON"
-        )), 400
+    返回的上下文占用了一个 Token，请求结束时需要调用 ctx.release()。
     
-    # 获取参数
-    model = data.get("model", "wenxiaobai-deep-thought")
+    Raises:
+        ChatPipelineError: 请求参数无效，或所有 Token 都已达到并发上限
+    """
     messages = data.get("messages", [])
     stream = data.get("stream", True)
     temperature = data.get("temperature", 1.0)
-    max_tokens = data.get("max_tokens", None)
-    top_p = data.get("top_p", 1.0)
     
     # Log request parameters
-    request_id = getattr(g, 'request_id', 'unknown')
     request_logger.logger.info(
         f"[{request_id}] Chat request parameters - Model: {model}, "
         f"Messages: {len(messages)}, Stream: {stream}, Temp: {temperature}"
     )
     
-    # 模型兼容性处理：如果模型不在MODEL_MAP中，使用默认模型deepseekV3_2
-    DEFAULT_MODEL_ID = "deepseekV3_2"  # 设置默认模型为ds3.2
-    original_model = model
-    if model not in MODEL_MAP:
-        model = next((k for k, v in MODEL_MAP.items() if v == DEFAULT_MODEL_ID), "wenxiaobai-deep-thought")
-        request_logger.logger.warning(
-            f"[{request_id}] Model fallback - '{original_model}' not found, "
-            f"using '{model}' (mapped to {MODEL_MAP.get(model, 'unknown')})"
-        )
-        print(f"[MODEL] 模型 '{original_model}' 不存在，自动回退到默认模型 '{DEFAULT_MODEL_ID}'")
-    else:
-        request_logger.logger.info(
-            f"[{request_id}] Model validation passed - '{model}' "
-            f"(mapped to {MODEL_MAP.get(model, 'unknown')})"
-        )
+    model = resolve_model(model, request_id)
     
     # 会话管理：尝试复用已有会话
-    # 如果客户端不传递session_id，使用当前默认session_id，这样所有请求都在同一会话中
-    provided_session_id = data.get("session_id")
-    if provided_session_id:
-        session_id = provided_session_id
-        request_logger.logger.info(f"[{request_id}] Using provided session ID: {session_id}")
-    else:
-        # 使用当前默认会话ID
-        session_id = current_default_session_id
-        request_logger.logger.info(f"[{request_id}] Using default session ID: {session_id}")
-    
-    session_info = sessions.get(session_id, {"conversation_id": None, "turn_index": 0})
-    conversation_id = session_info["conversation_id"]
-    turn_index = session_info["turn_index"]
-    
-    request_logger.logger.debug(
-        f"[{request_id}] Session state - ID: {session_id}, "
-        f"ConvID: {conversation_id}, Turn: {turn_index}"
-    )
-    
-    # 检测会话是否可能达到上限（turn_index >= 10时自动创建新会话）
-    if conversation_id is not None and turn_index >= 10:
-        request_logger.logger.warning(
-            f"[{request_id}] Session limit reached - Turn index {turn_index} >= 10, "
-            f"creating new session"
-        )
-        print(f"[AUTO_NEW] 会话可能达到上限（turn_index={turn_index}），自动创建新会话")
-        conversation_id = None
-        turn_index = 0
-        
-        # 如果是默认会话，生成新的默认会话ID
-        if session_id == current_default_session_id:
-            new_default_session_id = f"default-session-{int(time.time())}"
-            request_logger.logger.info(
-                f"[{request_id}] Default session rotation - "
-                f"{current_default_session_id} -> {new_default_session_id}"
-            )
-            print(f"[AUTO_NEW] 默认会话切换: {current_default_session_id} -> {new_default_session_id}")
-            current_default_session_id = new_default_session_id
-            session_id = new_default_session_id
-    
-    # 决定是否需要新建会话
-    is_new_conversation = conversation_id is None
+    session_id, conversation_id, turn_index, pinned_token_id = resolve_session(data.get("session_id"), request_id)
     
     request_logger.logger.info(
         f"[{request_id}] Session decision - ID: {session_id}, "
-        f"ConvID: {conversation_id}, Turn: {turn_index}, New: {is_new_conversation}"
+        f"ConvID: {conversation_id}, Turn: {turn_index}, New: {conversation_id is None}"
     )
     
-    print(f"[REQUEST] 收到请求: session_id={session_id}, conversation_id={conversation_id}, turn_index={turn_index}, is_new={is_new_conversation}, model={model}")
+    print(f"[REQUEST] 收到请求: session_id={session_id}, conversation_id={conversation_id}, turn_index={turn_index}, is_new={conversation_id is None}, model={model}")
     
     # 验证消息
     if not messages:
         error_msg = "请求中缺少 'messages' 字段"
-        request_logger.logger.error(
-            f"[{request_id}] Validation error - {error_msg}"
-        )
-        return jsonify(format_openai_error_response(
-            "invalid_request_error",
-            error_msg
-        )), 400
+        request_logger.logger.error(f"[{request_id}] Validation error - {error_msg}")
+        raise ChatPipelineError(400, "invalid_request_error", error_msg)
     
     # 提取查询内容
     query = extract_query_from_messages(messages)
@@ -477,344 +532,291 @@ def chat_completions_endpoint():
             f"[{request_id}] Query extraction error - {error_msg}, "
             f"Messages format: {type(messages)}, Count: {len(messages)}"
         )
-        return jsonify(format_openai_error_response(
-            "invalid_request_error",
-            error_msg
-        )), 400
+        raise ChatPipelineError(400, "invalid_request_error", error_msg)
+    
+    # 按调度策略从用户的多个token中选择一个；续写对话时优先使用创建该对话的token
+    # 绑定的token满载时会短暂等待，仍满载则返回 429，不换token丢失对话上下文
+    token_lease = token_scheduler.acquire(user_info['user_id'], tokens, preferred_id=pinned_token_id)
+    if token_lease is None:
+        if pinned_token_id is not None and any(token['id'] == pinned_token_id for token in tokens):
+            request_logger.logger.warning(
+                f"[{request_id}] Pinned token busy - Token: {pinned_token_id}, User: {user_info['user_id']}"
+            )
+            raise ChatPipelineError(429, "rate_limit_error", "当前对话使用的 Token 已达到并发上限，请稍后重试", "tokens_busy")
+        request_logger.logger.warning(f"[{request_id}] All tokens busy - User: {user_info['user_id']}")
+        raise ChatPipelineError(429, "rate_limit_error", "所有 Token 均已达到并发上限，请稍后重试", "tokens_busy")
+    token_info = dict(token_lease.token_info)
     
-    try:
-        # 使用用户的token创建客户端
-        user_token = g.token_info['token']
-        user_device_id = g.token_info['device_id'] or device_id
-        
-        # 创建用户专用的API客户端
-        user_client = create_wenxiaobai_client(
-            username=api_username,
-            secret_key=api_secret_key,
-            access_token=user_token,
-            device_id=user_device_id
-        )
-        
-        # 调用 API，传递 conversation_id 和 turn_index（会话复用逻辑在客户端处理）
-        # is_new_conversation 决定是否新建对话
-        api_call_id = api_debug_logger.log_api_call_parameters(
-            model=model,
-            query=query,
-            conversation_id=conversation_id,
-            abilities=MODEL_ABILITIES.get(model, {}).get("abilities", []),
-            request_id=request_id,
-            turn_index=turn_index,
-            is_new_conversation=is_new_conversation
+    # 绑定的token已被禁用或删除：对话属于创建它的上游账号，换了token后直接新建对话，避免先收到一次 400 再重试
+    if pinned_token_id is not None and token_info['id'] != pinned_token_id:
+        request_logger.logger.warning(
+            f"[{request_id}] Pinned token disabled or deleted - Token: {pinned_token_id}, "
+            f"using {token_info['id']} with a new conversation"
         )
-        
-        print(f"[API] 调用文小白API: query='{query[:50]}...', model={model}, conversation_id={conversation_id}, turn_index={turn_index}, is_new_conversation={is_new_conversation}")
-        
+        print(f"[SESSION] 对话绑定的Token {pinned_token_id} 已被禁用或删除，使用Token {token_info['id']} 新建对话")
+        conversation_id = None
+        turn_index = 0
+    
+    # 使用选中的token创建用户专用的API客户端
+    client = create_wenxiaobai_client(
+        username=api_username,
+        secret_key=api_secret_key,
+        access_token=token_info['token'],
+        device_id=token_info['device_id'] or device_id
+    )
+    
+    return ChatContext(
+        request_id=request_id,
+        data=data,
+        model=model,
+        query=query,
+        stream=stream,
+        session_id=session_id,
+        conversation_id=conversation_id,
+        turn_index=turn_index,
+        user_info=user_info,
+        token_info=token_info,
+        client=client,
+        token_lease=token_lease
+    )
+
+def log_upstream_call(ctx):
+    """记录上游调用参数"""
+    api_debug_logger.log_api_call_parameters(
+        model=ctx.model,
+        query=ctx.query,
+        conversation_id=ctx.conversation_id,
+        abilities=MODEL_ABILITIES.get(ctx.model, {}).get("abilities", []),
+        request_id=ctx.request_id,
+        turn_index=ctx.turn_index,
+        is_new_conversation=ctx.conversation_id is None
+    )
+    print(f"[API] 调用文小白API: query='{ctx.query[:50]}...', model={ctx.model}, conversation_id={ctx.conversation_id}, turn_index={ctx.turn_index}, is_new_conversation={ctx.conversation_id is None}")
+
+def log_upstream_response(ctx, response, timing, retried):
+    """记录上游响应；无响应时抛出 ChatPipelineError"""
+    print(f"[{'RETRY' if retried else 'API'}] API响应状态: {response.status_code if response else 'None'}")
+    
+    if response is None:
+        error_msg = "API 重试请求失败，无响应" if retried else "API 请求失败，无响应"
+        api_debug_logger.log_api_error(error_details=error_msg, request_id=ctx.request_id)
+        request_logger.logger.error(f"[{ctx.request_id}] {error_msg}")
+        raise ChatPipelineError(502, "api_error", error_msg)
+    
+    api_debug_logger.log_api_response(
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        request_id=ctx.request_id,
+        timing=timing
+    )
+
+def record_usage(ctx):
+    """记录使用情况和API调用计数（后台批量写入），并按调用次数触发余额检查"""
+    usage_writer.log_usage(
+        user_id=ctx.user_info['user_id'],
+        api_key_id=ctx.user_info['api_key_id'],
+        token_id=ctx.token_info['id'],
+        model=ctx.model,
+        request_id=ctx.request_id
+    )
+    
+    # 增加API调用计数（启用余额巡检时不使用当天调用次数，不读取已提交的次数）
+    api_calls_today = usage_writer.increment_api_calls(ctx.token_info['id'], return_count=not balance_sweeper.enabled)
+    
+    # 检查是否需要触发任务系统
+    trigger_balance_check(ctx.token_info, api_calls_today)
+
+def handle_upstream_error(ctx, status_code, error_details, retried):
+    """
+    处理上游非 200 响应
+    
+    对话上限（400）且尚未重试时切换到新会话并返回，由调用方重新请求；
+    其余情况抛出 ChatPipelineError。
+    """
+    api_debug_logger.log_api_error(
+        error_details=f"API {'retry failed with' if retried else 'returned'} status {status_code}: {error_details}",
+        status_code=status_code,
+        request_id=ctx.request_id
+    )
+    request_logger.logger.error(
+        f"[{ctx.request_id}] API {'retry ' if retried else ''}error - Status: {status_code}, "
+        f"Details: {error_details[:200]}..."
+    )
+    print(f"[ERROR] API返回错误: status={status_code}, details={error_details[:500]}")
+    
+    # 检查是否为对话上限错误，如果是则新建会话重试
+    if status_code != 400 or ctx.conversation_id is None or retried:
+        raise ChatPipelineError(502, "api_error", f"上游 API 返回错误: {status_code}", str(status_code))
+    
+    request_logger.logger.warning(
+        f"[{ctx.request_id}] Detected conversation limit error, attempting retry with new session"
+    )
+    print(f"[RETRY] 检测到400错误（对话上限），尝试新建会话重试...")
+    
+    # 如果是默认会话，生成新的默认会话ID；重置会话，新建对话
+    ctx.session_id = rotate_default_session(ctx.session_id, ctx.request_id, "Session limit retry")
+    ctx.conversation_id = None
+    ctx.turn_index = 0
+
+def check_event_stream(response):
+    """检查上游是否返回事件流"""
+    if 'text/event-stream' not in response.headers.get('Content-Type', ''):
+        raise ChatPipelineError(502, "api_error", "上游 API 未返回事件流", "invalid_content_type")
+
+def call_upstream(ctx):
+    """管线第二阶段：签名并调用上游（含对话上限时的一次重试），返回事件流响应"""
+    log_upstream_call(ctx)
+    
+    retried = False
+    while True:
         start_time = time.time()
-        response = user_client.chat(
-            query,
-            model=model,
-            conversation_id=conversation_id,
-            turn_index=turn_index,
-            is_new_conversation=is_new_conversation
-        )
+        response = ctx.client.chat(ctx.query, **ctx.chat_kwargs())
         api_timing = time.time() - start_time
         
-        # 记录使用情况和API调用计数
-        db.log_usage(
-            user_id=g.user_info['user_id'],
-            api_key_id=g.user_info['api_key_id'],
-            token_id=g.token_info['id'],
-            model=model,
-            request_id=request_id
-        )
+        if not retried:
+            record_usage(ctx)
+        log_upstream_response(ctx, response, api_timing, retried)
         
-        # 增加API调用计数
-        api_calls_today = db.increment_api_calls(g.token_info['id'])
+        if response.status_code == 200:
+            break
         
-        # 检查是否需要触发任务系统
-        if api_calls_today % 50 == 0:  # 每50次调用检查一次
-            from task_system import task_system
-            from balance_checker import balance_checker
+        error_details = response.text if response.text else "无错误详情"
+        response.close()
+        handle_upstream_error(ctx, response.status_code, error_details, retried)
+        retried = True
+    
+    try:
+        check_event_stream(response)
+    except ChatPipelineError:
+        response.close()
+        raise
+    return response
+
+def iter_chat_content(ctx, payloads):
+    """
+    管线第三阶段：从上游载荷中逐个产出 content，收到 conversationId 时更新会话
+    
+    读取出错或客户端断开时也会在结束前更新 turn_index，出错时随后重新抛出异常。
+    """
+    received_conversation_id = False
+    error = None
+    
+    try:
+        for payload in payloads:
+            conv_id, content = extract_event_fields(payload)
             
-            # 检查余额
-            balance_result = balance_checker.check_balance(
-                g.token_info['token'], 
-                g.token_info['device_id']
-            )
+            # 从事件中提取 conversationId
+            if conv_id and not received_conversation_id:
+                print(f"[STREAM] 收到conversationId: {conv_id}")
+                # 更新会话信息（使用当前 turn_index + 1，因为这是新的对话轮次）
+                update_session(ctx.session_id, conv_id, ctx.turn_index + 1, ctx.token_info['id'])
+                received_conversation_id = True
             
-            if balance_result and balance_result.get('success'):
-                current_balance = balance_result.get('suanli_balance', 0)
-                db.update_token_balance(g.token_info['id'], current_balance)
-                
-                # 如果余额低于10且启用了自动任务
-                tokens = db.get_user_tokens(g.user_info['user_id'])
-                token_info = next((t for t in tokens if t['id'] == g.token_info['id']), None)
-                
-                if (token_info and token_info.get('auto_task_enabled') and 
-                    current_balance < 10):
-                    
-                    logger.info(f"Triggering auto tasks for token {g.token_info['id']} due to low balance: {current_balance}")
-                    
-                    # 异步执行任务（避免阻塞API响应）
-                    import threading
-                    def run_tasks():
-                        try:
-                            task_result = task_system.auto_complete_tasks_for_token(token_info)
-                            if task_result.get('success'):
-                                logger.info(f"Auto tasks completed for token {g.token_info['id']}: {task_result.get('task_count')} tasks, {task_result.get('total_rewards')} rewards")
-                        except Exception as e:
-                            logger.error(f"Auto task execution failed for token {g.token_info['id']}: {e}")
-                    
-                    threading.Thread(target=run_tasks, daemon=True).start()
-        
-        print(f"[API] API响应状态: {response.status_code if response else 'None'}")
-        
-        if response is None:
-            error_msg = "API 请求失败，无响应"
-            api_debug_logger.log_api_error(
-                error_details=error_msg,
-                request_id=request_id
-            )
-            request_logger.logger.error(f"[{request_id}] {error_msg}")
-            return jsonify(format_openai_error_response(
-                "api_error",
-                error_msg
-            )), 502
-        
-        # Log API response
-        api_debug_logger.log_api_response(
-            status_code=response.status_code,
-            headers=dict(response.headers),
-            request_id=request_id,
-            timing=api_timing
-        )
-        
-        # 检查响应状态
-        if response.status_code != 200:
-            error_details = response.text if response.text else "无错误详情"
-            api_debug_logger.log_api_error(
-                error_details=f"API returned status {response.status_code}: {error_details}",
-                status_code=response.status_code,
-                request_id=request_id
-            )
-            request_logger.logger.error(
-                f"[{request_id}] API error - Status: {response.status_code}, "
-                f"Details: {error_details[:200]}..."
-            )
-            print(f"[ERROR] API返回错误: status={response.status_code}, details={error_details[:500]}")
-            
-            # 检查是否为对话上限错误，如果是则尝试新建会话重试
-            if response.status_code == 400 and conversation_id is not None:
-                request_logger.logger.warning(
-                    f"[{request_id}] Detected conversation limit error, attempting retry with new session"
-                )
-                print(f"[RETRY] 检测到400错误（对话上限），尝试新建会话重试...")
-                
-                # 如果是默认会话，生成新的默认会话ID
-                if session_id == current_default_session_id:
-                    new_default_session_id = f"default-session-{int(time.time())}"
-                    request_logger.logger.info(
-                        f"[{request_id}] Session limit retry - "
-                        f"{current_default_session_id} -> {new_default_session_id}"
-                    )
-                    print(f"[RETRY] 默认会话达到上限，切换到新会话: {current_default_session_id} -> {new_default_session_id}")
-                    current_default_session_id = new_default_session_id
-                    session_id = new_default_session_id
-                
-                # 重置会话，新建对话
-                conversation_id = None
-                turn_index = 0
-                
-                # Retry API call
-                retry_start_time = time.time()
-                response = client.chat(
-                    query,
-                    model=deployment_name,
-                    conversation_id=None,
-                    turn_index=0,
-                    is_new_conversation=True
-                )
-                retry_timing = time.time() - retry_start_time
-                
-                print(f"[RETRY] 重试后状态: {response.status_code if response else 'None'}")
-                
-                if response is None:
-                    error_msg = "API 重试请求失败，无响应"
-                    api_debug_logger.log_api_error(
-                        error_details=error_msg,
-                        request_id=request_id
-                    )
-                    request_logger.logger.error(f"[{request_id}] {error_msg}")
-                    return jsonify(format_openai_error_response(
-                        "api_error",
-                        error_msg
-                    )), 502
-                
-                # Log retry response
-                api_debug_logger.log_api_response(
-                    status_code=response.status_code,
-                    headers=dict(response.headers),
-                    request_id=request_id,
-                    timing=retry_timing
-                )
-                
-                if response.status_code != 200:
-                    retry_error = response.text if response.text else "无错误详情"
-                    api_debug_logger.log_api_error(
-                        error_details=f"API retry failed with status {response.status_code}: {retry_error}",
-                        status_code=response.status_code,
-                        request_id=request_id
-                    )
-                    request_logger.logger.error(
-                        f"[{request_id}] API retry failed - Status: {response.status_code}"
-                    )
-                    return jsonify(format_openai_error_response(
-                        "api_error",
-                        f"上游 API 返回错误: {response.status_code}",
-                        str(response.status_code)
-                    )), 502
-            else:
-                return jsonify(format_openai_error_response(
-                    "api_error",
-                    f"上游 API 返回错误: {response.status_code}",
-                    str(response.status_code)
-                )), 502
-        
-        # 检查内容类型
-        content_type = response.headers.get('Content-Type', '')
-        if 'text/event-stream' not in content_type:
-            return jsonify(format_openai_error_response(
-                "api_error",
-                "上游 API 未返回事件流",
-                "invalid_content_type"
-            )), 502
+            if content:
+                yield content
+    except Exception as e:
+        error = e
+    finally:
+        # 对话结束后更新 turn_index（如果还没更新）
+        if not received_conversation_id:
+            finish_session_turn(ctx.session_id)
+    
+    if error is not None:
+        raise error
+
+def record_cancel(ctx, chunks_sent):
+    """客户端中途断开：记录到会话日志，并把使用记录标记为 cancelled"""
+    request_logger.logger.warning(
+        f"[{ctx.request_id}] Client disconnected - upstream stream aborted, "
+        f"Session: {ctx.session_id}, Chunks sent: {chunks_sent}"
+    )
+    print(f"[CANCEL] 客户端断开连接，已中止上游流: session_id={ctx.session_id}, chunks_sent={chunks_sent}")
+    
+    try:
+        usage_writer.update_usage_status(ctx.request_id, 'cancelled')
+    except Exception as e:
+        request_logger.logger.error(f"[{ctx.request_id}] Failed to record cancel: {e}")
+
+def stream_chat_frames(ctx, response):
+    """管线输出阶段（流式）：合并 content 增量并编码为 OpenAI chunk 帧"""
+    encoder = OpenAIStreamEncoder(f"chatcmpl-{uuid.uuid4()}", ctx.model)
+    coalescer = create_coalescer(ctx.data, ctx.user_info)
+    contents = iter_chat_content(ctx, iter_sse_payloads(response.iter_content(chunk_size=None)))
+    chunks_sent = 0
+    
+    try:
+        for content in contents:
+            merged = coalescer.push(content)
+            if merged:
+                chunks_sent += 1
+                yield encoder.encode_content(merged)
+    except GeneratorExit:
+        # WSGI 服务器写入失败（客户端断开）时关闭生成器：立即关闭上游响应，不再继续读取
+        response.close()
+        contents.close()
+        record_cancel(ctx, chunks_sent)
+        raise
+    except Exception as e:
+        print(f"[ERROR] 流式响应生成器错误: {e}")
+        import traceback
+        traceback.print_exc()
+    finally:
+        response.close()
+        ctx.release()
+    
+    # 输出合并缓冲区中剩余的内容并发送结束标记
+    tail = coalescer.flush()
+    if tail:
+        yield encoder.encode_content(tail)
+    yield encoder.encode_stop()
+
+def collect_chat_response(ctx, response):
+    """管线输出阶段（非流式）：收集所有内容并返回完整响应"""
+    try:
+        payloads = iter_sse_payloads(response.iter_content(chunk_size=None))
+        content = ''.join(iter_chat_content(ctx, payloads))
+    finally:
+        response.close()
+        ctx.release()
+    
+    return format_openai_non_streaming_response(f"chatcmpl-{uuid.uuid4()}", ctx.model, content)
+
+def run_chat_pipeline(data, model):
+    """同步端点共用的管线入口，返回 Flask 响应"""
+    request_id = getattr(g, 'request_id', 'unknown')
+    
+    if not data:
+        return jsonify(format_openai_error_response(
+            "invalid_request_error",
+            "请求体必须是有效的 JSON"
+        )), 400
+    
+    ctx = None
+    try:
+        ctx = prepare_chat(data, model, g.user_info, g.tokens, request_id)
+        response = call_upstream(ctx)
         
         # 根据 stream 参数决定返回流式响应还是非流式响应
-        if stream:
-            # 生成流式响应
-            def generate_stream():
-                chat_id = f"chatcmpl-{uuid.uuid4()}"
-                received_conversation_id = False
-                current_turn_index = turn_index
-                
-                try:
-                    for line_bytes in response.iter_lines():
-                        if line_bytes:
-                            line = line_bytes.decode('utf-8')
-                            
-                            # 处理 SSE 事件格式
-                            if line.startswith('event:'):
-                                current_event = line[6:].strip()
-                                continue
-                            
-                            if line.startswith('data:'):
-                                json_str = line[5:].strip()
-                                
-                                # 跳过空行和 [DONE]
-                                if not json_str or json_str == '[DONE]':
-                                    continue
-                                
-                                try:
-                                    event_data = json.loads(json_str)
-                                    
-                                    # 调试：打印所有事件数据
-                                    if any(key in event_data for key in ['conversationId', 'conversationId', 'id']):
-                                        print(f"[DEBUG] Event data: {json.dumps(event_data, ensure_ascii=False)[:200]}")
-                                    
-                                    # 从事件中提取 conversationId（尝试多种可能的字段名）
-                                    conv_id = event_data.get('conversationId') or event_data.get('conversationId') or event_data.get('id')
-                                    if conv_id and not received_conversation_id:
-                                        print(f"[STREAM] 收到conversationId: {conv_id}")
-                                        if conv_id:
-                                            # 更新会话信息（使用当前 turn_index + 1，因为这是新的对话轮次）
-                                            current_turn_index += 1
-                                            update_session(session_id, conv_id, current_turn_index)
-                                        received_conversation_id = True
-                                    
-                                    content = event_data.get('content')
-                                    
-                                    if isinstance(content, str) and content:
-                                        yield format_openai_stream_chunk(chat_id, model, content)
-                                except json.JSONDecodeError:
-                                    continue
-                                except Exception:
-                                    continue
-                except Exception as e:
-                    print(f"[ERROR] 流式响应生成器错误: {e}")
-                    import traceback
-                    traceback.print_exc()
-                
-                # 对话结束后更新 turn_index（如果还没更新）
-                if session_id in sessions and not received_conversation_id:
-                    old_turn = sessions[session_id]["turn_index"]
-                    sessions[session_id]["turn_index"] += 1
-                    save_sessions(sessions)
-                    print(f"[SESSION] 对话结束更新turn_index: {old_turn} -> {sessions[session_id]['turn_index']}")
-                
-                # 发送结束标记
-                yield format_openai_stream_stop_chunk(chat_id, model)
-            
-            return Response(generate_stream(), content_type='text/event-stream')
-        else:
-            # 非流式响应：收集所有内容并返回完整响应
-            chat_id = f"chatcmpl-{uuid.uuid4()}"
-            full_content = []
-            received_conversation_id = False
-            current_turn_index = turn_index  # 保存当前 turn_index 用于更新
-            
-            for line_bytes in response.iter_lines():
-                if line_bytes:
-                    line = line_bytes.decode('utf-8')
-                    
-                    # 处理 SSE 事件格式
-                    if line.startswith('event:'):
-                        continue
-                    
-                    if line.startswith('data:'):
-                        json_str = line[5:].strip()
-                        
-                        # 跳过空行和 [DONE]
-                        if not json_str or json_str == '[DONE]':
-                            continue
-                        
-                        try:
-                            event_data = json.loads(json_str)
-                            
-                            # 从事件中提取 conversationId
-                            if 'conversationId' in event_data and not received_conversation_id:
-                                new_conversation_id = event_data['conversationId']
-                                if new_conversation_id:
-                                    # 更新会话信息
-                                    current_turn_index += 1
-                                    update_session(session_id, new_conversation_id, current_turn_index)
-                                received_conversation_id = True
-                            
-                            content = event_data.get('content')
-                            
-                            if isinstance(content, str) and content:
-                                full_content.append(content)
-                        except json.JSONDecodeError:
-                            continue
-                        except Exception:
-                            continue
-            
-            # 对话结束后更新 turn_index（如果还没更新）
-            if session_id in sessions and not received_conversation_id:
-                sessions[session_id]["turn_index"] += 1
-                save_sessions(sessions)
-            
-            # 组合所有内容
-            complete_response = format_openai_non_streaming_response(
-                chat_id, 
-                model, 
-                ''.join(full_content)
+        if ctx.stream:
+            stream_response = Response(
+                stream_with_context(stream_chat_frames(ctx, response)),
+                content_type='text/event-stream; charset=utf-8'
             )
-            
-            return jsonify(complete_response)
+            # WSGI 服务器关闭响应时释放 Token（客户端在首帧前断开时生成器不会执行）
+            stream_response.call_on_close(ctx.release)
+            return stream_response
+        return jsonify(collect_chat_response(ctx, response))
+    
+    except ChatPipelineError as e:
+        if ctx is not None:
+            ctx.release()
+        return jsonify(e.to_response()), e.status_code
     
     except Exception as e:
+        if ctx is not None:
+            ctx.release()
+        
         # Enhanced error logging with correlation ID
-        request_id = getattr(g, 'request_id', 'unknown')
         api_debug_logger.log_api_error(
             error_details=f"Internal server error: {str(e)}",
             request_id=request_id,
@@ -837,6 +839,16 @@ def chat_completions_endpoint():
             request_id
         )), 500
 
+@app.route('/v1/chat/completions', methods=['POST'])
+@require_api_key
+def chat_completions_endpoint():
+    """
+    兼容标准 OpenAI 的聊天 API 端点
+    完全符合 OpenAI Chat Completions API 规范
+    """
+    data = request.get_json()
+    return run_chat_pipeline(data, (data or {}).get("model", "wenxiaobai-deep-thought"))
+
 @app.route('/v1/deployments/<deployment_name>/chat/completions', methods=['POST'])
 @require_api_key
 def azure_chat_completions_endpoint(deployment_name):
@@ -844,270 +856,7 @@ def azure_chat_completions_endpoint(deployment_name):
     兼容 Azure OpenAI 的聊天 API 端点
     完全符合 Azure OpenAI Chat Completions API 规范
     """
-    global current_default_session_id  # 声明使用全局变量
-    
-    # 解析请求
-    data = request.get_json()
-    if not data:
-        return jsonify(format_openai_error_response(
-            "invalid_request_error",
-            "请求体必须是有效的 JSON"
-        )), 400
-    
-    # 获取参数
-    messages = data.get("messages", [])
-    stream = data.get("stream", True)
-    temperature = data.get("temperature", 1.0)
-    max_tokens = data.get("max_tokens", None)
-    top_p = data.get("top_p", 1.0)
-    
-    # 模型兼容性处理：如果模型不在MODEL_MAP中，使用默认模型deepseekV3_2
-    DEFAULT_MODEL_ID = "deepseekV3_2"  # 设置默认模型为ds3.2
-    if deployment_name not in MODEL_MAP:
-        print(f"[MODEL] 部署名称 '{deployment_name}' 不存在，自动回退到默认模型 '{DEFAULT_MODEL_ID}'")
-        deployment_name = next((k for k, v in MODEL_MAP.items() if v == DEFAULT_MODEL_ID), "wenxiaobai-deep-thought")
-    
-    # 会话管理：尝试复用已有会话
-    # 如果客户端不传递session_id，使用当前默认session_id，这样所有请求都在同一会话中
-    provided_session_id = data.get("session_id")
-    if provided_session_id:
-        session_id = provided_session_id
-    else:
-        # 使用当前默认会话ID
-        session_id = current_default_session_id
-    
-    session_info = sessions.get(session_id, {"conversation_id": None, "turn_index": 0})
-    conversation_id = session_info["conversation_id"]
-    turn_index = session_info["turn_index"]
-    
-    # 检测会话是否可能达到上限（turn_index >= 10时自动创建新会话）
-    if conversation_id is not None and turn_index >= 10:
-        print(f"[AUTO_NEW] 会话可能达到上限（turn_index={turn_index}），自动创建新会话")
-        conversation_id = None
-        turn_index = 0
-        
-        # 如果是默认会话，生成新的默认会话ID
-        if session_id == current_default_session_id:
-            new_default_session_id = f"default-session-{int(time.time())}"
-            print(f"[AUTO_NEW] 默认会话切换: {current_default_session_id} -> {new_default_session_id}")
-            current_default_session_id = new_default_session_id
-            session_id = new_default_session_id
-    
-    # 决定是否需要新建会话
-    is_new_conversation = conversation_id is None
-    
-    # 验证消息
-    if not messages:
-        return jsonify(format_openai_error_response(
-            "invalid_request_error",
-            "请求中缺少 'messages' 字段"
-        )), 400
-    
-    # 提取查询内容
-    query = extract_query_from_messages(messages)
-    if not query:
-        return jsonify(format_openai_error_response(
-            "invalid_request_error",
-            "无法从消息中提取有效的查询内容"
-        )), 400
-    
-    try:
-        # 使用用户的token创建客户端
-        user_token = g.token_info['token']
-        user_device_id = g.token_info['device_id'] or device_id
-        
-        # 创建用户专用的API客户端
-        user_client = create_wenxiaobai_client(
-            username=api_username,
-            secret_key=api_secret_key,
-            access_token=user_token,
-            device_id=user_device_id
-        )
-        
-        # 调用 API，传递 conversation_id 和 turn_index（会话复用逻辑在客户端处理）
-        response = user_client.chat(
-            query,
-            model=deployment_name,
-            conversation_id=conversation_id,
-            turn_index=turn_index,
-            is_new_conversation=is_new_conversation
-        )
-        
-        if response is None:
-            return jsonify(format_openai_error_response(
-                "api_error",
-                "API 请求失败，无响应"
-            )), 502
-        
-        # 检查响应状态
-        if response.status_code != 200:
-            error_details = response.text if response.text else "无错误详情"
-            
-            # 检查是否为对话上限错误，如果是则尝试新建会话重试
-            if response.status_code == 400 and conversation_id is not None:
-                print(f"[RETRY] 检测到400错误（对话上限），尝试新建会话重试...")
-                
-                # 如果是默认会话，生成新的默认会话ID
-                if session_id == current_default_session_id:
-                    new_default_session_id = f"default-session-{int(time.time())}"
-                    print(f"[RETRY] 默认会话达到上限，切换到新会话: {current_default_session_id} -> {new_default_session_id}")
-                    current_default_session_id = new_default_session_id
-                    session_id = new_default_session_id
-                
-                # 重置会话，新建对话
-                conversation_id = None
-                turn_index = 0
-                response = user_client.chat(
-                    query,
-                    model=deployment_name,
-                    conversation_id=None,
-                    turn_index=0,
-                    is_new_conversation=True
-                )
-                
-                if response is None:
-                    return jsonify(format_openai_error_response(
-                        "api_error",
-                        "API 请求失败，无响应"
-                    )), 502
-                
-                if response.status_code != 200:
-                    return jsonify(format_openai_error_response(
-                        "api_error",
-                        f"上游 API 返回错误: {response.status_code}",
-                        str(response.status_code)
-                    )), 502
-            else:
-                return jsonify(format_openai_error_response(
-                    "api_error",
-                    f"上游 API 返回错误: {response.status_code}",
-                    str(response.status_code)
-                )), 502
-        
-        # 检查内容类型
-        content_type = response.headers.get('Content-Type', '')
-        if 'text/event-stream' not in content_type:
-            return jsonify(format_openai_error_response(
-                "api_error",
-                "上游 API 未返回事件流",
-                "invalid_content_type"
-            )), 502
-        
-        # 根据 stream 参数决定返回流式响应还是非流式响应
-        if stream:
-            # 生成流式响应
-            def generate_stream():
-                chat_id = f"chatcmpl-{uuid.uuid4()}"
-                received_conversation_id = False
-                current_turn_index = turn_index  # 保存当前 turn_index 用于更新
-                
-                for line_bytes in response.iter_lines():
-                    if line_bytes:
-                        line = line_bytes.decode('utf-8')
-                        
-                        # 处理 SSE 事件格式
-                        if line.startswith('event:'):
-                            continue
-                        
-                        if line.startswith('data:'):
-                            json_str = line[5:].strip()
-                            
-                            # 跳过空行和 [DONE]
-                            if not json_str or json_str == '[DONE]':
-                                continue
-                            
-                            try:
-                                event_data = json.loads(json_str)
-                                
-                                # 从事件中提取 conversationId
-                                if 'conversationId' in event_data and not received_conversation_id:
-                                    new_conversation_id = event_data['conversationId']
-                                    if new_conversation_id:
-                                        # 更新会话信息
-                                        current_turn_index += 1
-                                        update_session(session_id, new_conversation_id, current_turn_index)
-                                    received_conversation_id = True
-                                
-                                content = event_data.get('content')
-                                
-                                if isinstance(content, str) and content:
-                                    yield format_openai_stream_chunk(chat_id, deployment_name, content)
-                            except json.JSONDecodeError:
-                                continue
-                            except Exception:
-                                continue
-                
-                # 对话结束后更新 turn_index（如果还没更新）
-                if session_id in sessions and not received_conversation_id:
-                    sessions[session_id]["turn_index"] += 1
-                    save_sessions(sessions)
-                
-                # 发送结束标记
-                yield format_openai_stream_stop_chunk(chat_id, deployment_name)
-            
-            return Response(generate_stream(), content_type='text/event-stream')
-        else:
-            # 非流式响应：收集所有内容并返回完整响应
-            chat_id = f"chatcmpl-{uuid.uuid4()}"
-            full_content = []
-            received_conversation_id = False
-            current_turn_index = turn_index  # 保存当前 turn_index 用于更新
-            
-            for line_bytes in response.iter_lines():
-                if line_bytes:
-                    line = line_bytes.decode('utf-8')
-                    
-                    # 处理 SSE 事件格式
-                    if line.startswith('event:'):
-                        continue
-                    
-                    if line.startswith('data:'):
-                        json_str = line[5:].strip()
-                        
-                        # 跳过空行和 [DONE]
-                        if not json_str or json_str == '[DONE]':
-                            continue
-                        
-                        try:
-                            event_data = json.loads(json_str)
-                            
-                            # 从事件中提取 conversationId
-                            if 'conversationId' in event_data and not received_conversation_id:
-                                new_conversation_id = event_data['conversationId']
-                                if new_conversation_id:
-                                    # 更新会话信息
-                                    current_turn_index += 1
-                                    update_session(session_id, new_conversation_id, current_turn_index)
-                                received_conversation_id = True
-                            
-                            content = event_data.get('content')
-                            
-                            if isinstance(content, str) and content:
-                                full_content.append(content)
-                        except json.JSONDecodeError:
-                            continue
-                        except Exception:
-                            continue
-            
-            # 对话结束后更新 turn_index（如果还没更新）
-            if session_id in sessions and not received_conversation_id:
-                sessions[session_id]["turn_index"] += 1
-                save_sessions(sessions)
-            
-            # 组合所有内容
-            complete_response = format_openai_non_streaming_response(
-                chat_id,
-                deployment_name,
-                ''.join(full_content)
-            )
-            
-            return jsonify(complete_response)
-    
-    except Exception as e:
-        return jsonify(format_openai_error_response(
-            "internal_server_error",
-            f"内部服务器错误: {str(e)}"
-        )), 500
+    return run_chat_pipeline(request.get_json(), deployment_name)
 
 @app.route('/v1/models', methods=['GET'])
 def list_models():
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+会话日志（journal）持久化模块
+
+每次会话更新只向 sessions.journal 追加一行紧凑记录，持久化开销与会话总数无关；
+记录数超过阈值时在后台线程中压缩：把快照 sessions.json 与日志合并成新快照，然后清空日志。
+启动时读取快照并重放日志即可恢复全部会话；压缩时丢弃空闲超过 idle_ttl 秒的会话，
+并只保留最近更新的 max_entries 个会话。
+
+多个 worker 进程共享同一组文件：追加使用 O_APPEND 并持有共享文件锁，
+压缩持有排他锁，并基于磁盘上的快照 + 日志重建，不会丢失其他进程写入的记录。
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，仅保证单进程内的一致性
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 日志记录数超过该值后触发后台压缩
+SESSION_JOURNAL_COMPACT_EVERY = int(os.environ.get("SESSION_JOURNAL_COMPACT_EVERY", 10000))
+
+
+class SessionJournal:
+    """
+    追加写入的会话日志
+
+    日志每行一条记录：["session_id", "conversation_id", turn_index, updated_at, token_id]，
+    重放时后出现的记录覆盖先出现的记录；进程崩溃导致的不完整末行会被忽略。
+    idle_ttl / max_entries 为 0 表示不限制。
+    """
+
+    def __init__(self, data_dir: str, compact_every: int = SESSION_JOURNAL_COMPACT_EVERY,
+                 idle_ttl: float = 0, max_entries: int = 0):
+        self.snapshot_file = os.path.join(data_dir, "sessions.json")
+        self.journal_file = os.path.join(data_dir, "sessions.journal")
+        self.lock_file = os.path.join(data_dir, "sessions.lock")
+        self.compact_every = compact_every
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._journal = None
+        self._lock_fd = None
+        self._records = 0
+        self._compacting = False
+
+    def load(self) -> Dict[str, Dict]:
+        """
+        读取快照并重放日志
+
+        Returns:
+            {session_id: {"conversation_id": str, "turn_index": int, "token_id": int, "updated_at": int}}
+        """
+        with self._lock, self._file_lock(exclusive=True):
+            sessions, records = self._read_state()
+            self._terminate_torn_line()
+        self._records = records
+        logger.info(f"Loaded {len(sessions)} sessions (replayed {records} journal records)")
+        return sessions
+
+    def append(self, session_id: str, session_info: Dict):
+        """追加一条会话更新记录"""
+        line = json.dumps(
+            [session_id, session_info.get("conversation_id"), session_info.get("turn_index", 0), int(time.time()),
+             session_info.get("token_id")],
+            ensure_ascii=False,
+            separators=(',', ':')
+        ) + '\n'
+
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_file, 'a', encoding='utf-8')
+            with self._file_lock(exclusive=False):
+                self._journal.write(line)
+                self._journal.flush()
+            self._records += 1
+            need_compact = self._records >= self.compact_every and not self._compacting
+            if need_compact:
+                self._compacting = True
+
+        if need_compact:
+            threading.Thread(target=self._compact_in_background, daemon=True).start()
+
+    def compact(self):
+        """把快照和日志合并为新快照并清空日志"""
+        with self._file_lock(exclusive=True):
+            sessions, records = self._read_state()
+            sessions = self._retain(sessions)
+
+            tmp_file = self.snapshot_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(sessions, f, ensure_ascii=False, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.snapshot_file)
+
+            # 原地截断：其他进程以 O_APPEND 打开的句柄会继续从新的文件末尾追加
+            with open(self.journal_file, 'w', encoding='utf-8'):
+                pass
+
+        with self._lock:
+            self._records = 0
+        logger.info(f"Session journal compacted - {len(sessions)} sessions, {records} records merged")
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"Session journal compaction failed: {e}")
+        finally:
+            self._compacting = False
+
+    def _retain(self, sessions: Dict[str, Dict]) -> Dict[str, Dict]:
+        """按保留策略过滤会话"""
+        if self.idle_ttl:
+            cutoff = time.time() - self.idle_ttl
+            sessions = {sid: info for sid, info in sessions.items() if info.get("updated_at", 0) >= cutoff}
+        if self.max_entries and len(sessions) > self.max_entries:
+            newest = sorted(sessions.items(), key=lambda item: item[1].get("updated_at", 0))[-self.max_entries:]
+            sessions = dict(newest)
+        return sessions
+
+    def _read_state(self):
+        """读取磁盘上的快照和日志（调用方需持有文件锁）"""
+        sessions = {}
+        try:
+            if os.path.exists(self.snapshot_file):
+                with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                    sessions = json.load(f)
+        except Exception as e:
+            logger.warning(f"Failed to load session snapshot: {e}")
+
+        # 旧版快照没有 updated_at，视为刚刚更新
+        now = int(time.time())
+        for info in sessions.values():
+            info.setdefault("updated_at", now)
+
+        records = 0
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        session_id, conversation_id, turn_index = record[:3]
+                    except (ValueError, TypeError):
+                        # 不完整的末行（写入时进程退出）
+                        continue
+                    sessions[session_id] = {
+                        "conversation_id": conversation_id,
+                        "turn_index": turn_index,
+                        "updated_at": record[3] if len(record) > 3 else now,
+                        "token_id": record[4] if len(record) > 4 else None
+                    }
+                    records += 1
+        return sessions, records
+
+    def _terminate_torn_line(self):
+        """不完整的末行补上换行，避免之后追加的记录与其拼接成一行"""
+        if not os.path.exists(self.journal_file) or os.path.getsize(self.journal_file) == 0:
+            return
+        with open(self.journal_file, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+    def _file_lock(self, exclusive: bool):
+        return _FileLock(self, exclusive)
+
+
+class _FileLock:
+    """
+    跨进程文件锁（flock），不支持时退化为空操作
+
+    flock 锁属于打开的文件描述，同一描述上再次加锁只会转换锁类型，
+    因此共享锁复用持久的描述（调用方已持有线程锁），排他锁（压缩）单独打开。
+    """
+
+    __slots__ = ('journal', 'exclusive', 'fd')
+
+    def __init__(self, journal: SessionJournal, exclusive: bool):
+        self.journal = journal
+        self.exclusive = exclusive
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return self
+        if self.exclusive:
+            self.fd = os.open(self.journal.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            if self.journal._lock_fd is None:
+                self.journal._lock_fd = os.open(self.journal.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            self.fd = self.journal._lock_fd
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        if self.exclusive:
+            os.close(self.fd)
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+跨进程共享的会话存储模块
+
+gunicorn 的多个 worker 通过同一个后端读写会话（conversation_id / turn_index / token_id）和当前默认会话ID：
+- sqlite（默认）：SESSION_DATA_DIR/sessions.db，WAL 模式，多进程并发读写
+- redis：SESSION_REDIS_URL 指向的 Redis（需要安装 redis 包）
+- journal：进程内字典 + 追加日志，仅适用于单进程部署
+
+每条会话带有版本号，所有写入都是基于版本的 compare-and-set，冲突时重新读取后重试；
+每个 worker 另有一个小的 LRU 读缓存，条目在 SESSION_CACHE_TTL 秒后过期。
+超过 SESSION_IDLE_TTL 秒未更新的会话会被清理，会话总数不超过 SESSION_MAX_ENTRIES。
+
+token_id 记录创建 conversation_id 的上游 Token：对话只属于该上游账号，后续轮次需要继续使用同一个 Token。
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from session_journal import SessionJournal
+from session_table import SessionTable
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORE = os.environ.get("SESSION_STORE", "sqlite").lower()
+SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 1024))
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 2))
+
+# 会话保留策略：空闲超过该秒数的会话被清理（默认 7 天），以及会话总数上限
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", 7 * 24 * 3600))
+SESSION_MAX_ENTRIES = int(os.environ.get("SESSION_MAX_ENTRIES", 100000))
+
+# 每写入该次数后执行一次清理
+SESSION_PRUNE_EVERY = 1000
+
+# 默认会话ID：当客户端不传递session_id时使用
+DEFAULT_SESSION_ID = "default-session"
+
+# CAS 冲突时的最大重试次数
+MAX_CAS_RETRIES = 10
+
+
+class SessionStore:
+    """
+    会话存储基类
+
+    子类实现 _load / _cas / _load_default / _cas_default 四个后端操作，
+    版本号 0 表示会话不存在。
+    """
+
+    def __init__(self, cache_size: int = SESSION_CACHE_SIZE, cache_ttl: float = SESSION_CACHE_TTL,
+                 idle_ttl: float = SESSION_IDLE_TTL, max_entries: int = SESSION_MAX_ENTRIES):
+        self.cache_ttl = cache_ttl
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+        self._cache = SessionTable(cache_size, cache_ttl)
+        self._cache_lock = threading.Lock()
+        self._default = None  # (session_id, expires_at)
+
+    def get(self, session_id: str) -> Tuple[Optional[Dict], int]:
+        """读取会话，返回 (info, version)；优先使用本进程缓存"""
+        with self._cache_lock:
+            record = self._cache.get(session_id)
+            if record is not None:
+                # 版本号 0 表示缓存的是“会话不存在”
+                return (record.to_dict() if record.version else None), record.version
+
+        info, version = self._load(session_id)
+        self._remember(session_id, info, version)
+        return info, version
+
+    def update(self, session_id: str, apply: Callable[[Optional[Dict]], Optional[Dict]]) -> Optional[Dict]:
+        """
+        基于版本的原子更新
+
+        apply 接收当前会话（不存在时为 None）并返回新的会话，返回 None 表示不修改。
+        与其他 worker 冲突时重新读取最新值后再次调用 apply。
+        """
+        for _ in range(MAX_CAS_RETRIES):
+            info, version = self._load(session_id)
+            new_info = apply(dict(info) if info else None)
+            if new_info is None:
+                self._remember(session_id, info, version)
+                return info
+            if self._cas(session_id, new_info, version):
+                self._remember(session_id, new_info, version + 1)
+                return new_info
+        raise RuntimeError(f"Session {session_id} update conflicted {MAX_CAS_RETRIES} times")
+
+    def get_default_session_id(self) -> str:
+        """当前默认会话ID（所有 worker 共享）"""
+        now = time.monotonic()
+        cached = self._default
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        session_id = self._load_default() or DEFAULT_SESSION_ID
+        self._default = (session_id, now + self.cache_ttl)
+        return session_id
+
+    def replace_default_session_id(self, expected: str, new_session_id: str) -> str:
+        """
+        把默认会话ID从 expected 切换为 new_session_id
+
+        Returns:
+            切换后的默认会话ID；其他 worker 已抢先切换时返回它设置的值
+        """
+        if self._cas_default(expected, new_session_id):
+            current = new_session_id
+        else:
+            current = self._load_default() or DEFAULT_SESSION_ID
+        self._default = (current, time.monotonic() + self.cache_ttl)
+        return current
+
+    def prune(self) -> int:
+        """清理空闲过期和超出数量上限的会话，返回清理数量"""
+        return 0
+
+    def _remember(self, session_id, info, version):
+        with self._cache_lock:
+            if info is None:
+                self._cache.put(session_id, None, 0, 0)
+            else:
+                self._cache.put(session_id, info["conversation_id"], info["turn_index"], version,
+                                token_id=info.get("token_id"))
+
+    def _load(self, session_id: str) -> Tuple[Optional[Dict], int]:
+        raise NotImplementedError
+
+    def _cas(self, session_id: str, info: Dict, version: int) -> bool:
+        raise NotImplementedError
+
+    def _load_default(self) -> Optional[str]:
+        raise NotImplementedError
+
+    def _cas_default(self, expected: str, new_session_id: str) -> bool:
+        raise NotImplementedError
+
+
+class SQLiteSessionStore(SessionStore):
+    """基于 SQLite（WAL）的共享会话存储，每个线程一个连接"""
+
+    def __init__(self, db_path: str, legacy_dir: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._writes = 0
+
+        conn = self._connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                conversation_id TEXT,
+                turn_index INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                token_id INTEGER
+            )
+        ''')
+        # 旧版本创建的表没有 token_id 列
+        if 'token_id' not in [row[1] for row in conn.execute('PRAGMA table_info(sessions)')]:
+            try:
+                conn.execute('ALTER TABLE sessions ADD COLUMN token_id INTEGER')
+            except sqlite3.OperationalError:
+                # 其他 worker 同时添加了该列
+                pass
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS session_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        if legacy_dir:
+            self._import_legacy(legacy_dir)
+        self.prune()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None：每条语句自动提交，CAS 依赖单条 UPDATE 的原子性
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _import_legacy(self, legacy_dir: str):
+        """首次启用时导入 sessions.json / sessions.journal 中的旧会话"""
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM session_meta WHERE key = 'legacy_imported'").fetchone():
+            return
+
+        legacy = SessionJournal(legacy_dir).load()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('''
+                INSERT OR IGNORE INTO sessions (session_id, conversation_id, turn_index, version, updated_at, token_id)
+                VALUES (?, ?, ?, 1, ?, ?)
+            ''', [
+                (sid, info.get("conversation_id"), info.get("turn_index", 0), info.get("updated_at") or now,
+                 info.get("token_id"))
+                for sid, info in legacy.items()
+            ])
+            conn.execute("INSERT OR IGNORE INTO session_meta (key, value) VALUES ('legacy_imported', '1')")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if legacy:
+            logger.info(f"Imported {len(legacy)} legacy sessions into {self.db_path}")
+
+    def _load(self, session_id):
+        row = self._connection().execute(
+            'SELECT conversation_id, turn_index, version, token_id FROM sessions WHERE session_id = ?',
+            (session_id,)
+        ).fetchone()
+        if row is None:
+            return None, 0
+        return {"conversation_id": row[0], "turn_index": row[1], "token_id": row[3]}, row[2]
+
+    def _cas(self, session_id, info, version):
+        conn = self._connection()
+        if version == 0:
+            cursor = conn.execute('''
+                INSERT INTO sessions (session_id, conversation_id, turn_index, version, updated_at, token_id)
+                VALUES (?, ?, ?, 1, ?, ?)
+                ON CONFLICT(session_id) DO NOTHING
+            ''', (session_id, info["conversation_id"], info["turn_index"], time.time(), info.get("token_id")))
+        else:
+            cursor = conn.execute('''
+                UPDATE sessions SET conversation_id = ?, turn_index = ?, token_id = ?, version = version + 1, updated_at = ?
+                WHERE session_id = ? AND version = ?
+            ''', (info["conversation_id"], info["turn_index"], info.get("token_id"), time.time(), session_id, version))
+
+        self._writes += 1
+        if self._writes % SESSION_PRUNE_EVERY == 0:
+            self.prune()
+        return cursor.rowcount == 1
+
+    def prune(self):
+        conn = self._connection()
+        removed = 0
+        if self.idle_ttl:
+            removed += conn.execute(
+                'DELETE FROM sessions WHERE updated_at < ?',
+                (time.time() - self.idle_ttl,)
+            ).rowcount
+
+        excess = conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0] - self.max_entries
+        if excess > 0:
+            removed += conn.execute('''
+                DELETE FROM sessions WHERE session_id IN (
+                    SELECT session_id FROM sessions ORDER BY updated_at LIMIT ?
+                )
+            ''', (excess,)).rowcount
+
+        if removed:
+            logger.info(f"Pruned {removed} idle sessions from {self.db_path}")
+        return removed
+
+    def _load_default(self):
+        row = self._connection().execute(
+            "SELECT value FROM session_meta WHERE key = 'default_session_id'"
+        ).fetchone()
+        return row[0] if row else None
+
+    def _cas_default(self, expected, new_session_id):
+        conn = self._connection()
+        if expected == DEFAULT_SESSION_ID:
+            # 初始值没有写入表中
+            cursor = conn.execute(
+                "INSERT INTO session_meta (key, value) VALUES ('default_session_id', ?) ON CONFLICT(key) DO NOTHING",
+                (new_session_id,)
+            )
+            if cursor.rowcount == 1:
+                return True
+        cursor = conn.execute(
+            "UPDATE session_meta SET value = ? WHERE key = 'default_session_id' AND value = ?",
+            (new_session_id, expected)
+        )
+        return cursor.rowcount == 1
+
+
+class RedisSessionStore(SessionStore):
+    """
+    基于 Redis 的共享会话存储，CAS 通过 Lua 脚本原子执行
+
+    每次写入都会把键的过期时间重置为空闲 TTL；数量上限交给 Redis 的 maxmemory 策略。
+    """
+
+    CAS_SCRIPT = """
+    local version = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+    if version ~= tonumber(ARGV[1]) then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'conversation_id', ARGV[2], 'turn_index', ARGV[3], 'token_id', ARGV[5],
+               'version', version + 1)
+    if tonumber(ARGV[4]) > 0 then
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+    end
+    return 1
+    """
+
+    CAS_DEFAULT_SCRIPT = """
+    local current = redis.call('GET', KEYS[1]) or ARGV[1]
+    if current ~= ARGV[2] then
+        return 0
+    end
+    redis.call('SET', KEYS[1], ARGV[3])
+    return 1
+    """
+
+    def __init__(self, url: str, prefix: str = "wxb:session:", **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SESSION_STORE=redis 需要安装 redis 包：pip install redis")
+
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._cas_script = self.client.register_script(self.CAS_SCRIPT)
+        self._cas_default_script = self.client.register_script(self.CAS_DEFAULT_SCRIPT)
+
+    def _load(self, session_id):
+        data = self.client.hgetall(self.prefix + session_id)
+        if not data:
+            return None, 0
+        return {
+            "conversation_id": data.get("conversation_id") or None,
+            "turn_index": int(data.get("turn_index", 0)),
+            "token_id": int(data["token_id"]) if data.get("token_id") else None
+        }, int(data.get("version", 0))
+
+    def _cas(self, session_id, info, version):
+        return bool(self._cas_script(
+            keys=[self.prefix + session_id],
+            args=[version, info["conversation_id"] or "", info["turn_index"], int(self.idle_ttl),
+                  info.get("token_id") or ""]
+        ))
+
+    def _load_default(self):
+        return self.client.get(self.prefix + "default")
+
+    def _cas_default(self, expected, new_session_id):
+        return bool(self._cas_default_script(
+            keys=[self.prefix + "default"],
+            args=[DEFAULT_SESSION_ID, expected, new_session_id]
+        ))
+
+
+class JournalSessionStore(SessionStore):
+    """进程内会话存储，持久化到追加日志（仅适用于单进程部署）"""
+
+    def __init__(self, data_dir: str, **kwargs):
+        super().__init__(**kwargs)
+        self.journal = SessionJournal(data_dir, idle_ttl=self.idle_ttl, max_entries=self.max_entries)
+        self._sessions = SessionTable(self.max_entries, self.idle_ttl, sliding=True)
+        self._default_session_id = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        # 按最后更新时间恢复会话的过期时刻
+        offset = time.monotonic() - time.time()
+        loaded = sorted(self.journal.load().items(), key=lambda item: item[1].get("updated_at", 0))
+        for session_id, info in loaded:
+            updated_at = info.get("updated_at") or time.time()
+            self._sessions.put(
+                session_id, info.get("conversation_id"), info.get("turn_index", 0), 1,
+                now=updated_at + offset, token_id=info.get("token_id")
+            )
+
+    def get(self, session_id):
+        # 数据本身就在内存中，不需要额外缓存
+        return self._load(session_id)
+
+    def _load(self, session_id):
+        with self._lock:
+            record = self._sessions.get(session_id)
+            if record is None:
+                return None, 0
+            return record.to_dict(), record.version
+
+    def _cas(self, session_id, info, version):
+        with self._lock:
+            record = self._sessions.get(session_id)
+            if (record.version if record else 0) != version:
+                return False
+            self._sessions.put(session_id, info["conversation_id"], info["turn_index"], version + 1,
+                               token_id=info.get("token_id"))
+            self._writes += 1
+            if self._writes % SESSION_PRUNE_EVERY == 0:
+                self._sessions.evict_expired()
+        self.journal.append(session_id, info)
+        return True
+
+    def prune(self):
+        with self._lock:
+            return self._sessions.evict_expired(limit=len(self._sessions))
+
+    def _remember(self, session_id, info, version):
+        pass
+
+    def _load_default(self):
+        return self._default_session_id
+
+    def _cas_default(self, expected, new_session_id):
+        with self._lock:
+            if (self._default_session_id or DEFAULT_SESSION_ID) != expected:
+                return False
+            self._default_session_id = new_session_id
+            return True
+
+
+def create_session_store(data_dir: str) -> SessionStore:
+    """根据 SESSION_STORE 环境变量创建会话存储"""
+    if SESSION_STORE == "redis":
+        logger.info("Using Redis session store")
+        return RedisSessionStore(SESSION_REDIS_URL)
+    if SESSION_STORE == "journal":
+        logger.info("Using process-local journal session store")
+        return JournalSessionStore(data_dir)
+    return SQLiteSessionStore(
+        os.environ.get("SESSION_STORE_PATH", os.path.join(data_dir, "sessions.db")),
+        legacy_dir=data_dir
+    )
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+有界的内存会话表
+
+会话以并行数组的形式保存（session_id -> 槽位号，各字段各占一个紧凑数组），
+不再为每个会话分配一个 {"conversation_id": ..., "turn_index": ...} 字典。
+表的容量有上限，满了以后用 CLOCK（二次机会）算法近似 LRU 淘汰；
+记录在 TTL 内未被访问（或写入）即视为过期，get() 遇到时删除，evict_expired() 分批清理。
+"""
+import time
+from array import array
+from typing import Dict, Iterator, Optional, Tuple
+
+
+class SessionRecord:
+    """get() / pop() 返回的会话快照"""
+
+    __slots__ = ('conversation_id', 'turn_index', 'version', 'token_id')
+
+    def __init__(self, conversation_id: Optional[str], turn_index: int, version: int,
+                 token_id: Optional[int] = None):
+        self.conversation_id = conversation_id
+        self.turn_index = turn_index
+        self.version = version
+        self.token_id = token_id
+
+    def to_dict(self) -> Dict:
+        return {"conversation_id": self.conversation_id, "turn_index": self.turn_index, "token_id": self.token_id}
+
+
+class SessionTable:
+    """
+    按 CLOCK + TTL 淘汰的会话表
+
+    - max_size: 最大会话数，超过后淘汰最近未被访问的会话
+    - ttl: 记录的有效期（秒），0 表示不过期
+    - sliding: 为 True 时每次读取都会续期（空闲 TTL），否则只有写入时设置有效期（缓存新鲜度）
+    """
+
+    __slots__ = ('max_size', 'ttl', 'sliding', 'evictions',
+                 '_index', '_keys', '_conversations', '_turns', '_versions', '_tokens', '_expires',
+                 '_referenced', '_free', '_hand')
+
+    def __init__(self, max_size: int, ttl: float = 0, sliding: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sliding = sliding
+        self.evictions = 0
+
+        self._index = {}            # session_id -> 槽位号
+        self._keys = []             # 槽位 -> session_id（空闲槽位为 None）
+        self._conversations = []
+        self._turns = array('q')
+        self._versions = array('q')
+        self._tokens = array('q')   # 对话所属的 Token ID，0 表示未知
+        self._expires = array('d')
+        self._referenced = bytearray()
+        self._free = []
+        self._hand = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def get(self, session_id: str, now: Optional[float] = None) -> Optional[SessionRecord]:
+        slot = self._index.get(session_id)
+        if slot is None:
+            return None
+
+        if self.ttl:
+            if now is None:
+                now = time.monotonic()
+            if self._expires[slot] <= now:
+                self._release(slot)
+                self.evictions += 1
+                return None
+            if self.sliding:
+                self._expires[slot] = now + self.ttl
+
+        self._referenced[slot] = 1
+        return self._record(slot)
+
+    def put(self, session_id: str, conversation_id: Optional[str], turn_index: int,
+            version: int = 0, now: Optional[float] = None, token_id: Optional[int] = None):
+        if now is None:
+            now = time.monotonic()
+
+        slot = self._index.get(session_id)
+        if slot is None:
+            if self.max_size <= 0:
+                return
+            # 新插入的记录不设置访问标记，被再次访问后才获得二次机会
+            slot = self._allocate(now)
+            self._index[session_id] = slot
+            self._keys[slot] = session_id
+        else:
+            self._referenced[slot] = 1
+
+        self._conversations[slot] = conversation_id
+        self._turns[slot] = turn_index
+        self._versions[slot] = version
+        self._tokens[slot] = token_id or 0
+        self._expires[slot] = now + self.ttl if self.ttl else float('inf')
+
+    def pop(self, session_id: str) -> Optional[SessionRecord]:
+        slot = self._index.get(session_id)
+        if slot is None:
+            return None
+        record = self._record(slot)
+        self._release(slot)
+        return record
+
+    def evict_expired(self, now: Optional[float] = None, limit: int = 1000) -> int:
+        """从 CLOCK 指针处开始检查最多 limit 个槽位，删除其中已过期的记录"""
+        if not self.ttl or not self._index:
+            return 0
+        if now is None:
+            now = time.monotonic()
+
+        capacity = len(self._keys)
+        slot = self._hand
+        evicted = 0
+        for _ in range(min(limit, capacity)):
+            if self._keys[slot] is not None and self._expires[slot] <= now:
+                self._release(slot)
+                evicted += 1
+            slot = (slot + 1) % capacity
+        self._hand = slot
+        self.evictions += evicted
+        return evicted
+
+    def items(self) -> Iterator[Tuple[str, SessionRecord]]:
+        """遍历 (session_id, record)，顺序不固定"""
+        for session_id, slot in list(self._index.items()):
+            yield session_id, self._record(slot)
+
+    def _record(self, slot: int) -> SessionRecord:
+        return SessionRecord(self._conversations[slot], self._turns[slot], self._versions[slot],
+                             self._tokens[slot] or None)
+
+    def _allocate(self, now: float) -> int:
+        """分配一个槽位：优先复用空闲槽位，其次扩容，表满时按 CLOCK 淘汰"""
+        if self._free:
+            return self._free.pop()
+
+        if len(self._keys) < self.max_size:
+            self._keys.append(None)
+            self._conversations.append(None)
+            self._turns.append(0)
+            self._versions.append(0)
+            self._tokens.append(0)
+            self._expires.append(0.0)
+            self._referenced.append(0)
+            return len(self._keys) - 1
+
+        # 表满：转动指针，过期或最近未被访问的槽位被淘汰，被访问过的清除标记后给一次机会
+        capacity = len(self._keys)
+        while True:
+            slot = self._hand
+            self._hand = (slot + 1) % capacity
+            if self._keys[slot] is None:
+                continue
+            if self._referenced[slot] and (not self.ttl or self._expires[slot] > now):
+                self._referenced[slot] = 0
+                continue
+            self._release(slot)
+            self.evictions += 1
+            return self._free.pop()
+
+    def _release(self, slot: int):
+        del self._index[self._keys[slot]]
+        self._keys[slot] = None
+        self._conversations[slot] = None
+        self._referenced[slot] = 0
+        self._free.append(slot)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+OpenAI 流式响应帧编码模块
+
+每个流创建一个编码器：id、object、created、model 和 choices 外壳在创建时一次性序列化为 bytes，
+之后每个 token 只需要对 content 做 JSON 字符串转义并拼接前后缀。
+"""
+import json
+import os
+import time
+from json.encoder import encode_basestring, encode_basestring_ascii
+from typing import Optional
+
+DONE_FRAME = b'data: [DONE]\n\n'
+
+# 是否直接输出 UTF-8 字符（而不是 \uXXXX 转义），中文内容体积约减半
+SSE_UTF8_OUTPUT = os.environ.get("SSE_UTF8_OUTPUT", "false").lower() == "true"
+
+
+class OpenAIStreamEncoder:
+    """
+    OpenAI chat.completion.chunk 帧编码器
+
+    输出格式与逐个 json.dumps 完整 chunk 字典一致（默认分隔符），
+    只是 created 在整个流中保持不变。
+    """
+
+    __slots__ = ('chat_id', 'model', 'created', '_escape', '_prefix', '_suffix', '_stop_frame')
+
+    def __init__(self, chat_id: str, model: str, created: Optional[int] = None,
+                 utf8_output: Optional[bool] = None):
+        if utf8_output is None:
+            utf8_output = SSE_UTF8_OUTPUT
+
+        self.chat_id = chat_id
+        self.model = model
+        self.created = created if created is not None else int(time.time())
+        self._escape = encode_basestring if utf8_output else encode_basestring_ascii
+
+        header = json.dumps({
+            "id": chat_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model,
+        }, ensure_ascii=not utf8_output)[:-1]
+
+        self._prefix = f'data: {header}, "choices": [{{"index": 0, "delta": {{"content": '.encode('utf-8')
+        self._suffix = b'}, "finish_reason": null}]}\n\n'
+        self._stop_frame = (
+            f'data: {header}, "choices": [{{"index": 0, "delta": {{}}, "finish_reason": "stop"}}]}}\n\n'.encode('utf-8')
+            + DONE_FRAME
+        )
+
+    def encode_content(self, content: str) -> bytes:
+        """编码一个 content 增量帧"""
+        return self._prefix + self._escape(content).encode('utf-8') + self._suffix
+
+    def encode_stop(self) -> bytes:
+        """编码结束帧（finish_reason=stop）和 [DONE] 标记"""
+        return self._stop_frame
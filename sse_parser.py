@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+上游 SSE 增量解析模块
+
+直接处理原始字节块：按行切分时保留跨块的半行，只拷贝 data: 之后的有效载荷，
+并提供只提取 content / conversationId 的快速路径，避免对每个事件都构建完整字典。
+"""
+import json
+from json.decoder import scanstring
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+DATA_PREFIX = b'data:'
+DONE_PAYLOAD = b'[DONE]'
+
+_WHITESPACE = ' \t\n\r'
+
+
+class SSEParser:
+    """
+    增量 SSE 解析器
+
+    feed() 接收任意切分的字节块，返回其中已完整到达的 data 载荷（bytes）。
+    与之前 iter_lines() 的处理方式一致，每个 data: 行视为一个独立事件；
+    event:、id:、注释行和空行被忽略，[DONE] 不会返回。
+    """
+
+    __slots__ = ('_buffer',)
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """写入一个字节块，返回已完整的 data 载荷列表"""
+        buffer = self._buffer
+        buffer += chunk
+
+        payloads = []
+        pos = 0
+        while True:
+            newline = buffer.find(b'\n', pos)
+            if newline < 0:
+                break
+            self._parse_line(buffer, pos, newline, payloads)
+            pos = newline + 1
+
+        # 只保留未完成的半行
+        if pos:
+            del buffer[:pos]
+        return payloads
+
+    def flush(self) -> List[bytes]:
+        """流结束时处理没有换行结尾的最后一行"""
+        payloads = []
+        if self._buffer:
+            self._parse_line(self._buffer, 0, len(self._buffer), payloads)
+            self._buffer.clear()
+        return payloads
+
+    @staticmethod
+    def _parse_line(buffer, start, end, payloads):
+        # 兼容 \r\n 换行
+        if end > start and buffer[end - 1] == 13:
+            end -= 1
+        if not buffer.startswith(DATA_PREFIX, start, end):
+            return
+
+        start += len(DATA_PREFIX)
+        # 跳过 data: 之后的空白
+        while start < end and buffer[start] in (32, 9):
+            start += 1
+        while end > start and buffer[end - 1] in (32, 9):
+            end -= 1
+
+        if start == end:
+            return
+        payload = bytes(buffer[start:end])
+        if payload != DONE_PAYLOAD:
+            payloads.append(payload)
+
+
+def iter_sse_payloads(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """从字节块迭代器中逐个产出 data 载荷"""
+    parser = SSEParser()
+    for chunk in chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+def _find_top_level_string(text: str, key: str) -> Tuple[bool, Optional[str]]:
+    """
+    在 JSON 文本中查找顶层字符串字段
+
+    Returns:
+        (ok, value)：ok 为 False 表示快速路径无法确定，需要回退到完整解析；
+        字段不存在或不是字符串时返回 (True, None)
+    """
+    pattern = f'"{key}"'
+    index = text.find(pattern)
+    if index < 0:
+        return True, None
+
+    # 键之前只允许出现最外层的 {，否则可能位于嵌套对象或字符串中
+    if text.count('{', 0, index) != 1 or text.count('"' + key + '"', index + 1) > 0:
+        return False, None
+
+    pos = index + len(pattern)
+    length = len(text)
+    while pos < length and text[pos] in _WHITESPACE:
+        pos += 1
+    if pos >= length or text[pos] != ':':
+        return False, None
+    pos += 1
+    while pos < length and text[pos] in _WHITESPACE:
+        pos += 1
+    if pos >= length:
+        return False, None
+
+    if text[pos] != '"':
+        # null 视为字段不存在，数字等其他类型交给完整解析处理
+        return text.startswith('null', pos), None
+
+    try:
+        value, _ = scanstring(text, pos + 1)
+    except ValueError:
+        return False, None
+    return True, value
+
+
+def extract_event_fields(payload: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """
+    从单个事件载荷中提取 (conversation_id, content)
+
+    优先走快速路径，只扫描需要的两个字段；遇到嵌套或无法确定的情况时回退到 json.loads。
+    content 不是字符串或为空时返回 None，无法解析的载荷返回 (None, None)。
+    """
+    try:
+        text = payload.decode('utf-8')
+    except UnicodeDecodeError:
+        return None, None
+
+    ok_content, content = _find_top_level_string(text, 'content')
+    ok_conv, conversation_id = _find_top_level_string(text, 'conversationId')
+
+    if not (ok_content and ok_conv):
+        try:
+            event_data = json.loads(text)
+        except json.JSONDecodeError:
+            return None, None
+        if not isinstance(event_data, dict):
+            return None, None
+        content = event_data.get('content')
+        conversation_id = event_data.get('conversationId')
+        if not isinstance(content, str):
+            content = None
+
+    return conversation_id or None, content or None
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+流式输出合并模块
+
+上游的 content 增量通常非常小，逐个转发会产生大量 SSE 帧和 socket 写入。
+StreamCoalescer 把 N 毫秒内或累计 M 字节以内的增量合并为一个 OpenAI chunk，
+第一个 token 和流结束时总是立即输出，不影响首字延迟。
+"""
+import os
+import time
+from typing import Dict, Optional
+
+# 全局默认值（0 表示不合并），可被 API Key 设置和单次请求参数覆盖
+STREAM_COALESCE_MS = int(os.environ.get("STREAM_COALESCE_MS", 0))
+STREAM_COALESCE_BYTES = int(os.environ.get("STREAM_COALESCE_BYTES", 0))
+
+# 单次请求允许设置的上限，避免客户端把输出憋得过久
+MAX_COALESCE_MS = 1000
+MAX_COALESCE_BYTES = 64 * 1024
+
+
+class StreamCoalescer:
+    """
+    按时间窗口 / 字节数合并 content 增量
+
+    - window_ms: 从缓冲区第一个增量开始计时，超过该毫秒数后输出
+    - max_bytes: 缓冲内容的 UTF-8 字节数达到该值后输出
+    两者都为 0 时不做合并，push() 原样返回。
+    """
+
+    __slots__ = ('window', 'max_bytes', '_parts', '_size', '_started_at', '_first_sent')
+
+    def __init__(self, window_ms: int = 0, max_bytes: int = 0):
+        self.window = window_ms / 1000.0
+        self.max_bytes = max_bytes
+        self._parts = []
+        self._size = 0
+        self._started_at = 0.0
+        self._first_sent = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 or self.max_bytes > 0
+
+    def push(self, content: str, now: Optional[float] = None) -> Optional[str]:
+        """
+        写入一个增量，返回需要立即输出的合并内容，或 None 表示继续缓冲
+
+        同步模式下只有新增量到达时才会检查时间窗口，
+        异步模式配合 time_remaining() 在窗口到期时主动 flush()。
+        """
+        if not self._first_sent:
+            # 第一个 token 立即输出
+            self._first_sent = True
+            return content
+        if not self.enabled:
+            return content
+
+        if now is None:
+            now = time.monotonic()
+        if not self._parts:
+            self._started_at = now
+        self._parts.append(content)
+        self._size += len(content.encode('utf-8'))
+
+        if (self.max_bytes and self._size >= self.max_bytes) or \
+                (self.window and now - self._started_at >= self.window):
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """输出并清空缓冲区（流结束时调用）"""
+        if not self._parts:
+            return None
+        merged = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        return merged
+
+    def time_remaining(self, now: Optional[float] = None) -> Optional[float]:
+        """距离当前窗口到期的秒数；缓冲区为空或未设置时间窗口时返回 None"""
+        if not self._parts or not self.window:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self._started_at + self.window - now)
+
+
+def _clamp(value, upper) -> Optional[int]:
+    try:
+        return max(0, min(int(value), upper))
+    except (TypeError, ValueError):
+        return None
+
+
+def create_coalescer(request_data: Dict, key_settings: Optional[Dict] = None) -> StreamCoalescer:
+    """
+    根据 请求参数 > API Key 设置 > 全局默认 的优先级创建合并器
+
+    Args:
+        request_data: 请求体，可包含 coalesce_ms / coalesce_bytes
+        key_settings: API Key 上的 stream_coalesce_ms / stream_coalesce_bytes（为 None 表示未设置）
+    """
+    key_settings = key_settings or {}
+
+    window_ms = _clamp(request_data.get('coalesce_ms'), MAX_COALESCE_MS)
+    if window_ms is None:
+        window_ms = key_settings.get('stream_coalesce_ms')
+    if window_ms is None:
+        window_ms = STREAM_COALESCE_MS
+
+    max_bytes = _clamp(request_data.get('coalesce_bytes'), MAX_COALESCE_BYTES)
+    if max_bytes is None:
+        max_bytes = key_settings.get('stream_coalesce_bytes')
+    if max_bytes is None:
+        max_bytes = STREAM_COALESCE_BYTES
+
+    return StreamCoalescer(window_ms, max_bytes)
@@ -6,11 +6,12 @@ import requests
 import json
 import hashlib
 import base64
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import pytz
 from typing import Optional, Dict, List
 import logging
 from database import db
+from http_transport import upstream_transport
 
 logger = logging.getLogger(__name__)
 
@@ -56,7 +57,7 @@ class TaskSystem:
         try:
             headers = self._get_base_headers(token, device_id)
             
-            response = requests.get(
+            response = upstream_transport.get(
                 f"{self.base_url}{self.task_list_endpoint}?isOldVersion=false",
                 headers=headers,
                 timeout=10,
@@ -118,7 +119,7 @@ class TaskSystem:
             
             data = f"taskId={task_id}"
             
-            response = requests.post(
+            response = upstream_transport.post(
                 f"{self.base_url}{self.task_execute_endpoint}",
                 headers=headers,
                 data=data,
@@ -180,19 +181,20 @@ class TaskSystem:
     
     def get_daily_task_stats(self, token_id: int) -> Dict:
         """获取Token的每日任务统计"""
-        today = date.today().isoformat()
+        today = date.today()
         
         with db.get_connection() as conn:
             cursor = conn.cursor()
+            # 用时间范围代替 DATE(created_at) = ?，可以走 (token_id, created_at) 索引
             cursor.execute('''
                 SELECT 
                     task_type,
                     COUNT(*) as count,
                     SUM(rewards_earned) as total_rewards
                 FROM task_logs 
-                WHERE token_id = ? AND DATE(created_at) = ?
+                WHERE token_id = ? AND created_at >= ? AND created_at < ?
                 GROUP BY task_type
-            ''', (token_id, today))
+            ''', (token_id, today.isoformat(), (today + timedelta(days=1)).isoformat()))
             
             results = cursor.fetchall()
             
@@ -231,13 +233,7 @@ class TaskSystem:
     
     def log_task_completion(self, token_id: int, task_type: str, task_id: str, rewards_earned: float):
         """记录任务完成情况"""
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO task_logs (token_id, task_type, task_id, rewards_earned)
-                VALUES (?, ?, ?, ?)
-            ''', (token_id, task_type, task_id, rewards_earned))
-            conn.commit()
+        db.record_task_completion(token_id, task_type, task_id, rewards_earned)
     
     def auto_complete_tasks_for_token(self, token_info: Dict) -> Dict:
         """为Token自动完成任务"""
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+API Key / Token / 用户变更方法的返回值
+
+这些方法在同一事务中递增认证缓存版本号，返回值必须来自变更语句本身：
+不存在或属于其他用户的 id 返回 False / 0，批量操作返回实际变更的行数，
+未变更时不递增版本号、不通知本进程的缓存。
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    # 导入 database 会在当前目录创建全局实例的数据库文件
+    monkeypatch.chdir(tmp_path)
+    from database import DatabaseManager, AUTH_CACHE_VERSION
+
+    manager = DatabaseManager(str(tmp_path / "test.db"))
+    manager.notified = []
+    manager.add_cache_listener(AUTH_CACHE_VERSION, lambda: manager.notified.append(1))
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def users(manager):
+    owner = manager.create_user("owner", "password")
+    other = manager.create_user("other", "password")
+    manager.create_api_key(owner, "key")
+    token_ids = [manager.create_token(owner, f"token-{i}", f"token-value-{i}") for i in range(3)]
+    api_key_id = manager.get_user_api_keys(owner)[0]['id']
+    manager.notified.clear()
+    return owner, other, api_key_id, token_ids
+
+
+def auth_version(manager):
+    from database import AUTH_CACHE_VERSION
+    return manager.get_cache_version(AUTH_CACHE_VERSION)
+
+
+def test_missing_or_foreign_ids_return_false(manager, users):
+    owner, other, api_key_id, token_ids = users
+    version = auth_version(manager)
+
+    assert manager.toggle_api_key(9999, owner) is False
+    assert manager.toggle_api_key(api_key_id, other) is False
+    assert manager.update_api_key_stream_settings(api_key_id, other, 10, 10) is False
+    assert manager.delete_api_key(api_key_id, other) is False
+    assert manager.toggle_token(token_ids[0], other) is False
+    assert manager.delete_token(777, owner) is False
+    assert manager.delete_token(token_ids[0], other) is False
+    assert manager.admin_toggle_token(777) is False
+    assert manager.admin_delete_token(777) is False
+
+    admin_id = manager.authenticate_user("admin", "admin123")["id"]
+    assert manager.admin_delete_user(admin_id) is False
+    assert manager.admin_toggle_user_status(admin_id) is False
+    assert manager.admin_delete_user(9999) is False
+
+    # 没有变更时不递增版本号、不通知缓存
+    assert auth_version(manager) == version
+    assert manager.notified == []
+
+
+def test_batch_operations_return_changed_rows(manager, users):
+    owner, other, _, token_ids = users
+
+    assert manager.batch_toggle_tokens(token_ids, other) == 0
+    assert manager.batch_delete_tokens(token_ids, other) == 0
+    assert manager.admin_batch_toggle_tokens([777, 778]) == 0
+    assert manager.admin_batch_delete_tokens([777, 778]) == 0
+    assert manager.notified == []
+
+    assert manager.batch_toggle_tokens(token_ids + [777], owner) == 3
+    assert manager.admin_batch_toggle_tokens(token_ids[:2]) == 2
+    assert manager.batch_delete_tokens(token_ids[:1], owner) == 1
+    assert manager.admin_batch_delete_tokens(token_ids) == 2
+
+
+def test_successful_changes_bump_version_and_notify(manager, users):
+    owner, _, api_key_id, token_ids = users
+    version = auth_version(manager)
+
+    assert manager.toggle_api_key(api_key_id, owner) is True
+    assert manager.toggle_token(token_ids[0], owner) is True
+    assert manager.delete_token(token_ids[1], owner) is True
+    assert manager.admin_toggle_user_status(owner) is True
+
+    assert auth_version(manager) == version + 4
+    assert len(manager.notified) == 4
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+用户多 Token 调度
+
+同一用户上传了多个 Token 时，按策略把请求分摊到各个上游账号，而不是总使用余额最高的那一个：
+- balance：总是选择余额最高的 Token（原来的行为）
+- weighted：按余额加权的平滑轮询（余额越高分到的请求越多）
+- least_inflight：选择当前进行中请求最少的 Token
+- p2c：随机取两个 Token，选择进行中请求较少的一个（power of two choices）
+
+进行中请求数保存在本进程内存中，TOKEN_MAX_CONCURRENCY 限制的是每个 worker 内单个 Token 的并发数。
+预估余额（estimated_balance）低于 TOKEN_MIN_BALANCE 的 Token 只有在其他候选都不足时才会被选择，
+在上游返回余额不足的错误之前避开即将耗尽的 Token；尚无预估的 Token 不受影响。
+会话亲和：续写已有对话时传入创建该对话的 Token（preferred_id），只要它仍在候选列表中（未被禁用/删除）
+就使用它，不经过策略选择，也不受预估余额的影响；达到并发上限时最多等待 TOKEN_PIN_WAIT_MS 毫秒，
+仍满载则返回 None（由调用方返回 429），不会换 Token 丢失对话上下文。
+只有绑定的 Token 已被禁用或删除时才回退到策略选择，由调用方新建对话。
+其他策略可通过 register_policy() 注册。
+"""
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TOKEN_SCHEDULER_POLICY = os.environ.get("TOKEN_SCHEDULER_POLICY", "weighted").lower()
+TOKEN_MAX_CONCURRENCY = int(os.environ.get("TOKEN_MAX_CONCURRENCY", 0))   # 0 表示不限制
+TOKEN_MIN_BALANCE = float(os.environ.get("TOKEN_MIN_BALANCE", 1))
+TOKEN_PIN_WAIT_MS = int(os.environ.get("TOKEN_PIN_WAIT_MS", 2000))   # 绑定的 Token 满载时等待空位的毫秒数
+TOKEN_SCHEDULER_STATE_SIZE = int(os.environ.get("TOKEN_SCHEDULER_STATE_SIZE", 10000))   # 保留加权轮询状态的用户数
+
+# 加权轮询中余额为 0（或尚未查询余额）的 Token 的最小权重
+MIN_TOKEN_WEIGHT = 1.0
+
+
+class TokenLease:
+    """一次请求占用的 Token，请求结束时 release()（可重复调用）"""
+
+    __slots__ = ('scheduler', 'token_info', '_released')
+
+    def __init__(self, scheduler: 'TokenScheduler', token_info: Dict):
+        self.scheduler = scheduler
+        self.token_info = token_info
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.scheduler.release(self.token_info['id'])
+
+
+def _pick_balance(scheduler, user_id, tokens):
+    return tokens[0]
+
+
+def _pick_weighted(scheduler, user_id, tokens):
+    # 平滑加权轮询：每轮所有候选加上自己的权重，选当前值最大的，再减去总权重
+    # 状态按用户 LRU 保留，最久未请求的用户被淘汰后从零开始轮询
+    current = scheduler._wrr_state.get(user_id)
+    if current is None:
+        current = scheduler._wrr_state[user_id] = {}
+        while len(scheduler._wrr_state) > scheduler.state_size:
+            scheduler._wrr_state.popitem(last=False)
+    else:
+        scheduler._wrr_state.move_to_end(user_id)
+    total = 0.0
+    best = None
+    for token in tokens:
+        weight = max(token.get('balance') or 0, MIN_TOKEN_WEIGHT)
+        total += weight
+        current[token['id']] = current.get(token['id'], 0.0) + weight
+        if best is None or current[token['id']] > current[best['id']]:
+            best = token
+    current[best['id']] -= total
+
+    # 清理已不在候选列表中的 Token
+    if len(current) > len(tokens):
+        ids = {token['id'] for token in tokens}
+        for token_id in [token_id for token_id in current if token_id not in ids]:
+            del current[token_id]
+    return best
+
+
+def _pick_least_inflight(scheduler, user_id, tokens):
+    # min() 取第一个最小值，相同时优先余额更高的 Token
+    return min(tokens, key=lambda token: scheduler._inflight.get(token['id'], 0))
+
+
+def _pick_p2c(scheduler, user_id, tokens):
+    if len(tokens) == 1:
+        return tokens[0]
+    first, second = sorted(random.sample(range(len(tokens)), 2))
+    if scheduler._inflight.get(tokens[second]['id'], 0) < scheduler._inflight.get(tokens[first]['id'], 0):
+        return tokens[second]
+    return tokens[first]
+
+
+POLICIES: Dict[str, Callable] = {
+    'balance': _pick_balance,
+    'weighted': _pick_weighted,
+    'least_inflight': _pick_least_inflight,
+    'p2c': _pick_p2c,
+}
+
+
+def register_policy(name: str, pick: Callable):
+    """注册调度策略：pick(scheduler, user_id, tokens) 从非空候选列表中返回一个 Token"""
+    POLICIES[name] = pick
+
+
+class TokenScheduler:
+    """按策略选择 Token 并维护每个 Token 的进行中请求数"""
+
+    def __init__(self, policy: str = TOKEN_SCHEDULER_POLICY, max_concurrency: int = TOKEN_MAX_CONCURRENCY,
+                 min_balance: float = TOKEN_MIN_BALANCE, state_size: int = TOKEN_SCHEDULER_STATE_SIZE,
+                 pin_wait_ms: int = TOKEN_PIN_WAIT_MS):
+        if policy not in POLICIES:
+            logger.warning(f"Unknown token scheduler policy '{policy}', falling back to 'balance'")
+            policy = 'balance'
+        self.policy = policy
+        self.max_concurrency = max_concurrency
+        self.min_balance = min_balance
+        self.state_size = max(state_size, 1)
+        self.pin_wait = max(pin_wait_ms, 0) / 1000
+        self.rejected = 0
+        self.avoided = 0
+        self.pinned = 0
+        self.pin_fallbacks = 0
+        self.pin_waits = 0
+
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)   # release() 时通知等待绑定 Token 的请求
+        self._inflight: Dict[int, int] = {}
+        self._wrr_state: OrderedDict = OrderedDict()   # user_id -> {token_id: 当前权重}
+
+    def acquire(self, user_id: int, tokens: List[Dict], policy: Optional[str] = None,
+                preferred_id: Optional[int] = None) -> Optional[TokenLease]:
+        """
+        从候选 Token（优先顺序）中选择一个并占用
+
+        Args:
+            preferred_id: 会话绑定的 Token ID，仍在候选列表中时总是使用它（满载时等待，见模块说明）
+
+        Returns:
+            TokenLease；绑定的 Token 或所有候选都已达到并发上限时返回 None。
+            lease.token_info['id'] != preferred_id 表示绑定的 Token 已被禁用或删除
+        """
+        if preferred_id is not None:
+            pinned = next((token for token in tokens if token['id'] == preferred_id), None)
+            if pinned is not None:
+                return self._acquire_pinned(pinned)
+
+        pick = POLICIES.get(policy or self.policy, _pick_balance)
+        with self._lock:
+            if preferred_id is not None:
+                self.pin_fallbacks += 1
+            if self.max_concurrency > 0:
+                tokens = [token for token in tokens if self._inflight.get(token['id'], 0) < self.max_concurrency]
+            if not tokens:
+                self.rejected += 1
+                return None
+            funded = [token for token in tokens
+                      if token.get('estimated_balance') is None or token['estimated_balance'] >= self.min_balance]
+            if funded and len(funded) < len(tokens):
+                self.avoided += 1
+                tokens = funded
+
+            token = pick(self, user_id, tokens)
+            self._inflight[token['id']] = self._inflight.get(token['id'], 0) + 1
+        return TokenLease(self, token)
+
+    def _acquire_pinned(self, token: Dict) -> Optional[TokenLease]:
+        deadline = time.monotonic() + self.pin_wait
+        with self._released:
+            waited = False
+            while self.max_concurrency > 0 and self._inflight.get(token['id'], 0) >= self.max_concurrency:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    return None
+                if not waited:
+                    waited = True
+                    self.pin_waits += 1
+                self._released.wait(remaining)
+            self.pinned += 1
+            self._inflight[token['id']] = self._inflight.get(token['id'], 0) + 1
+        return TokenLease(self, token)
+
+    def release(self, token_id: int):
+        with self._released:
+            remaining = self._inflight.get(token_id, 0) - 1
+            if remaining > 0:
+                self._inflight[token_id] = remaining
+            else:
+                self._inflight.pop(token_id, None)
+            self._released.notify_all()
+
+    def inflight(self, token_id: int) -> int:
+        return self._inflight.get(token_id, 0)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'policy': self.policy,
+                'max_concurrency': self.max_concurrency,
+                'inflight': dict(self._inflight),
+                'tracked_users': len(self._wrr_state),
+                'min_balance': self.min_balance,
+                'rejected': self.rejected,
+                'avoided': self.avoided,
+                'pinned': self.pinned,
+                'pin_fallbacks': self.pin_fallbacks,
+                'pin_waits': self.pin_waits
+            }
+
+
+# 全局调度器实例
+token_scheduler = TokenScheduler()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+使用记录的后台批量写入（write-behind）
+
+请求路径只把使用记录、调用次数增量和状态更新放入有界队列，由后台线程每 USAGE_FLUSH_MS 毫秒
+或每攒满 USAGE_BATCH_SIZE 条在一个事务中写入，不再为每个请求单独打开事务提交。
+
+- 队列满（数据库长时间不可写）或写入器已关闭时退化为同步写入，内存占用有上限
+- 批量写入失败会重试，仍失败则整批追加到溢出文件，下次启动时重放，不会静默丢弃
+- 进程退出时（atexit / ASGI lifespan）写完队列中剩余的记录；被强制杀死时最多丢失一个刷新窗口
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+USAGE_WRITE_BEHIND = os.environ.get("USAGE_WRITE_BEHIND", "true").lower() == "true"
+USAGE_FLUSH_MS = int(os.environ.get("USAGE_FLUSH_MS", 200))
+USAGE_BATCH_SIZE = int(os.environ.get("USAGE_BATCH_SIZE", 500))
+USAGE_QUEUE_SIZE = int(os.environ.get("USAGE_QUEUE_SIZE", 10000))
+
+# 批量写入失败后的重试次数
+USAGE_FLUSH_RETRIES = 3
+
+_STOP = object()
+
+
+class UsageWriter:
+    """
+    使用记录写入器
+
+    调用次数由两部分组成：已提交的次数 + 本进程已入队尚未提交的增量，两者在同一把锁下读取/更新，
+    返回值不会重复计算也不会遗漏本进程的调用。已提交的次数在本进程当天第一次调用该 Token 时从数据库读取一次
+    （此时还没有该 Token 的待提交增量），之后由每次批量写入返回的累计值更新；数据库写入本身不持有锁，
+    请求线程不会等待批量提交。
+    """
+
+    def __init__(self, database, enabled: bool = USAGE_WRITE_BEHIND, flush_ms: int = USAGE_FLUSH_MS,
+                 batch_size: int = USAGE_BATCH_SIZE, queue_size: int = USAGE_QUEUE_SIZE):
+        self.db = database
+        self.enabled = enabled
+        self.flush_interval = flush_ms / 1000
+        self.batch_size = max(1, batch_size)
+        self.queue_size = queue_size
+        self.spill_file = os.path.abspath(database.db_path) + '.usage-spill'
+
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self._pending_calls: Dict[Tuple[int, str], int] = {}   # (token_id, date) -> 已入队未提交的调用次数
+        self._committed_calls: Dict[Tuple[int, str], int] = {} # (token_id, date) -> 最近一次得知的已提交调用次数
+
+    def log_usage(self, user_id: int, api_key_id: int, token_id: int, model: str,
+                  tokens_used: int = 0, cost: float = 0, request_id: str = None):
+        """记录使用情况"""
+        row = (user_id, api_key_id, token_id, model, tokens_used, cost, request_id)
+        if not self._submit(('usage', row)):
+            self._write([row], [], [])
+
+    def increment_api_calls(self, token_id: int, return_count: bool = True) -> Optional[int]:
+        """
+        增加Token的API调用次数，返回当天的调用次数
+
+        Args:
+            return_count: 为 False 时只记录增量并返回 None，不读取已提交的次数
+        """
+        if not self.enabled:
+            return self.db.increment_api_calls(token_id)
+
+        today = datetime.now().date().isoformat()
+        key = (token_id, today)
+        if not self._closed:
+            self._ensure_started()
+        calls = None
+        with self._lock:
+            if return_count and key not in self._committed_calls:
+                # 此前没有该 key 的待提交增量，读到的次数不会与队列中的重复（WAL 模式下读取不等待写锁）
+                for stale in [k for k in self._committed_calls if k[1] != today]:
+                    del self._committed_calls[stale]
+                self._committed_calls[key] = self.db.get_api_calls_today(token_id, today)
+            self._pending_calls[key] = self._pending_calls.get(key, 0) + 1
+            if return_count:
+                calls = self._committed_calls[key] + self._pending_calls[key]
+        if not self._submit(('calls', key)):
+            self._write([], [(token_id, today, 1)], [])
+        return calls
+
+    def update_usage_status(self, request_id: str, status: str):
+        """更新使用记录状态；与插入走同一个队列，保证在对应记录写入之后执行"""
+        if not self._submit(('status', (status, request_id))):
+            self._write([], [], [(status, request_id)])
+
+    def flush(self, timeout: float = 5):
+        """等待当前已入队的记录全部写入"""
+        if self._queue is not None and self._pid == os.getpid():
+            done = threading.Event()
+            try:
+                self._queue.put(('flush', done), timeout=timeout)
+            except queue.Full:
+                return False
+            return done.wait(timeout)
+        return True
+
+    def close(self, timeout: float = 10):
+        """停止后台线程并写完队列中剩余的记录，之后的写入改为同步执行"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.error("Usage writer queue still full at shutdown, remaining records will be lost")
+            return
+        thread.join(timeout)
+
+    def _submit(self, item) -> bool:
+        """放入队列，写入器未启用、已关闭或队列已满时返回 False"""
+        if not self.enabled or self._closed:
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            logger.warning("Usage writer queue full, writing synchronously")
+            return False
+
+    def _ensure_started(self):
+        # fork 出的子进程没有父进程的后台线程，需要重新创建队列和线程
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._pending_calls = {}
+            self._committed_calls = {}
+            self._thread = threading.Thread(target=self._run, name="usage-writer", daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self._replay_spill()
+        except Exception as e:
+            logger.error(f"Failed to replay usage spill file: {e}")
+
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._flush_batch(batch)
+            if batch[-1] is _STOP:
+                return
+
+    def _flush_batch(self, batch):
+        usage_rows = []
+        call_deltas = {}
+        status_updates = []
+        waiters = []
+        for item in batch:
+            if item is _STOP:
+                continue
+            kind, value = item
+            if kind == 'usage':
+                usage_rows.append(value)
+            elif kind == 'calls':
+                call_deltas[value] = call_deltas.get(value, 0) + 1
+            elif kind == 'status':
+                status_updates.append(value)
+            elif kind == 'flush':
+                waiters.append(value)
+
+        # 跨零点时旧日期的增量先写
+        deltas = sorted(((token_id, date, delta) for (token_id, date), delta in call_deltas.items()),
+                        key=lambda d: d[1])
+        if usage_rows or deltas or status_updates:
+            self._write(usage_rows, deltas, status_updates, retries=USAGE_FLUSH_RETRIES)
+
+        for waiter in waiters:
+            waiter.set()
+
+    def _write(self, usage_rows, call_deltas, status_updates, retries: int = 1):
+        """写入一批记录并扣除对应的待提交调用次数；多次失败后写入溢出文件"""
+        for attempt in range(retries):
+            try:
+                # 提交之后、结算之前读取的次数 = 旧的已提交次数 + 仍包含本批的待提交增量，同样准确
+                totals = self.db.write_usage_batch(usage_rows, call_deltas, status_updates)
+            except Exception as e:
+                logger.warning(f"Usage batch write failed (attempt {attempt + 1}/{retries}): {e}")
+                if attempt + 1 < retries:
+                    time.sleep(0.1 * (attempt + 1))
+                continue
+            with self._lock:
+                for key, total in (totals or {}).items():
+                    # 同步写入与后台写入可能乱序完成，累计值只增不减
+                    if key in self._committed_calls:
+                        self._committed_calls[key] = max(self._committed_calls[key], total)
+                self._settle(call_deltas)
+            return
+
+        self._spill(usage_rows, call_deltas, status_updates)
+
+    def _settle(self, call_deltas):
+        """调用方需持有 self._lock"""
+        for token_id, date, delta in call_deltas:
+            key = (token_id, date)
+            remaining = self._pending_calls.get(key, 0) - delta
+            if remaining > 0:
+                self._pending_calls[key] = remaining
+            else:
+                self._pending_calls.pop(key, None)
+
+    def _spill(self, usage_rows, call_deltas, status_updates):
+        """写入数据库失败的批次追加到溢出文件，等待下次启动时重放"""
+        line = json.dumps({
+            'usage_rows': usage_rows,
+            'call_deltas': call_deltas,
+            'status_updates': status_updates
+        }, ensure_ascii=False) + '\n'
+        try:
+            with open(self.spill_file, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            logger.error(f"Usage batch spilled to {self.spill_file}: {len(usage_rows)} records")
+        except Exception as e:
+            logger.error(f"Failed to spill usage batch, {len(usage_rows)} records lost: {e} - {line.strip()}")
+        finally:
+            with self._lock:
+                self._settle(call_deltas)
+
+    def _replay_spill(self):
+        """重放溢出文件；先改名认领，避免多个 worker 重复写入"""
+        if not os.path.exists(self.spill_file):
+            return
+        claimed = f"{self.spill_file}.{os.getpid()}"
+        try:
+            os.replace(self.spill_file, claimed)
+        except FileNotFoundError:
+            return
+
+        replayed = 0
+        failed = []
+        with open(claimed, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    batch = json.loads(line)
+                except ValueError:
+                    continue
+                try:
+                    self.db.write_usage_batch(
+                        [tuple(row) for row in batch['usage_rows']],
+                        [tuple(delta) for delta in batch['call_deltas']],
+                        [tuple(update) for update in batch['status_updates']]
+                    )
+                    replayed += len(batch['usage_rows'])
+                except Exception as e:
+                    logger.error(f"Failed to replay spilled usage batch: {e}")
+                    failed.append(line)
+
+        # 仍然写不进去的批次放回溢出文件
+        if failed:
+            with open(self.spill_file, 'a', encoding='utf-8') as f:
+                f.writelines(failed)
+        os.remove(claimed)
+        logger.info(f"Replayed {replayed} spilled usage records")
+
+# 全局写入器实例
+usage_writer = UsageWriter(db)
+atexit.register(usage_writer.close)
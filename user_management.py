@@ -7,8 +7,14 @@ from functools import wraps
 import logging
 from database import db
 from balance_checker import balance_checker
+from balance_cache import BALANCE_CACHE_TTL
 from task_system import task_system
+from log_archiver import log_archiver, ARCHIVE_TABLES
+from balance_refresher import balance_refresher
+from balance_sweeper import balance_sweeper
+from token_scheduler import token_scheduler
 from wenxiaobai_client import MODEL_ABILITIES
+from stream_coalescer import MAX_COALESCE_MS, MAX_COALESCE_BYTES
 
 logger = logging.getLogger(__name__)
 
@@ -147,6 +153,30 @@ def toggle_api_key(key_id):
         return jsonify({'success': True})
     return jsonify({'error': '操作失败'}), 400
 
+@user_bp.route('/api/keys/<int:key_id>/stream-settings', methods=['POST'])
+@login_required
+def update_api_key_stream_settings(key_id):
+    """设置API Key的流式输出合并参数"""
+    data = request.get_json() or {}
+    
+    settings = {}
+    for field, upper in (('coalesce_ms', MAX_COALESCE_MS), ('coalesce_bytes', MAX_COALESCE_BYTES)):
+        value = data.get(field)
+        if value is None:
+            settings[field] = None  # 使用全局默认
+            continue
+        if not isinstance(value, int) or value < 0 or value > upper:
+            return jsonify({'error': f'{field} 必须是 0 到 {upper} 之间的整数'}), 400
+        settings[field] = value
+    
+    success = db.update_api_key_stream_settings(
+        key_id, session['user_id'], settings['coalesce_ms'], settings['coalesce_bytes']
+    )
+    if success:
+        logger.info(f"User {session['username']} updated stream settings for API key {key_id}: {settings}")
+        return jsonify({'success': True})
+    return jsonify({'error': '操作失败'}), 400
+
 @user_bp.route('/api/keys/<int:key_id>', methods=['DELETE'])
 @login_required
 def delete_api_key(key_id):
@@ -200,7 +230,7 @@ def create_token():
         
         # 更新余额信息
         suanli_balance = balance_result.get('suanli_balance', 0)
-        db.update_token_balance(token_id, suanli_balance)
+        db.update_token_balance(token_id, suanli_balance, balance_result.get('fetched_at'))
         
         logger.info(f"User {session['username']} created token: {name} for {wenxiaobai_username}")
         return jsonify({
@@ -260,9 +290,9 @@ def batch_manage_tokens():
         return jsonify({'error': '批量操作失败'}), 500
 
 # 余额查询
-@user_bp.route('/api/tokens/balance/batch', methods=['POST'])
+@user_bp.route('/api/tokens/<int:token_id>/balance', methods=['GET'])
 @login_required
-def batch_check_balances():
+def check_token_balance(token_id):
     """查询单个Token余额"""
     # 获取token信息
     tokens = db.get_user_tokens(session['user_id'])
@@ -272,15 +302,17 @@ def batch_check_balances():
         return jsonify({'error': 'Token不存在'}), 404
     
     # 查询余额
+    # 用户主动查询：只接受 TTL 内的缓存结果
     balance_result = balance_checker.check_balance(
         token_info['full_token'], 
-        token_info['device_id']
+        token_info['device_id'],
+        max_staleness=BALANCE_CACHE_TTL
     )
     
     if balance_result and balance_result.get('success'):
         # 更新数据库中的余额
         suanli_balance = balance_result.get('suanli_balance', 0)
-        db.update_token_balance(token_id, suanli_balance)
+        db.update_token_balance(token_id, suanli_balance, balance_result.get('fetched_at'))
         
         logger.info(f"Balance checked for token {token_id}: {suanli_balance}")
         return jsonify({
@@ -296,6 +328,47 @@ def batch_check_balances():
             'error': error_msg
         }), 400
 
+@user_bp.route('/api/tokens/balance/batch', methods=['POST'])
+@login_required
+def batch_check_balances():
+    """批量查询Token余额"""
+    data = request.get_json()
+    token_ids = data.get('token_ids', [])
+    
+    if not token_ids:
+        return jsonify({'error': 'Token ID列表不能为空'}), 400
+    
+    # 获取用户的tokens，筛选出要查询的tokens
+    user_tokens = db.get_user_tokens(session['user_id'])
+    token_ids = set(token_ids)
+    tokens_to_check = [token for token in user_tokens if token['id'] in token_ids]
+    
+    if not tokens_to_check:
+        return jsonify({'error': '没有找到有效的Token'}), 400
+    
+    batch_result = check_and_save_balances(tokens_to_check)
+    logger.info(f"Batch balance check for user {session['username']}: {batch_result['success_count']} success, "
+                f"{batch_result['failed_count']} failed, {batch_result['timed_out_count']} timed out")
+    
+    return jsonify({
+        'success': True,
+        'results': batch_result
+    })
+
+def check_and_save_balances(tokens):
+    """并发查询一组Token的余额（get_user_tokens / get_all_tokens 格式），成功的结果在一个事务中写回"""
+    batch_result = balance_checker.batch_check_balances([{
+        'id': token['id'],
+        'token': token['full_token'],
+        'device_id': token['device_id']
+    } for token in tokens], max_staleness=BALANCE_CACHE_TTL)
+    
+    db.update_token_balances([
+        (result['token_id'], result['balance'], result.get('fetched_at'))
+        for result in batch_result['results'] if 'balance' in result
+    ])
+    return batch_result
+
 @user_bp.route('/api/tokens/<int:token_id>/toggle-auto-task', methods=['POST'])
 @login_required
 def toggle_auto_task(token_id):
@@ -374,44 +447,6 @@ def get_available_models():
         })
     
     return jsonify({'models': models})
-    """批量查询Token余额"""
-    data = request.get_json()
-    token_ids = data.get('token_ids', [])
-    
-    if not token_ids:
-        return jsonify({'error': 'Token ID列表不能为空'}), 400
-    
-    # 获取用户的tokens
-    user_tokens = db.get_user_tokens(session['user_id'])
-    
-    # 筛选出要查询的tokens
-    tokens_to_check = []
-    for token in user_tokens:
-        if token['id'] in token_ids:
-            tokens_to_check.append({
-                'id': token['id'],
-                'token': token['full_token'],
-                'device_id': token['device_id']
-            })
-    
-    if not tokens_to_check:
-        return jsonify({'error': '没有找到有效的Token'}), 400
-    
-    # 批量查询余额
-    batch_result = balance_checker.batch_check_balances(tokens_to_check)
-    
-    # 更新数据库中的余额
-    for result in batch_result['results']:
-        if result['balance_result'].get('success'):
-            balance = result['balance_result'].get('suanli_balance', 0)
-            db.update_token_balance(result['token_id'], balance)
-    
-    logger.info(f"Batch balance check for user {session['username']}: {batch_result['success_count']} success, {batch_result['failed_count']} failed")
-    
-    return jsonify({
-        'success': True,
-        'results': batch_result
-    })
 
 # 管理员功能
 @user_bp.route('/api/admin/users', methods=['GET'])
@@ -445,7 +480,12 @@ def get_admin_stats():
         'total_users': total_users,
         'active_users': active_users,
         'admin_users': admin_users,
-        'recent_users': users[:10]  # 最近10个用户
+        'recent_users': users[:10],  # 最近10个用户
+        'balance_refresh': balance_refresher.stats(),
+        'balance_cache': balance_checker.cache.stats(),
+        'balance_sweep': balance_sweeper.stats(),
+        'model_costs': db.get_model_costs(),
+        'token_scheduler': token_scheduler.stats()
     })
 
 # 使用统计
@@ -501,7 +541,7 @@ def admin_create_token():
         
         # 更新余额信息
         suanli_balance = balance_result.get('suanli_balance', 0)
-        db.update_token_balance(token_id, suanli_balance)
+        db.update_token_balance(token_id, suanli_balance, balance_result.get('fetched_at'))
         
         logger.info(f"Admin {session['username']} created token: {name} for user {user_id}")
         return jsonify({
@@ -549,7 +589,7 @@ def admin_delete_token(token_id):
 def admin_batch_manage_tokens():
     """管理员批量管理Token"""
     data = request.get_json()
-    action = data.get('action')  # 'toggle', 'toggle-auto-task', 'delete'
+    action = data.get('action')  # 'toggle', 'toggle-auto-task', 'delete', 'check-balance'
     token_ids = data.get('token_ids', [])
     
     if not action or not token_ids:
@@ -565,6 +605,12 @@ def admin_batch_manage_tokens():
         elif action == 'delete':
             affected = db.admin_batch_delete_tokens(token_ids)
             logger.info(f"Admin {session['username']} batch deleted {affected} tokens")
+        elif action == 'check-balance':
+            token_ids = set(token_ids)
+            batch_result = check_and_save_balances([t for t in db.get_all_tokens() if t['id'] in token_ids])
+            logger.info(f"Admin {session['username']} batch checked balances: {batch_result['success_count']} success, "
+                        f"{batch_result['failed_count']} failed, {batch_result['timed_out_count']} timed out")
+            return jsonify({'success': True, 'affected': batch_result['success_count'], 'results': batch_result})
         else:
             return jsonify({'error': '无效的操作'}), 400
         
@@ -592,4 +638,42 @@ def admin_delete_user(user_id):
     if success:
         logger.info(f"Admin {session['username']} deleted user {user_id}")
         return jsonify({'success': True})
-    return jsonify({'error': '删除失败'}), 400
\ No newline at end of file
+    return jsonify({'error': '删除失败'}), 400
+
+# 日志归档
+@user_bp.route('/api/admin/archive', methods=['GET'])
+@admin_required
+def get_archive_stats():
+    """获取日志归档状态（管理员功能）"""
+    return jsonify({'archive': log_archiver.stats()})
+
+@user_bp.route('/api/admin/archive/run', methods=['POST'])
+@admin_required
+def run_archive():
+    """立即归档过期的日志记录（管理员功能）"""
+    try:
+        archived = log_archiver.run_once()
+        logger.info(f"Admin {session['username']} ran log archiving: {archived}")
+        return jsonify({'success': True, 'archived': archived})
+    except Exception as e:
+        logger.error(f"Log archiving failed: {e}")
+        return jsonify({'error': '归档失败'}), 500
+
+@user_bp.route('/api/admin/archive/<table>', methods=['GET'])
+@admin_required
+def query_archive(table):
+    """查询归档的日志记录（管理员功能）：start / end 为 YYYY-MM-DD，可按 user_id / token_id 过滤"""
+    if table not in ARCHIVE_TABLES:
+        return jsonify({'error': '不支持的表'}), 400
+    
+    start = request.args.get('start', '0000-00-00')
+    end = request.args.get('end', '9999-99-99')
+    limit = min(request.args.get('limit', 1000, type=int), 10000)
+    filters = {}
+    for key in ('user_id', 'token_id', 'api_key_id'):
+        value = request.args.get(key, type=int)
+        if value is not None:
+            filters[key] = value
+    
+    rows = log_archiver.query(table, start, end, limit=limit, **filters)
+    return jsonify({'rows': rows, 'count': len(rows)})
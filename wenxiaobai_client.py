@@ -4,6 +4,7 @@ import json
 import requests
 from datetime import datetime
 import pytz
+from http_transport import upstream_transport
 
 # 模型名称到模型ID的映射 - 完整的模型组合
 MODEL_MAP = {
@@ -247,7 +248,8 @@ class WenXiaoBaiAPI:
         signature = hmac_sha1(self.secret_key, signing_string)
         return signature
 
-    def chat(self, query, model="wenxiaobai-deep-thought", conversation_id=None, user_id=128122134, turn_index=0, is_new_conversation=None, **kwargs):
+    def _build_chat_request(self, query, model="wenxiaobai-deep-thought", conversation_id=None, user_id=128122134, turn_index=0, is_new_conversation=None, **kwargs):
+        """构造对话请求体并计算签名，返回 (headers, request_body)"""
         # 使用 MODEL_MAP 将模型名称转换为模型 ID
         model_id = MODEL_MAP.get(model, MODEL_MAP["wenxiaobai-deep-thought"])
         
@@ -313,8 +315,16 @@ class WenXiaoBaiAPI:
             'x-date': date_str,
         }
         
+        return headers, request_body
+
+    def chat(self, query, model="wenxiaobai-deep-thought", conversation_id=None, user_id=128122134, turn_index=0, is_new_conversation=None, **kwargs):
+        headers, request_body = self._build_chat_request(
+            query, model=model, conversation_id=conversation_id, user_id=user_id,
+            turn_index=turn_index, is_new_conversation=is_new_conversation, **kwargs
+        )
+        
         try:
-            response = requests.post(
+            response = upstream_transport.post(
                 self.base_url,
                 headers=headers,
                 json=request_body,
@@ -327,5 +337,34 @@ class WenXiaoBaiAPI:
             print(f"Request to WenXiaoBai API failed: {e}")
             return None
 
+    async def achat(self, query, model="wenxiaobai-deep-thought", conversation_id=None, user_id=128122134, turn_index=0, is_new_conversation=None, **kwargs):
+        """
+        chat 的异步版本（用于 ASGI 服务模式）
+        
+        返回已打开的 httpx 流式响应，调用方通过 response.aiter_lines() 逐行读取 SSE，
+        并在结束后调用 response.aclose() 归还连接。失败时返回 None。
+        """
+        import httpx
+        
+        headers, request_body = self._build_chat_request(
+            query, model=model, conversation_id=conversation_id, user_id=user_id,
+            turn_index=turn_index, is_new_conversation=is_new_conversation, **kwargs
+        )
+        
+        client = upstream_transport.get_async_client()
+        try:
+            request = client.build_request(
+                'POST',
+                self.base_url,
+                headers=headers,
+                # 与 requests 的 json= 序列化保持一致，确保两种模式发送的请求体相同
+                content=json.dumps(request_body).encode('utf-8'),
+                timeout=30
+            )
+            return await client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            print(f"Request to WenXiaoBai API failed: {e}")
+            return None
+
 def create_wenxiaobai_client(username, secret_key, access_token, device_id):
     return WenXiaoBaiAPI(username, secret_key, access_token, device_id)